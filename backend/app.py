@@ -3,16 +3,30 @@ The Fitness Revolution - Flask Backend API
 A comprehensive backend for the gym and fitness website
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, decode_token, jwt_required, get_jwt, get_jwt_identity
 from flask_cors import CORS
 from flask_bcrypt import Bcrypt
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
 from datetime import datetime, timedelta
 import os
-import uuid
+
+from keys import CompactUUID, new_id
+from ratelimit import RateLimiter, email_from_json
+from events import CapacityFeed
+from revocation import RevocationList
+from batch import BatchExecutor, BatchError, parse_batch
+from checkin import CheckInDesk, CheckInError
+from contact_queue import ContactQueue
+from media import ImageStore, MediaError
+from querybudget import QueryBudget
+from slowlog import SlowQueryLog
+from profiling import RequestProfiler
+from calendar_feeds import CalendarFeeds, FEED_KINDS, feed_scope, hash_feed_token, new_feed_token, render_calendar
+from leaderboards import Leaderboards, METRICS as LEADERBOARD_METRICS, PERIODS as LEADERBOARD_PERIODS
+from replicas import RoutingSession, replica_binds, branch_binds, BRANCH_BIND_PREFIX, BRANCH_PARTITIONED_TABLES
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -21,25 +35,185 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'fitness-revolution-secret-key-2024')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///fitness_revolution.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Read replicas for GET requests, comma-separated (become binds replica_0, replica_1, ...)
+app.config['SQLALCHEMY_BINDS'] = replica_binds(os.environ.get('DATABASE_REPLICA_URLS'))
+# Optional per-branch databases as code=url pairs (become binds branch_<code>)
+app.config['SQLALCHEMY_BINDS'].update(branch_binds(os.environ.get('BRANCH_DATABASE_URLS')))
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'jwt-secret-key-fitness-revolution')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=7)
 
+# Revoked token denylist (memory:// for a single process, sqlite:///<path> to
+# share it between gunicorn workers)
+app.config['REVOCATION_STORAGE_URL'] = os.environ.get('REVOCATION_STORAGE_URL', 'sqlite:///revocation.db')
+app.config['REVOCATION_SYNC_INTERVAL'] = float(os.environ.get('REVOCATION_SYNC_INTERVAL', 1.0))
+
+# Rate limiting (memory:// for a single process, sqlite:///<path> to share
+# buckets between gunicorn workers)
+app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', 'true').lower() == 'true'
+app.config['RATELIMIT_STORAGE_URL'] = os.environ.get('RATELIMIT_STORAGE_URL', 'sqlite:///ratelimit.db')
+app.config['RATELIMIT_TRUST_PROXY'] = os.environ.get('RATELIMIT_TRUST_PROXY', 'false').lower() == 'true'
+app.config['RATELIMIT_POLICIES'] = {
+    'login': {'ip': '20/minute', 'account': '5/minute'},
+    'register': {'ip': '10/hour', 'account': '3/hour'},
+    'submit_contact': {'ip': '5/minute', 'account': '10/hour'},
+    'upload_profile_image': {'ip': '20/minute', 'account': '20/hour'}
+}
+
+# Live capacity events (memory:// for a single process, sqlite:///<path> to
+# fan out across gunicorn workers)
+app.config['EVENTS_BROKER_URL'] = os.environ.get('EVENTS_BROKER_URL', 'sqlite:///events.db')
+
+# Classes older than this (and their bookings) are moved to the archive tables
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+
+# Trainer ranking: ratings are shrunk towards PRIOR_MEAN as if every trainer
+# had PRIOR_WEIGHT extra reviews of that score
+app.config['TRAINER_RATING_PRIOR_MEAN'] = float(os.environ.get('TRAINER_RATING_PRIOR_MEAN', 4.0))
+app.config['TRAINER_RATING_PRIOR_WEIGHT'] = float(os.environ.get('TRAINER_RATING_PRIOR_WEIGHT', 5))
+
+# Class check-in: journal of acknowledged check-ins not yet written, how often
+# they are written (seconds) and how many per transaction, and cancelled
+# bookings (memory:// for a single process, sqlite:///<path> to share them
+# between gunicorn workers)
+app.config['CHECKIN_JOURNAL_DIR'] = os.environ.get('CHECKIN_JOURNAL_DIR', 'checkin-journal')
+app.config['CHECKIN_STORAGE_URL'] = os.environ.get('CHECKIN_STORAGE_URL', 'sqlite:///checkin.db')
+app.config['CHECKIN_FLUSH_INTERVAL'] = float(os.environ.get('CHECKIN_FLUSH_INTERVAL', 0.5))
+app.config['CHECKIN_BATCH_SIZE'] = int(os.environ.get('CHECKIN_BATCH_SIZE', 100))
+app.config['CHECKIN_OPENS_MINUTES'] = int(os.environ.get('CHECKIN_OPENS_MINUTES', 30))
+
+# Contact form: journal of acknowledged submissions not yet written, how often
+# they are written (seconds), how many per transaction and how long identical
+# submissions are dropped as duplicates (seconds)
+app.config['CONTACT_JOURNAL_DIR'] = os.environ.get('CONTACT_JOURNAL_DIR', 'contact-journal')
+app.config['CONTACT_FLUSH_INTERVAL'] = float(os.environ.get('CONTACT_FLUSH_INTERVAL', 1.0))
+app.config['CONTACT_BATCH_SIZE'] = int(os.environ.get('CONTACT_BATCH_SIZE', 500))
+app.config['CONTACT_DEDUP_SECONDS'] = int(os.environ.get('CONTACT_DEDUP_SECONDS', 3600))
+
+# Profile images: where uploads and their resized variants are stored, the URL
+# prefix variants are served under (a CDN or nginx location in production),
+# upload limits, encoder quality and resize threads per worker
+app.config['MEDIA_ROOT'] = os.environ.get('MEDIA_ROOT', 'media')
+app.config['MEDIA_URL'] = os.environ.get('MEDIA_URL', '/media')
+app.config['MEDIA_MAX_UPLOAD_BYTES'] = int(os.environ.get('MEDIA_MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+app.config['MEDIA_MAX_PIXELS'] = int(os.environ.get('MEDIA_MAX_PIXELS', 40_000_000))
+app.config['MEDIA_QUALITY'] = int(os.environ.get('MEDIA_QUALITY', 82))
+app.config['MEDIA_WORKERS'] = int(os.environ.get('MEDIA_WORKERS', 4))
+
+# SQL statement budgets per route (QUERY_BUDGETS, at the end of this file):
+# off, log (logs over-budget requests), enforce (fails them, for tests) or
+# unset to log in debug mode only. Statements with the same fingerprint may
+# run at most QUERY_BUDGET_MAX_REPEATS times in one transaction on one database.
+app.config['QUERY_BUDGET_MODE'] = os.environ.get('QUERY_BUDGET_MODE')
+app.config['QUERY_BUDGET_MAX_REPEATS'] = int(os.environ.get('QUERY_BUDGET_MAX_REPEATS', 2))
+
+# Slow-query log: statements slower than this (0 disables) are logged with
+# their plan to a rotating JSON-lines file per worker (pid added to the name),
+# explaining each statement at most once per interval (seconds); parameters
+# named like a SLOW_QUERY_REDACT entry are redacted
+app.config['SLOW_QUERY_THRESHOLD_MS'] = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 200))
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG', 'logs/slow-queries.jsonl')
+app.config['SLOW_QUERY_LOG_BYTES'] = int(os.environ.get('SLOW_QUERY_LOG_BYTES', 10 * 1024 * 1024))
+app.config['SLOW_QUERY_LOG_BACKUPS'] = int(os.environ.get('SLOW_QUERY_LOG_BACKUPS', 5))
+app.config['SLOW_QUERY_EXPLAIN_INTERVAL'] = int(os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', 300))
+app.config['SLOW_QUERY_REDACT'] = os.environ.get(
+    'SLOW_QUERY_REDACT', 'email,phone,password,name,birth,address,token,secret,message')
+
+# Admin requests carrying PROFILE_HEADER (cprofile or sample) are profiled;
+# profiles are kept in PROFILE_DIR up to a file count and total size
+app.config['PROFILING_ENABLED'] = os.environ.get('PROFILING_ENABLED', 'true').lower() == 'true'
+app.config['PROFILE_HEADER'] = os.environ.get('PROFILE_HEADER', 'X-Profile')
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+app.config['PROFILE_MAX_FILES'] = int(os.environ.get('PROFILE_MAX_FILES', 50))
+app.config['PROFILE_MAX_BYTES'] = int(os.environ.get('PROFILE_MAX_BYTES', 200 * 1024 * 1024))
+app.config['PROFILE_SAMPLE_INTERVAL_MS'] = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 2))
+
+# Workout and calorie leaderboards: progress events (memory:// for a single
+# process, sqlite:///<path> to share them between gunicorn workers), how often
+# workers pick them up and how often boards are rebuilt from progress_logs (seconds)
+app.config['LEADERBOARD_STORAGE_URL'] = os.environ.get('LEADERBOARD_STORAGE_URL', 'sqlite:///leaderboards.db')
+app.config['LEADERBOARD_SYNC_INTERVAL'] = float(os.environ.get('LEADERBOARD_SYNC_INTERVAL', 1.0))
+app.config['LEADERBOARD_REBUILD_INTERVAL'] = int(os.environ.get('LEADERBOARD_REBUILD_INTERVAL', 3600))
+
+# iCalendar feeds: feed versions (memory:// for a single process, sqlite:///<path>
+# to share them between gunicorn workers), rendered feeds cached per worker,
+# the time zone class times are in and how many past days feeds include
+app.config['CALENDAR_VERSION_STORAGE_URL'] = os.environ.get('CALENDAR_VERSION_STORAGE_URL', 'sqlite:///calendar.db')
+app.config['CALENDAR_CACHE_SIZE'] = int(os.environ.get('CALENDAR_CACHE_SIZE', 10000))
+app.config['CALENDAR_TIMEZONE'] = os.environ.get('CALENDAR_TIMEZONE', 'Asia/Kolkata')
+app.config['CALENDAR_PAST_DAYS'] = int(os.environ.get('CALENDAR_PAST_DAYS', 30))
+
+# Occupancy forecasts (forecasting.py): days of past classes the model learns
+# from and days of upcoming classes it forecasts
+app.config['FORECAST_HISTORY_DAYS'] = int(os.environ.get('FORECAST_HISTORY_DAYS', 730))
+app.config['FORECAST_HORIZON_DAYS'] = int(os.environ.get('FORECAST_HORIZON_DAYS', 28))
+
+# Revenue report (revenue.py): days covered when no start date is given
+app.config['REVENUE_REPORT_DAYS'] = int(os.environ.get('REVENUE_REPORT_DAYS', 90))
+
+# Programs stored per member by recommendations.py
+app.config['RECOMMENDATIONS_TOP_K'] = int(os.environ.get('RECOMMENDATIONS_TOP_K', 5))
+
+# Daily plans per member in personalized meal plans (nutrition.py)
+app.config['MEAL_PLAN_DAYS'] = int(os.environ.get('MEAL_PLAN_DAYS', 7))
+
+# POST /api/batch limits
+app.config['BATCH_MAX_REQUESTS'] = int(os.environ.get('BATCH_MAX_REQUESTS', 20))
+app.config['BATCH_MAX_WORKERS'] = int(os.environ.get('BATCH_MAX_WORKERS', 4))
+
 # Initialize extensions
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 ma = Marshmallow(app)
 jwt = JWTManager(app)
 bcrypt = Bcrypt(app)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
+limiter = RateLimiter(app)
+capacity_feed = CapacityFeed(app)
+revocations = RevocationList(app)
+batch_executor = BatchExecutor(app, excluded_endpoints=('stream_class_availability',),
+                               max_workers=app.config['BATCH_MAX_WORKERS'])
+checkin_desk = CheckInDesk(app)
+contact_queue = ContactQueue(app)
+image_store = ImageStore(app)
+query_budget = QueryBudget(app)
+slow_queries = SlowQueryLog(app)
+request_profiler = RequestProfiler(app)
+leaderboards = Leaderboards(app)
+calendar_feeds = CalendarFeeds(app)
 
 # ============================================
 # DATABASE MODELS
 # ============================================
 
+class Branch(db.Model):
+    """Gym location (branch) model"""
+    __tablename__ = 'branches'
+    
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    code = db.Column(db.String(20), unique=True, nullable=False)  # short slug, e.g. blr-indiranagar
+    name = db.Column(db.String(100), nullable=False)
+    city = db.Column(db.String(100))
+    address = db.Column(db.Text)
+    phone = db.Column(db.String(20))
+    
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'code': self.code,
+            'name': self.name,
+            'city': self.city,
+            'address': self.address,
+            'phone': self.phone,
+            'is_active': self.is_active
+        }
+
 class User(db.Model):
     """User model for members, trainers, and admins"""
     __tablename__ = 'users'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
     first_name = db.Column(db.String(50), nullable=False)
@@ -57,9 +231,10 @@ class User(db.Model):
     activity_level = db.Column(db.String(20))  # sedentary, light, moderate, active
     
     # Membership
-    membership_id = db.Column(db.String(36), db.ForeignKey('memberships.id'))
+    membership_id = db.Column(CompactUUID, db.ForeignKey('memberships.id'))
     membership_start = db.Column(db.Date)
-    membership_end = db.Column(db.Date)
+    membership_end = db.Column(db.Date, index=True)
+    membership_billing = db.Column(db.String(10))  # monthly, yearly
     
     # Status
     is_active = db.Column(db.Boolean, default=True)
@@ -82,7 +257,11 @@ class User(db.Model):
             'last_name': self.last_name,
             'phone': self.phone,
             'role': self.role,
+            'profile_image': image_store.url(self.profile_image),
+            'profile_images': image_store.urls(self.profile_image),
             'membership_id': self.membership_id,
+            'membership_billing': self.membership_billing,
+            'membership_end': self.membership_end.isoformat() if self.membership_end else None,
             'is_active': self.is_active,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
@@ -90,8 +269,12 @@ class User(db.Model):
 class Membership(db.Model):
     """Membership plans model"""
     __tablename__ = 'memberships'
+    __table_args__ = (
+        db.Index('ix_memberships_branch_active', 'branch_id', 'is_active'),
+    )
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    branch_id = db.Column(CompactUUID, db.ForeignKey('branches.id'))  # None = all branches
     name = db.Column(db.String(50), nullable=False)  # Basic, Premium, Elite
     description = db.Column(db.Text)
     price_monthly = db.Column(db.Float, nullable=False)
@@ -106,8 +289,8 @@ class Membership(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # Relationships
-    users = db.relationship('User', backref='membership', lazy=True)
+    # Relationships (a query: plans can have many thousands of members)
+    users = db.relationship('User', backref='membership', lazy='dynamic')
     
     def to_dict(self):
         import json
@@ -121,15 +304,66 @@ class Membership(db.Model):
             'features': json.loads(self.features) if self.features else [],
             'not_included': json.loads(self.not_included) if self.not_included else [],
             'is_popular': self.is_popular,
+            'branch_id': self.branch_id,
             'is_active': self.is_active
         }
+    
+    def monthly_revenue(self, billing_cycle):
+        """What one member on this plan brings in per month"""
+        return self.price_yearly / 12 if billing_cycle == 'yearly' else self.price_monthly
+
+class MembershipChange(db.Model):
+    """Log of plan assignments and cancellations, aggregated by revenue.py"""
+    __tablename__ = 'membership_changes'
+    
+    KINDS = ('new', 'renewal', 'upgrade', 'downgrade', 'change', 'cancel')
+    
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'), nullable=False, index=True)
+    from_membership_id = db.Column(CompactUUID, db.ForeignKey('memberships.id'))
+    to_membership_id = db.Column(CompactUUID, db.ForeignKey('memberships.id'))  # None on cancel
+    billing_cycle = db.Column(db.String(10))
+    from_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    to_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    kind = db.Column(db.String(20), nullable=False)
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    @staticmethod
+    def classify(from_membership_id, to_membership_id, from_mrr, to_mrr):
+        if to_membership_id is None:
+            return 'cancel'
+        if from_membership_id is None:
+            return 'new'
+        if to_mrr > from_mrr:
+            return 'upgrade'
+        if to_mrr < from_mrr:
+            return 'downgrade'
+        return 'renewal' if from_membership_id == to_membership_id else 'change'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'from_membership_id': self.from_membership_id,
+            'to_membership_id': self.to_membership_id,
+            'billing_cycle': self.billing_cycle,
+            'from_mrr': self.from_mrr,
+            'to_mrr': self.to_mrr,
+            'kind': self.kind,
+            'changed_at': self.changed_at.isoformat() if self.changed_at else None
+        }
 
 class Trainer(db.Model):
     """Trainer model"""
     __tablename__ = 'trainers'
+    __table_args__ = (
+        db.Index('ix_trainers_branch_active', 'branch_id', 'is_active'),
+        db.Index('ix_trainers_active_ranking', 'is_active', 'ranking_score'),
+    )
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = db.Column(db.String(36), db.ForeignKey('users.id'))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'))
+    branch_id = db.Column(CompactUUID, db.ForeignKey('branches.id'))  # home branch
     
     # Professional details
     specialization = db.Column(db.Text)  # JSON array
@@ -141,25 +375,35 @@ class Trainer(db.Model):
     available_days = db.Column(db.Text)  # JSON array
     available_hours = db.Column(db.Text)  # JSON object
     
-    # Rating
+    # Rating, maintained by create_trainer_review
     rating = db.Column(db.Float, default=5.0)
     total_reviews = db.Column(db.Integer, default=0)
+    rating_sum = db.Column(db.Float, default=0.0)
+    ranking_score = db.Column(db.Float, default=lambda: Trainer.smoothed_rating(0.0, 0))
     
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
     classes = db.relationship('Class', backref='trainer', lazy=True)
+    user = db.relationship('User', foreign_keys=[user_id])
+    
+    @staticmethod
+    def smoothed_rating(rating_sum, total_reviews):
+        """Bayesian average rating; takes numbers or column expressions"""
+        weight = app.config['TRAINER_RATING_PRIOR_WEIGHT']
+        return (weight * app.config['TRAINER_RATING_PRIOR_MEAN'] + rating_sum) / (weight + total_reviews)
     
     def to_dict(self):
         import json
-        user = User.query.get(self.user_id)
+        user = self.user
         return {
             'id': self.id,
             'user_id': self.user_id,
             'name': f"{user.first_name} {user.last_name}" if user else None,
             'email': user.email if user else None,
-            'profile_image': user.profile_image if user else None,
+            'profile_image': image_store.url(user.profile_image) if user else None,
+            'profile_images': image_store.urls(user.profile_image) if user else None,
             'specialization': json.loads(self.specialization) if self.specialization else [],
             'experience_years': self.experience_years,
             'certifications': json.loads(self.certifications) if self.certifications else [],
@@ -167,14 +411,45 @@ class Trainer(db.Model):
             'available_days': json.loads(self.available_days) if self.available_days else [],
             'rating': self.rating,
             'total_reviews': self.total_reviews,
+            'ranking_score': round(self.ranking_score, 3) if self.ranking_score is not None else None,
+            'branch_id': self.branch_id,
             'is_active': self.is_active
         }
 
+class TrainerReview(db.Model):
+    """Review of a trainer by a member who attended one of their classes"""
+    __tablename__ = 'trainer_reviews'
+    __table_args__ = (
+        db.UniqueConstraint('trainer_id', 'user_id', name='uq_trainer_reviews_trainer_user'),
+        db.Index('ix_trainer_reviews_trainer_created', 'trainer_id', 'created_at'),
+    )
+    
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    trainer_id = db.Column(CompactUUID, db.ForeignKey('trainers.id'), nullable=False)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'), nullable=False)
+    rating = db.Column(db.Integer, nullable=False)  # 1-5
+    comment = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    user = db.relationship('User')
+    
+    def to_dict(self):
+        user = self.user
+        return {
+            'id': self.id,
+            'trainer_id': self.trainer_id,
+            'user_id': self.user_id,
+            'reviewer': f"{user.first_name} {user.last_name[:1]}." if user else None,
+            'rating': self.rating,
+            'comment': self.comment,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
 class Program(db.Model):
     """Fitness programs/classes model"""
     __tablename__ = 'programs'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     category = db.Column(db.String(50))  # HIIT, Yoga, Strength, Cardio
@@ -209,10 +484,15 @@ class Program(db.Model):
 class Class(db.Model):
     """Scheduled classes model"""
     __tablename__ = 'classes'
+    __table_args__ = (
+        db.Index('ix_classes_date_start_time', 'date', 'start_time'),
+        db.Index('ix_classes_branch_date_start_time', 'branch_id', 'date', 'start_time'),
+    )
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    program_id = db.Column(db.String(36), db.ForeignKey('programs.id'))
-    trainer_id = db.Column(db.String(36), db.ForeignKey('trainers.id'))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    branch_id = db.Column(CompactUUID, db.ForeignKey('branches.id'))
+    program_id = db.Column(CompactUUID, db.ForeignKey('programs.id'))
+    trainer_id = db.Column(CompactUUID, db.ForeignKey('trainers.id'))
     
     # Schedule
     date = db.Column(db.Date, nullable=False)
@@ -228,6 +508,10 @@ class Class(db.Model):
     max_participants = db.Column(db.Integer, default=20)
     enrolled_count = db.Column(db.Integer, default=0)
     
+    # Waitlist (tail is the last position handed out)
+    waitlist_tail = db.Column(db.Integer, default=0, nullable=False)
+    waitlist_count = db.Column(db.Integer, default=0, nullable=False)
+    
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -237,6 +521,7 @@ class Class(db.Model):
     def to_dict(self):
         return {
             'id': self.id,
+            'branch_id': self.branch_id,
             'program': self.program.to_dict() if self.program else None,
             'trainer': self.trainer.to_dict() if self.trainer else None,
             'date': self.date.isoformat() if self.date else None,
@@ -247,38 +532,137 @@ class Class(db.Model):
             'max_participants': self.max_participants,
             'enrolled_count': self.enrolled_count,
             'available_spots': self.max_participants - self.enrolled_count,
+            'waitlist_count': self.waitlist_count or 0,
             'is_active': self.is_active
         }
 
 class Booking(db.Model):
     """Class booking model"""
     __tablename__ = 'bookings'
+    __table_args__ = (
+        db.Index('ix_bookings_class_status', 'class_id', 'status'),
+        db.Index('ix_bookings_branch_status_booked_at', 'branch_id', 'status', 'booked_at'),
+    )
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = db.Column(db.String(36), db.ForeignKey('users.id'))
-    class_id = db.Column(db.String(36), db.ForeignKey('classes.id'))
+    # Statuses that occupy a seat and count towards Class.enrolled_count
+    # (a no-show still held the seat until the class started)
+    SEAT_HOLDING_STATUSES = ('confirmed', 'attended', 'no_show')
     
-    status = db.Column(db.String(20), default='confirmed')  # confirmed, cancelled, attended
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'))
+    class_id = db.Column(CompactUUID, db.ForeignKey('classes.id'))
+    branch_id = db.Column(CompactUUID, db.ForeignKey('branches.id'))  # copied from the class
+    
+    status = db.Column(db.String(20), default='confirmed')  # confirmed, cancelled, attended, no_show
     booked_at = db.Column(db.DateTime, default=datetime.utcnow)
     cancelled_at = db.Column(db.DateTime)
     attended = db.Column(db.Boolean, default=False)
+    checked_in_at = db.Column(db.DateTime)
     
     def to_dict(self):
         return {
             'id': self.id,
             'user_id': self.user_id,
             'class_id': self.class_id,
+            'branch_id': self.branch_id,
             'class_details': self.class_.to_dict() if self.class_ else None,
             'status': self.status,
             'booked_at': self.booked_at.isoformat() if self.booked_at else None,
-            'attended': self.attended
+            'attended': self.attended,
+            'checked_in_at': self.checked_in_at.isoformat() if self.checked_in_at else None
+        }
+
+class WaitlistEntry(db.Model):
+    """Class waitlist entry; members are promoted in position order"""
+    __tablename__ = 'waitlist_entries'
+    __table_args__ = (
+        db.UniqueConstraint('class_id', 'user_id', name='uq_waitlist_class_user'),
+        db.UniqueConstraint('class_id', 'position', name='uq_waitlist_class_position'),
+        db.Index('ix_waitlist_class_status_position', 'class_id', 'status', 'position')
+    )
+    
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    class_id = db.Column(CompactUUID, db.ForeignKey('classes.id'), nullable=False)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'), nullable=False)
+    
+    position = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), default='waiting')  # waiting, promoted, left
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    promoted_at = db.Column(db.DateTime)
+    
+    def people_ahead(self):
+        """Number of members still waiting in front of this entry"""
+        return WaitlistEntry.query.filter(
+            WaitlistEntry.class_id == self.class_id,
+            WaitlistEntry.status == 'waiting',
+            WaitlistEntry.position < self.position
+        ).count()
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'class_id': self.class_id,
+            'user_id': self.user_id,
+            'status': self.status,
+            'joined_at': self.created_at.isoformat() if self.created_at else None,
+            'promoted_at': self.promoted_at.isoformat() if self.promoted_at else None
         }
 
+class ArchivedClass(db.Model):
+    """Past class moved out of `classes` by archive.py"""
+    __tablename__ = 'archived_classes'
+    __table_args__ = (
+        db.Index('ix_archived_classes_date', 'date', 'start_time'),
+        db.Index('ix_archived_classes_branch_date', 'branch_id', 'date'),
+    )
+    
+    # Same columns as Class, without foreign keys
+    id = db.Column(CompactUUID, primary_key=True)
+    branch_id = db.Column(CompactUUID)
+    program_id = db.Column(CompactUUID)
+    trainer_id = db.Column(CompactUUID)
+    date = db.Column(db.Date, nullable=False)
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    location = db.Column(db.String(100))
+    is_virtual = db.Column(db.Boolean, default=False)
+    meeting_link = db.Column(db.String(255))
+    max_participants = db.Column(db.Integer, default=20)
+    enrolled_count = db.Column(db.Integer, default=0)
+    waitlist_tail = db.Column(db.Integer, default=0, nullable=False)
+    waitlist_count = db.Column(db.Integer, default=0, nullable=False)
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime)
+    
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ArchivedBooking(db.Model):
+    """Booking of an archived class"""
+    __tablename__ = 'archived_bookings'
+    __table_args__ = (
+        db.Index('ix_archived_bookings_user_booked_at', 'user_id', 'booked_at'),
+        db.Index('ix_archived_bookings_class', 'class_id'),
+        db.Index('ix_archived_bookings_branch_booked_at', 'branch_id', 'booked_at'),
+    )
+    
+    # Same columns as Booking, without foreign keys
+    id = db.Column(CompactUUID, primary_key=True)
+    user_id = db.Column(CompactUUID)
+    class_id = db.Column(CompactUUID)
+    branch_id = db.Column(CompactUUID)
+    status = db.Column(db.String(20))
+    booked_at = db.Column(db.DateTime)
+    cancelled_at = db.Column(db.DateTime)
+    attended = db.Column(db.Boolean, default=False)
+    checked_in_at = db.Column(db.DateTime)
+    
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class MealPlan(db.Model):
     """Nutrition meal plans model"""
     __tablename__ = 'meal_plans'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     category = db.Column(db.String(50))  # weight_loss, muscle_gain, vegetarian, maintenance
@@ -316,8 +700,8 @@ class ProgressLog(db.Model):
     """User fitness progress tracking"""
     __tablename__ = 'progress_logs'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = db.Column(db.String(36), db.ForeignKey('users.id'))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'))
     
     # Measurements
     weight = db.Column(db.Float)
@@ -331,7 +715,8 @@ class ProgressLog(db.Model):
     calories_burned = db.Column(db.Integer)
     
     notes = db.Column(db.Text)
-    log_date = db.Column(db.Date, default=datetime.utcnow)
+    # Indexed for the weekly and monthly leaderboard rebuilds
+    log_date = db.Column(db.Date, default=datetime.utcnow, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def to_dict(self):
@@ -353,15 +738,16 @@ class ContactMessage(db.Model):
     """Contact form messages"""
     __tablename__ = 'contact_messages'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), nullable=False)
     phone = db.Column(db.String(20))
     subject = db.Column(db.String(200))
     message = db.Column(db.Text, nullable=False)
+    content_hash = db.Column(db.String(64), index=True)  # for dropping resubmissions
     
     is_read = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     def to_dict(self):
         return {
@@ -375,6 +761,161 @@ class ContactMessage(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+class Counter(db.Model):
+    """Denormalized counts, updated in the transactions that change what they count"""
+    __tablename__ = 'counters'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class Recommendation(db.Model):
+    """Precomputed top programs per member, written by recommendations.py"""
+    __tablename__ = 'recommendations'
+    
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'), primary_key=True)
+    programs = db.Column(db.Text, nullable=False)  # JSON: [{program_id, score, reason}, ...]
+    class_ids = db.Column(db.Text, nullable=False)  # JSON: next open class per program
+    generated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def to_dict(self):
+        import json
+        return {
+            'user_id': self.user_id,
+            'programs': json.loads(self.programs),
+            'class_ids': json.loads(self.class_ids),
+            'generated_at': self.generated_at.isoformat() if self.generated_at else None
+        }
+
+class PersonalMealPlan(db.Model):
+    """Generated daily meal plans per member, written by nutrition.py"""
+    __tablename__ = 'personal_meal_plans'
+    
+    # User fields the targets are computed from
+    PROFILE_FIELDS = ('height', 'weight', 'date_of_birth', 'gender', 'activity_level', 'fitness_goal')
+    
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'), primary_key=True)
+    profile_hash = db.Column(db.String(40), nullable=False)
+    targets = db.Column(db.Text, nullable=False)  # JSON: daily calories and macro grams
+    days = db.Column(db.Text, nullable=False)  # JSON: [{day, meals, totals}, ...]
+    generated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def to_dict(self):
+        import json
+        return {
+            'user_id': self.user_id,
+            'targets': json.loads(self.targets),
+            'days': json.loads(self.days),
+            'generated_at': self.generated_at.isoformat() if self.generated_at else None
+        }
+
+class OccupancyForecast(db.Model):
+    """Predicted demand and suggested capacity per upcoming class, written by forecasting.py"""
+    __tablename__ = 'occupancy_forecasts'
+    
+    # Not a foreign key: the class may live in a branch database
+    class_id = db.Column(CompactUUID, primary_key=True)
+    branch_id = db.Column(CompactUUID, index=True)
+    program_id = db.Column(CompactUUID)
+    class_date = db.Column(db.Date, nullable=False, index=True)
+    start_time = db.Column(db.Time, nullable=False)
+    max_participants = db.Column(db.Integer)  # when forecast
+    predicted_bookings = db.Column(db.Float, nullable=False)  # bookings plus waitlist
+    predicted_fill_rate = db.Column(db.Float, nullable=False)  # can exceed 1 when oversubscribed
+    suggested_capacity = db.Column(db.Integer, nullable=False)
+    generated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def to_dict(self):
+        return {
+            'class_id': self.class_id,
+            'branch_id': self.branch_id,
+            'program_id': self.program_id,
+            'date': self.class_date.isoformat() if self.class_date else None,
+            'start_time': self.start_time.isoformat() if self.start_time else None,
+            'max_participants': self.max_participants,
+            'predicted_bookings': self.predicted_bookings,
+            'predicted_fill_rate': self.predicted_fill_rate,
+            'suggested_capacity': self.suggested_capacity,
+            'capacity_change': self.suggested_capacity - (self.max_participants or 0),
+            'generated_at': self.generated_at.isoformat() if self.generated_at else None
+        }
+
+class CalendarFeed(db.Model):
+    """Secret iCalendar feed of a member's bookings or a trainer's classes"""
+    __tablename__ = 'calendar_feeds'
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'owner_id', name='uq_calendar_feeds_owner'),
+    )
+    
+    token_hash = db.Column(db.String(64), primary_key=True)  # sha256 of the URL token
+    kind = db.Column(db.String(20), nullable=False)  # member, trainer
+    owner_id = db.Column(CompactUUID, nullable=False)  # users.id or trainers.id
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'owner_id': self.owner_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class RevenueSnapshot(db.Model):
+    """Members, MRR and plan movements per plan per day, written by revenue.py"""
+    __tablename__ = 'revenue_snapshots'
+    __table_args__ = (
+        db.UniqueConstraint('snapshot_date', 'membership_id', name='uq_revenue_snapshots_plan_day'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    snapshot_date = db.Column(db.Date, nullable=False, index=True)
+    membership_id = db.Column(CompactUUID, nullable=False)
+    plan_name = db.Column(db.String(50))  # as of the snapshot
+    active_members = db.Column(db.Integer, nullable=False, default=0)
+    yearly_members = db.Column(db.Integer, nullable=False, default=0)
+    mrr = db.Column(db.Float, nullable=False, default=0.0)
+    
+    # Movements during the day
+    new_members = db.Column(db.Integer, nullable=False, default=0)
+    renewals = db.Column(db.Integer, nullable=False, default=0)
+    upgrades = db.Column(db.Integer, nullable=False, default=0)
+    downgrades = db.Column(db.Integer, nullable=False, default=0)
+    cancellations = db.Column(db.Integer, nullable=False, default=0)
+    expirations = db.Column(db.Integer, nullable=False, default=0)
+    new_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    expansion_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    contraction_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    churned_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    generated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ReconcileRun(db.Model):
+    """One enrolled_count reconciliation run, written by reconcile.py"""
+    __tablename__ = 'reconcile_runs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    run_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    start = db.Column(db.Date, nullable=False)
+    end = db.Column(db.Date, nullable=False)
+    dry_run = db.Column(db.Boolean, nullable=False, default=False)
+    classes_checked = db.Column(db.Integer, nullable=False, default=0)
+    drifted_classes = db.Column(db.Integer, nullable=False, default=0)
+    repaired_classes = db.Column(db.Integer, nullable=False, default=0)
+    absolute_drift = db.Column(db.Integer, nullable=False, default=0)
+    promoted = db.Column(db.Integer, nullable=False, default=0)
+    duration_ms = db.Column(db.Float)
+    
+    def to_dict(self):
+        return {
+            'run_at': self.run_at.isoformat() if self.run_at else None,
+            'start': self.start.isoformat(),
+            'end': self.end.isoformat(),
+            'dry_run': self.dry_run,
+            'classes_checked': self.classes_checked,
+            'drifted_classes': self.drifted_classes,
+            'repaired_classes': self.repaired_classes,
+            'absolute_drift': self.absolute_drift,
+            'promoted': self.promoted,
+            'duration_ms': self.duration_ms
+        }
+
 # ============================================
 # SCHEMAS (Marshmallow)
 # ============================================
@@ -427,13 +968,19 @@ def api_docs():
                 'POST /api/auth/register': 'Register new user',
                 'POST /api/auth/login': 'Login user',
                 'GET /api/auth/me': 'Get current user (requires JWT)',
-                'POST /api/auth/change-password': 'Change password (requires JWT)'
+                'POST /api/auth/change-password': 'Change password (requires JWT)',
+                'POST /api/auth/logout': 'Revoke the current token (requires JWT)'
             },
             'Users': {
                 'GET /api/users': 'Get all users (admin only)',
                 'GET /api/users/<id>': 'Get user by ID',
                 'PUT /api/users/<id>': 'Update user',
-                'DELETE /api/users/<id>': 'Delete user (admin only)'
+                'DELETE /api/users/<id>': 'Delete user (admin only)',
+                'PUT /api/users/<id>/membership': 'Start, renew or change a plan, billing_cycle=monthly|yearly (admin only)',
+                'DELETE /api/users/<id>/membership': 'Cancel a plan (admin only)',
+                'POST /api/users/<id>/profile-image': 'Upload a profile image, multipart field image (requires JWT)',
+                'DELETE /api/users/<id>/profile-image': 'Remove the profile image (requires JWT)',
+                'GET /media/<key>-<variant>.<webp|jpg>': 'Resized profile image, variant=thumb|card|large'
             },
             'Memberships': {
                 'GET /api/memberships': 'Get all memberships',
@@ -443,7 +990,10 @@ def api_docs():
             'Trainers': {
                 'GET /api/trainers': 'Get all trainers',
                 'POST /api/trainers': 'Create trainer (admin only)',
-                'GET /api/trainers/<id>': 'Get trainer by ID'
+                'GET /api/trainers/<id>': 'Get trainer by ID',
+                'GET /api/trainers?sort=ranking': 'Trainers by smoothed rating',
+                'GET /api/trainers/<id>/reviews': 'Get trainer reviews',
+                'POST /api/trainers/<id>/reviews': 'Review a trainer after attending their class (requires JWT)'
             },
             'Programs': {
                 'GET /api/programs': 'Get all programs',
@@ -452,11 +1002,42 @@ def api_docs():
             },
             'Classes': {
                 'GET /api/classes': 'Get all classes (with filters)',
-                'POST /api/classes': 'Create class (admin/trainer)'
+                'POST /api/classes': 'Create class (admin/trainer)',
+                'GET /api/classes/<id>/roster': 'Class attendees (class trainer/admin)',
+                'POST /api/classes/<id>/attendance': 'Mark attended / no-show in bulk (class trainer/admin)'
             },
             'Bookings': {
                 'GET /api/bookings': 'Get bookings (user/admin)',
-                'POST /api/bookings': 'Create booking'
+                'POST /api/bookings': 'Create booking',
+                'POST /api/checkin': 'Check in to a class (requires JWT)'
+            },
+            'Recommendations': {
+                'GET /api/recommendations': 'Recommended programs, ?include_classes=true for classes (requires JWT)',
+                'POST /api/admin/recommendations/refresh': 'Recompute recommendations (admin only)'
+            },
+            'Forecasts': {
+                'GET /api/admin/forecasts/occupancy': 'Predicted occupancy and suggested capacity of upcoming classes (admin only)',
+                'POST /api/admin/forecasts/refresh': 'Refit the occupancy model (admin only)'
+            },
+            'Reports': {
+                'GET /api/admin/reports/revenue': 'MRR, plan mix, churn and plan changes, ?interval=day|week|month (admin only)',
+                'POST /api/admin/reports/revenue/snapshot': 'Take or backfill daily revenue snapshots (admin only)'
+            },
+            'Calendar': {
+                'POST /api/calendar/feeds': 'Create a secret iCalendar feed URL, kind=member|trainer (requires JWT)',
+                'DELETE /api/calendar/feeds/<kind>': 'Revoke a feed URL (requires JWT)',
+                'GET /api/calendar/members/<token>.ics': "Member's booked classes (feed token)",
+                'GET /api/calendar/trainers/<token>.ics': "Trainer's classes (feed token)"
+            },
+            'Leaderboards': {
+                'GET /api/leaderboards/<metric>': 'Top members by workouts or calories, ?period=week|month|all',
+                'GET /api/leaderboards/<metric>/me': 'Rank of the current user (requires JWT)',
+                'POST /api/admin/leaderboards/rebuild': 'Rebuild leaderboards from progress logs (admin only)'
+            },
+            'Meal Plans': {
+                'GET /api/meal-plans': 'Get meal plans (filter by category)',
+                'GET /api/meal-plans/personal': 'Generated plan for the current user (requires JWT)',
+                'POST /api/admin/meal-plans/refresh': 'Regenerate personal meal plans (admin only)'
             }
         }
     })
@@ -465,7 +1046,21 @@ def api_docs():
 # AUTHENTICATION ROUTES
 # ============================================
 
+@jwt.token_in_blocklist_loader
+def check_if_token_revoked(jwt_header, jwt_payload):
+    return revocations.is_revoked(jwt_payload['jti'])
+
+
+def issue_token(user):
+    """Create an access token for `user`, recorded so it can be revoked"""
+    access_token = create_access_token(identity=user.id)
+    claims = decode_token(access_token)
+    revocations.track(claims['jti'], user.id, claims['exp'])
+    return access_token
+
+
 @app.route('/api/auth/register', methods=['POST'])
+@limiter.limit(account=email_from_json)
 def register():
     """Register a new user"""
     data = request.get_json()
@@ -498,7 +1093,7 @@ def register():
     db.session.commit()
     
     # Create access token
-    access_token = create_access_token(identity=new_user.id)
+    access_token = issue_token(new_user)
     
     return jsonify({
         'message': 'User registered successfully',
@@ -508,6 +1103,7 @@ def register():
 
 
 @app.route('/api/auth/login', methods=['POST'])
+@limiter.limit(account=email_from_json)
 def login():
     """Login user"""
     data = request.get_json()
@@ -526,7 +1122,7 @@ def login():
     if not user.is_active:
         return jsonify({'error': 'Account is deactivated'}), 403
     
-    access_token = create_access_token(identity=user.id)
+    access_token = issue_token(user)
     
     return jsonify({
         'message': 'Login successful',
@@ -565,7 +1161,23 @@ def change_password():
     user.password = bcrypt.generate_password_hash(new_password).decode('utf-8')
     db.session.commit()
     
-    return jsonify({'message': 'Password changed successfully'}), 200
+    # Sign out every session, then give this one a fresh token
+    revocations.revoke_user(user.id)
+    
+    return jsonify({
+        'message': 'Password changed successfully',
+        'token': issue_token(user)
+    }), 200
+
+
+@app.route('/api/auth/logout', methods=['POST'])
+@jwt_required()
+def logout():
+    """Revoke the token used for this request"""
+    claims = get_jwt()
+    revocations.revoke(claims['jti'], claims['exp'])
+    
+    return jsonify({'message': 'Logged out successfully'}), 200
 
 
 # ============================================
@@ -619,6 +1231,7 @@ def update_user(user_id):
         return jsonify({'error': 'User not found'}), 404
     
     data = request.get_json()
+    profile_before = [getattr(user, field) for field in PersonalMealPlan.PROFILE_FIELDS]
     
     # Update fields
     if 'first_name' in data:
@@ -635,10 +1248,22 @@ def update_user(user_id):
         user.fitness_goal = data['fitness_goal']
     if 'activity_level' in data:
         user.activity_level = data['activity_level']
+    if 'date_of_birth' in data:
+        user.date_of_birth = datetime.strptime(data['date_of_birth'], '%Y-%m-%d').date() if data['date_of_birth'] else None
+    if 'gender' in data:
+        user.gender = data['gender']
+    
+    profile_changed = [getattr(user, field) for field in PersonalMealPlan.PROFILE_FIELDS] != profile_before
     
     user.updated_at = datetime.utcnow()
     db.session.commit()
     
+    if profile_changed:
+        # Personal meal plan targets depend on these; regenerated here so the
+        # GET stays read-only
+        from nutrition import store_plan
+        store_plan(user, app.config['MEAL_PLAN_DAYS'])
+    
     return jsonify({
         'message': 'User updated successfully',
         'user': user.to_dict()
@@ -660,131 +1285,449 @@ def delete_user(user_id):
         return jsonify({'error': 'User not found'}), 404
     
     user.is_active = False
+    if user.membership_id:
+        record_membership_change(user, None)
     db.session.commit()
     
+    revocations.revoke_user(user.id)
+    calendar_feeds.bump(feed_scope('member', user.id))
+    
     return jsonify({'message': 'User deactivated successfully'}), 200
 
 
-# ============================================
-# MEMBERSHIP ROUTES
-# ============================================
-
-@app.route('/api/memberships', methods=['GET'])
-def get_memberships():
-    """Get all membership plans"""
-    memberships = Membership.query.filter_by(is_active=True).all()
-    return jsonify({'memberships': [m.to_dict() for m in memberships]}), 200
+def record_membership_change(user, membership, billing_cycle=None, start=None):
+    """Move `user` onto `membership` (None cancels) and log it for revenue.py"""
+    from datetime import date
+    
+    # A plan that already ran out was counted as an expiration; coming back
+    # after it is a reactivation ('new'), not a renewal
+    lapsed = user.membership_end is not None and user.membership_end < date.today()
+    previous = Membership.query.get(user.membership_id) if user.membership_id and not lapsed else None
+    from_mrr = previous.monthly_revenue(user.membership_billing) if previous else 0.0
+    to_mrr = membership.monthly_revenue(billing_cycle) if membership else 0.0
+    change = MembershipChange(
+        user_id=user.id,
+        from_membership_id=previous.id if previous else None,
+        to_membership_id=membership.id if membership else None,
+        billing_cycle=billing_cycle,
+        from_mrr=from_mrr,
+        to_mrr=to_mrr,
+        kind=MembershipChange.classify(previous.id if previous else None, membership.id if membership else None,
+                                       from_mrr, to_mrr)
+    )
+    db.session.add(change)
+    
+    if membership:
+        start = start or date.today()
+        user.membership_id = membership.id
+        user.membership_billing = billing_cycle
+        user.membership_start = start
+        user.membership_end = start + timedelta(days=365 if billing_cycle == 'yearly' else membership.duration_days or 30)
+    else:
+        user.membership_id = None
+        user.membership_billing = None
+        user.membership_end = date.today()
+    user.updated_at = datetime.utcnow()
+    return change
 
 
-@app.route('/api/memberships', methods=['POST'])
+@app.route('/api/users/<user_id>/membership', methods=['PUT'])
 @jwt_required()
-def create_membership():
-    """Create new membership plan (admin only)"""
-    user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+def assign_membership(user_id):
+    """Start, renew or change a member's plan (admin only)"""
+    current_user = User.query.get(get_jwt_identity())
     
-    if user.role != 'admin':
+    if current_user.role != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    data = request.get_json()
-    import json
+    user = User.query.get(user_id)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
     
-    new_membership = Membership(
-        name=data['name'],
-        description=data.get('description'),
-        price_monthly=data['price_monthly'],
-        price_yearly=data['price_yearly'],
-        duration_days=data.get('duration_days', 30),
-        features=json.dumps(data.get('features', [])),
-        not_included=json.dumps(data.get('not_included', [])),
-        is_popular=data.get('is_popular', False)
-    )
+    data = request.get_json() or {}
+    membership = Membership.query.get(data.get('membership_id')) if data.get('membership_id') else None
+    if not membership or not membership.is_active:
+        return jsonify({'error': 'Membership not found'}), 404
     
-    db.session.add(new_membership)
+    from datetime import date
+    
+    billing_cycle = data.get('billing_cycle', 'monthly')
+    if billing_cycle not in ('monthly', 'yearly'):
+        return jsonify({'error': 'billing_cycle must be monthly or yearly'}), 400
+    try:
+        start = date.fromisoformat(data['start_date']) if data.get('start_date') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid start_date, use YYYY-MM-DD'}), 400
+    
+    change = record_membership_change(user, membership, billing_cycle, start)
     db.session.commit()
     
     return jsonify({
-        'message': 'Membership created successfully',
-        'membership': new_membership.to_dict()
-    }), 201
+        'message': 'Membership updated successfully',
+        'change': change.to_dict(),
+        'user': user.to_dict()
+    }), 200
 
 
-@app.route('/api/memberships/<membership_id>', methods=['PUT'])
+@app.route('/api/users/<user_id>/membership', methods=['DELETE'])
 @jwt_required()
-def update_membership(membership_id):
-    """Update membership plan (admin only)"""
-    user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+def cancel_membership(user_id):
+    """End a member's plan today (admin only)"""
+    current_user = User.query.get(get_jwt_identity())
     
-    if user.role != 'admin':
+    if current_user.role != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    membership = Membership.query.get(membership_id)
-    if not membership:
-        return jsonify({'error': 'Membership not found'}), 404
-    
-    data = request.get_json()
-    import json
-    
-    if 'name' in data:
-        membership.name = data['name']
-    if 'description' in data:
-        membership.description = data['description']
-    if 'price_monthly' in data:
-        membership.price_monthly = data['price_monthly']
-    if 'price_yearly' in data:
-        membership.price_yearly = data['price_yearly']
-    if 'features' in data:
-        membership.features = json.dumps(data['features'])
-    if 'not_included' in data:
-        membership.not_included = json.dumps(data['not_included'])
-    if 'is_popular' in data:
-        membership.is_popular = data['is_popular']
-    if 'is_active' in data:
-        membership.is_active = data['is_active']
+    user = User.query.get(user_id)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    if not user.membership_id:
+        return jsonify({'error': 'User has no membership'}), 400
     
+    change = record_membership_change(user, None)
     db.session.commit()
     
     return jsonify({
-        'message': 'Membership updated successfully',
-        'membership': membership.to_dict()
+        'message': 'Membership cancelled successfully',
+        'change': change.to_dict(),
+        'user': user.to_dict()
     }), 200
 
 
-# ============================================
-# TRAINER ROUTES
-# ============================================
-
-@app.route('/api/trainers', methods=['GET'])
-def get_trainers():
-    """Get all active trainers"""
-    trainers = Trainer.query.filter_by(is_active=True).all()
-    return jsonify({'trainers': [t.to_dict() for t in trainers]}), 200
-
 
-@app.route('/api/trainers', methods=['POST'])
+@app.route('/api/users/<user_id>/profile-image', methods=['POST'])
 @jwt_required()
-def create_trainer():
-    """Create new trainer (admin only)"""
-    user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+@limiter.limit(account=get_jwt_identity)
+def upload_profile_image(user_id):
+    """Upload a profile image: multipart field `image`, or the raw image as the body"""
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
     
-    if user.role != 'admin':
+    if current_user.role != 'admin' and current_user_id != user_id:
         return jsonify({'error': 'Unauthorized'}), 403
     
-    data = request.get_json()
-    import json
+    user = User.query.get(user_id)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
     
-    new_trainer = Trainer(
-        user_id=data['user_id'],
-        specialization=json.dumps(data.get('specialization', [])),
-        experience_years=data.get('experience_years', 0),
-        certifications=json.dumps(data.get('certifications', [])),
-        bio=data.get('bio'),
-        available_days=json.dumps(data.get('available_days', []))
-    )
+    # Refuse oversized bodies before reading them
+    if request.content_length and request.content_length > image_store.max_bytes + 64 * 1024:
+        return jsonify({'error': 'Image is too large'}), 413
+    upload = request.files.get('image')
+    data = upload.read(image_store.max_bytes + 1) if upload else request.get_data()
+    if not data:
+        return jsonify({'error': 'image is required'}), 400
     
-    db.session.add(new_trainer)
+    try:
+        key, deduplicated = image_store.store(data)
+    except MediaError as e:
+        return jsonify({'error': e.message}), e.status
+    
+    user.profile_image = key
+    user.updated_at = datetime.utcnow()
+    db.session.commit()
+    
+    return jsonify({
+        'message': 'Profile image updated successfully',
+        'image': {'key': key, 'deduplicated': deduplicated, 'variants': image_store.urls(key)},
+        'user': user.to_dict()
+    }), 201
+
+
+@app.route('/api/users/<user_id>/profile-image', methods=['DELETE'])
+@jwt_required()
+def delete_profile_image(user_id):
+    """Remove a profile image (its files stay: other accounts may share them)"""
+    current_user_id = get_jwt_identity()
+    current_user = User.query.get(current_user_id)
+    
+    if current_user.role != 'admin' and current_user_id != user_id:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    user = User.query.get(user_id)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    
+    user.profile_image = None
+    user.updated_at = datetime.utcnow()
+    db.session.commit()
+    
+    return jsonify({'message': 'Profile image removed successfully', 'user': user.to_dict()}), 200
+
+
+@app.route('/media/<filename>', methods=['GET'])
+def get_media(filename):
+    """Serve a resized image; names are content hashes, so cache them forever"""
+    from flask import send_file
+    
+    located = image_store.locate(filename)
+    if located is None:
+        return jsonify({'error': 'Image not found'}), 404
+    path, mimetype = located
+    
+    response = send_file(os.path.abspath(path), mimetype=mimetype, etag=filename.split('.')[0],
+                         conditional=True, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+# ============================================
+# BRANCH ROUTES
+# ============================================
+
+# Branch lookup by id or code, refreshed every minute: {ref: (id, code)}
+_branch_directory = {'loaded_at': None, 'refs': {}}
+BRANCH_DIRECTORY_TTL = timedelta(minutes=1)
+
+
+def resolve_branch(ref):
+    """(id, code) of the branch with id or code `ref`, or None"""
+    loaded_at = _branch_directory['loaded_at']
+    if loaded_at is None or datetime.utcnow() - loaded_at > BRANCH_DIRECTORY_TTL \
+            or ref not in _branch_directory['refs']:
+        refs = {}
+        for branch_id, code in db.session.query(Branch.id, Branch.code).all():
+            refs[branch_id] = refs[code] = (branch_id, code)
+        _branch_directory['refs'] = refs
+        _branch_directory['loaded_at'] = datetime.utcnow()
+    return _branch_directory['refs'].get(ref)
+
+
+def current_branch_id():
+    """Branch selected with the X-Branch header or ?branch= (id or code)
+
+    Unknown branches resolve to the raw value so scoped queries match nothing.
+    """
+    if 'branch_id' not in g:
+        ref = request.headers.get('X-Branch') or request.args.get('branch')
+        branch = resolve_branch(ref) if ref else None
+        g.branch_id = branch[0] if branch else ref
+    return g.branch_id
+
+
+def scope_to_branch(query, model, include_shared=False):
+    """Restrict a query to the current branch, if one is selected
+
+    `include_shared` also keeps rows without a branch (chain-wide records).
+    """
+    branch_id = current_branch_id()
+    if not branch_id:
+        return query
+    if include_shared:
+        return query.filter(db.or_(model.branch_id == branch_id, model.branch_id.is_(None)))
+    return query.filter(model.branch_id == branch_id)
+
+
+@app.before_request
+def bind_branch_database():
+    """Point partitioned tables at the branch's own database, if configured"""
+    if not any(key.startswith(BRANCH_BIND_PREFIX) for key in app.config['SQLALCHEMY_BINDS']):
+        return
+    ref = request.headers.get('X-Branch') or request.args.get('branch')
+    branch = resolve_branch(ref) if ref else None
+    if branch:
+        db.session().use_branch(branch[1])
+
+
+def branch_database_codes():
+    """Codes of the branches that have a database of their own"""
+    return [key[len(BRANCH_BIND_PREFIX):] for key in app.config['SQLALCHEMY_BINDS']
+            if key.startswith(BRANCH_BIND_PREFIX)]
+
+
+def each_database():
+    """Iterate once per database holding partitioned tables (default, then
+    branch databases), each in its own app context and session"""
+    for code in [None] + branch_database_codes():
+        with app.app_context():
+            if code:
+                db.session().use_branch(code)
+            yield code
+
+
+def create_branch_tables():
+    """Create the partitioned tables in every branch database"""
+    tables = [db.metadata.tables[name] for name in BRANCH_PARTITIONED_TABLES]
+    for key, engine in db.engines.items():
+        if key and key.startswith(BRANCH_BIND_PREFIX):
+            db.metadata.create_all(engine, tables=tables)
+
+
+@app.route('/api/branches', methods=['GET'])
+def get_branches():
+    """Get all active branches"""
+    branches = Branch.query.filter_by(is_active=True).order_by(Branch.name).all()
+    return jsonify({'branches': [b.to_dict() for b in branches]}), 200
+
+
+@app.route('/api/branches', methods=['POST'])
+@jwt_required()
+def create_branch():
+    """Create new branch (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    data = request.get_json()
+    
+    for field in ['code', 'name']:
+        if not data.get(field):
+            return jsonify({'error': f'{field} is required'}), 400
+    
+    if Branch.query.filter_by(code=data['code']).first():
+        return jsonify({'error': 'Branch code already exists'}), 409
+    
+    new_branch = Branch(
+        code=data['code'],
+        name=data['name'],
+        city=data.get('city'),
+        address=data.get('address'),
+        phone=data.get('phone')
+    )
+    
+    db.session.add(new_branch)
+    db.session.commit()
+    
+    return jsonify({
+        'message': 'Branch created successfully',
+        'branch': new_branch.to_dict()
+    }), 201
+
+
+# ============================================
+# MEMBERSHIP ROUTES
+# ============================================
+
+@app.route('/api/memberships', methods=['GET'])
+def get_memberships():
+    """Get all membership plans"""
+    query = scope_to_branch(Membership.query.filter_by(is_active=True), Membership, include_shared=True)
+    memberships = query.all()
+    return jsonify({'memberships': [m.to_dict() for m in memberships]}), 200
+
+
+@app.route('/api/memberships', methods=['POST'])
+@jwt_required()
+def create_membership():
+    """Create new membership plan (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    data = request.get_json()
+    import json
+    
+    new_membership = Membership(
+        name=data['name'],
+        description=data.get('description'),
+        price_monthly=data['price_monthly'],
+        price_yearly=data['price_yearly'],
+        duration_days=data.get('duration_days', 30),
+        features=json.dumps(data.get('features', [])),
+        not_included=json.dumps(data.get('not_included', [])),
+        is_popular=data.get('is_popular', False),
+        branch_id=data.get('branch_id')
+    )
+    
+    db.session.add(new_membership)
+    db.session.commit()
+    
+    return jsonify({
+        'message': 'Membership created successfully',
+        'membership': new_membership.to_dict()
+    }), 201
+
+
+@app.route('/api/memberships/<membership_id>', methods=['PUT'])
+@jwt_required()
+def update_membership(membership_id):
+    """Update membership plan (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    membership = Membership.query.get(membership_id)
+    if not membership:
+        return jsonify({'error': 'Membership not found'}), 404
+    
+    data = request.get_json()
+    import json
+    
+    if 'name' in data:
+        membership.name = data['name']
+    if 'description' in data:
+        membership.description = data['description']
+    if 'price_monthly' in data:
+        membership.price_monthly = data['price_monthly']
+    if 'price_yearly' in data:
+        membership.price_yearly = data['price_yearly']
+    if 'features' in data:
+        membership.features = json.dumps(data['features'])
+    if 'not_included' in data:
+        membership.not_included = json.dumps(data['not_included'])
+    if 'is_popular' in data:
+        membership.is_popular = data['is_popular']
+    if 'is_active' in data:
+        membership.is_active = data['is_active']
+    
+    db.session.commit()
+    
+    return jsonify({
+        'message': 'Membership updated successfully',
+        'membership': membership.to_dict()
+    }), 200
+
+
+# ============================================
+# TRAINER ROUTES
+# ============================================
+
+@app.route('/api/trainers', methods=['GET'])
+def get_trainers():
+    """Get all active trainers (?sort=ranking for best rated first)"""
+    query = scope_to_branch(Trainer.query.filter_by(is_active=True), Trainer)
+    
+    if request.args.get('sort') == 'ranking':
+        # Served from ix_trainers_active_ranking
+        query = query.order_by(Trainer.ranking_score.desc())
+        limit = request.args.get('limit', type=int)
+        if limit:
+            query = query.limit(min(limit, 100))
+    
+    trainers = query.options(db.joinedload(Trainer.user)).all()
+    return jsonify({'trainers': [t.to_dict() for t in trainers]}), 200
+
+
+@app.route('/api/trainers', methods=['POST'])
+@jwt_required()
+def create_trainer():
+    """Create new trainer (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    data = request.get_json()
+    import json
+    
+    new_trainer = Trainer(
+        user_id=data['user_id'],
+        specialization=json.dumps(data.get('specialization', [])),
+        experience_years=data.get('experience_years', 0),
+        certifications=json.dumps(data.get('certifications', [])),
+        bio=data.get('bio'),
+        available_days=json.dumps(data.get('available_days', [])),
+        branch_id=data.get('branch_id')
+    )
+    
+    db.session.add(new_trainer)
     db.session.commit()
     
     return jsonify({
@@ -803,6 +1746,87 @@ def get_trainer(trainer_id):
     return jsonify({'trainer': trainer.to_dict()}), 200
 
 
+@app.route('/api/trainers/<trainer_id>/reviews', methods=['GET'])
+def get_trainer_reviews(trainer_id):
+    """Get a trainer's reviews, newest first"""
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    offset = request.args.get('offset', 0, type=int)
+    
+    reviews = TrainerReview.query.filter_by(trainer_id=trainer_id) \
+        .options(db.joinedload(TrainerReview.user)) \
+        .order_by(TrainerReview.created_at.desc()).limit(limit).offset(offset).all()
+    
+    return jsonify({'reviews': [r.to_dict() for r in reviews], 'limit': limit, 'offset': offset}), 200
+
+
+def attended_trainer_class(user_id, trainer_id):
+    """True if the user attended a class (live or archived) given by the trainer"""
+    for booking_model, class_model in ((Booking, Class), (ArchivedBooking, ArchivedClass)):
+        attended = db.session.query(booking_model.id) \
+            .join(class_model, booking_model.class_id == class_model.id) \
+            .filter(booking_model.user_id == user_id,
+                    class_model.trainer_id == trainer_id,
+                    db.or_(booking_model.status == 'attended', booking_model.attended == True)) \
+            .first()
+        if attended:
+            return True
+    return False
+
+
+@app.route('/api/trainers/<trainer_id>/reviews', methods=['POST'])
+@jwt_required()
+def create_trainer_review(trainer_id):
+    """Review a trainer (members who attended one of their classes)"""
+    user_id = get_jwt_identity()
+    data = request.get_json()
+    
+    trainer = Trainer.query.get(trainer_id)
+    if not trainer:
+        return jsonify({'error': 'Trainer not found'}), 404
+    
+    rating = data.get('rating')
+    if not isinstance(rating, int) or isinstance(rating, bool) or not 1 <= rating <= 5:
+        return jsonify({'error': 'rating must be a whole number from 1 to 5'}), 400
+    
+    if not attended_trainer_class(user_id, trainer_id):
+        return jsonify({'error': 'You can only review trainers whose classes you attended'}), 403
+    
+    if TrainerReview.query.filter_by(trainer_id=trainer_id, user_id=user_id).first():
+        return jsonify({'error': 'You have already reviewed this trainer'}), 409
+    
+    review = TrainerReview(trainer_id=trainer_id, user_id=user_id, rating=rating, comment=data.get('comment'))
+    db.session.add(review)
+    
+    # Running aggregates, updated in the database so concurrent reviews can't
+    # overwrite each other. Derived columns come first: MySQL evaluates SET
+    # clauses left to right with already-updated values.
+    total_reviews = Trainer.total_reviews + 1
+    rating_sum = Trainer.rating_sum + rating
+    aggregates = Trainer.__table__.update().where(Trainer.id == trainer_id).ordered_values(
+        (Trainer.rating, rating_sum / total_reviews),
+        (Trainer.ranking_score, Trainer.smoothed_rating(rating_sum, total_reviews)),
+        (Trainer.rating_sum, rating_sum),
+        (Trainer.total_reviews, total_reviews)
+    )
+    
+    from sqlalchemy.exc import IntegrityError
+    try:
+        db.session.execute(aggregates)
+        db.session.commit()
+    except IntegrityError:
+        # Same member reviewing twice at once
+        db.session.rollback()
+        return jsonify({'error': 'You have already reviewed this trainer'}), 409
+    
+    db.session.refresh(trainer)
+    
+    return jsonify({
+        'message': 'Review submitted successfully',
+        'review': review.to_dict(),
+        'trainer': trainer.to_dict()
+    }), 201
+
+
 # ============================================
 # PROGRAM ROUTES
 # ============================================
@@ -880,6 +1904,14 @@ def update_program(program_id):
 # CLASS SCHEDULE ROUTES
 # ============================================
 
+def class_details(via=None):
+    """Loader options for what Class.to_dict() reads: a few statements per query
+    instead of a few per class (selectin, so it works across branch databases).
+    `via` loads them for classes reached through a relationship."""
+    load = via.selectinload if via is not None else db.selectinload
+    return (load(Class.program), load(Class.trainer).selectinload(Trainer.user))
+
+
 @app.route('/api/classes', methods=['GET'])
 def get_classes():
     """Get all scheduled classes"""
@@ -890,7 +1922,7 @@ def get_classes():
     trainer_filter = request.args.get('trainer_id')
     program_filter = request.args.get('program_id')
     
-    query = Class.query.filter_by(is_active=True)
+    query = scope_to_branch(Class.query.filter_by(is_active=True), Class)
     
     if date_filter:
         query = query.filter(Class.date == date.fromisoformat(date_filter))
@@ -903,11 +1935,29 @@ def get_classes():
     if program_filter:
         query = query.filter_by(program_id=program_filter)
     
-    classes = query.order_by(Class.date, Class.start_time).all()
+    classes = query.options(*class_details()).order_by(Class.date, Class.start_time).all()
     
     return jsonify({'classes': [c.to_dict() for c in classes]}), 200
 
 
+@app.route('/api/classes/stream', methods=['GET'])
+def stream_class_availability():
+    """Server-Sent Events stream of class capacity changes"""
+    class_ids = request.args.get('class_id')
+    class_ids = set(class_ids.split(',')) if class_ids else None
+    
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    
+    return Response(
+        capacity_feed.stream(class_ids, last_event_id),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
 @app.route('/api/classes', methods=['POST'])
 @jwt_required()
 def create_class():
@@ -922,7 +1972,14 @@ def create_class():
     
     from datetime import datetime, time
     
+    # Classes default to the selected branch, then the trainer's home branch
+    branch_id = data.get('branch_id') or current_branch_id()
+    if not branch_id:
+        trainer = Trainer.query.get(data['trainer_id'])
+        branch_id = trainer.branch_id if trainer else None
+    
     new_class = Class(
+        branch_id=branch_id,
         program_id=data['program_id'],
         trainer_id=data['trainer_id'],
         date=datetime.strptime(data['date'], '%Y-%m-%d').date(),
@@ -937,6 +1994,8 @@ def create_class():
     db.session.add(new_class)
     db.session.commit()
     
+    calendar_feeds.bump(*class_feed_scopes(new_class))
+    
     return jsonify({
         'message': 'Class scheduled successfully',
         'class': new_class.to_dict()
@@ -953,7 +2012,9 @@ def get_bookings():
     """Get user's bookings"""
     user_id = get_jwt_identity()
     
-    bookings = Booking.query.filter_by(user_id=user_id).order_by(Booking.booked_at.desc()).all()
+    query = scope_to_branch(Booking.query.filter_by(user_id=user_id), Booking)
+    bookings = query.options(*class_details(db.selectinload(Booking.class_))) \
+        .order_by(Booking.booked_at.desc()).all()
     
     return jsonify({'bookings': [b.to_dict() for b in bookings]}), 200
 
@@ -971,58 +2032,557 @@ def create_booking():
     if not class_:
         return jsonify({'error': 'Class not found'}), 404
     
-    # Check if class is full
-    if class_.enrolled_count >= class_.max_participants:
-        return jsonify({'error': 'Class is full'}), 400
-    
-    # Check if user already booked
-    existing = Booking.query.filter_by(user_id=user_id, class_id=class_id).first()
-    if existing and existing.status == 'confirmed':
+    # Check if user already booked (checked-in bookings still hold the seat)
+    existing = Booking.query.filter(Booking.user_id == user_id, Booking.class_id == class_id,
+                                    Booking.status.in_(Booking.SEAT_HOLDING_STATUSES)).first()
+    if existing:
         return jsonify({'error': 'Already booked for this class'}), 400
     
+    # Full classes put the member on the waitlist instead of rejecting them
+    if class_.enrolled_count >= class_.max_participants:
+        entry = join_waitlist(class_, user_id)
+        return jsonify({
+            'message': 'Class is full, you have been added to the waitlist',
+            'waitlist': waitlist_status(entry, class_)
+        }), 202
+    
     # Create booking
     new_booking = Booking(
         user_id=user_id,
         class_id=class_id,
+        branch_id=class_.branch_id,
         status='confirmed'
     )
     
     class_.enrolled_count += 1
     
-    db.session.add(new_booking)
-    db.session.commit()
+    # A member who was waiting and books a free seat leaves the waitlist
+    entry = WaitlistEntry.query.filter_by(class_id=class_id, user_id=user_id, status='waiting').first()
+    if entry:
+        entry.status = 'promoted'
+        entry.promoted_at = datetime.utcnow()
+        class_.waitlist_count = Class.waitlist_count - 1
+    
+    db.session.add(new_booking)
+    db.session.commit()
+    
+    capacity_feed.publish(class_)
+    calendar_feeds.bump(feed_scope('member', user_id))
+    
+    return jsonify({
+        'message': 'Class booked successfully',
+        'booking': new_booking.to_dict()
+    }), 201
+
+
+@app.route('/api/bookings/<booking_id>/cancel', methods=['POST'])
+@jwt_required()
+def cancel_booking(booking_id):
+    """Cancel a booking"""
+    user_id = get_jwt_identity()
+    
+    booking = Booking.query.get(booking_id)
+    if not booking:
+        return jsonify({'error': 'Booking not found'}), 404
+    
+    if booking.user_id != user_id:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    if booking.status == 'cancelled':
+        return jsonify({'error': 'Booking already cancelled'}), 400
+    if booking.status != 'confirmed':
+        # Attendance is recorded: the class has started, so there is no seat to free
+        return jsonify({'error': f'Booking is already marked {booking.status}'}), 400
+    
+    booking.status = 'cancelled'
+    booking.cancelled_at = datetime.utcnow()
+    
+    # The freed seat goes to the head of the waitlist in the same transaction
+    promoted = None
+    if booking.class_:
+        promoted = promote_from_waitlist(booking.class_)
+        if not promoted:
+            if booking.class_.enrolled_count <= 0:
+                # Counter drifted; reconcile.py recounts it from the bookings
+                app.logger.warning('enrolled_count already 0 for class %s', booking.class_.id)
+            booking.class_.enrolled_count = max(0, booking.class_.enrolled_count - 1)
+    
+    db.session.commit()
+    
+    checkin_desk.forget(booking.id, booking.class_.date if booking.class_ else None)
+    if booking.class_:
+        capacity_feed.publish(booking.class_)
+    calendar_feeds.bump(feed_scope('member', user_id), promoted and feed_scope('member', promoted.user_id))
+    
+    return jsonify({'message': 'Booking cancelled successfully'}), 200
+
+
+@app.route('/api/classes/<class_id>/waitlist', methods=['GET'])
+@jwt_required()
+def get_waitlist_position(class_id):
+    """Get current user's waitlist position for a class"""
+    user_id = get_jwt_identity()
+    
+    class_ = Class.query.get(class_id)
+    if not class_:
+        return jsonify({'error': 'Class not found'}), 404
+    
+    entry = WaitlistEntry.query.filter_by(class_id=class_id, user_id=user_id).first()
+    if not entry or entry.status == 'left':
+        return jsonify({'error': 'Not on the waitlist'}), 404
+    
+    return jsonify({'waitlist': waitlist_status(entry, class_)}), 200
+
+
+@app.route('/api/classes/<class_id>/waitlist', methods=['DELETE'])
+@jwt_required()
+def leave_waitlist(class_id):
+    """Leave a class waitlist"""
+    user_id = get_jwt_identity()
+    
+    entry = WaitlistEntry.query.filter_by(class_id=class_id, user_id=user_id, status='waiting').first()
+    if not entry:
+        return jsonify({'error': 'Not on the waitlist'}), 404
+    
+    entry.status = 'left'
+    class_ = Class.query.get(class_id)
+    class_.waitlist_count = Class.waitlist_count - 1
+    db.session.commit()
+    
+    return jsonify({'message': 'Left the waitlist'}), 200
+
+
+def join_waitlist(class_, user_id):
+    """Add a member to the end of a class waitlist (idempotent)"""
+    entry = WaitlistEntry.query.filter_by(class_id=class_.id, user_id=user_id).first()
+    if entry and entry.status == 'waiting':
+        return entry
+    
+    # Hand out the next position with an atomic increment of the tail
+    class_.waitlist_tail = Class.waitlist_tail + 1
+    class_.waitlist_count = Class.waitlist_count + 1
+    db.session.flush()
+    
+    if entry:
+        # Re-joining after leaving or a past promotion goes to the back
+        entry.position = class_.waitlist_tail
+        entry.status = 'waiting'
+        entry.created_at = datetime.utcnow()
+        entry.promoted_at = None
+    else:
+        entry = WaitlistEntry(class_id=class_.id, user_id=user_id, position=class_.waitlist_tail)
+        db.session.add(entry)
+    
+    db.session.commit()
+    return entry
+
+
+def promote_from_waitlist(class_):
+    """Give a freed seat to the head of the waitlist (caller commits)"""
+    # Members who meanwhile hold a seat (booked directly) are passed over
+    holds_seat = db.session.query(Booking.id).filter(
+        Booking.class_id == class_.id,
+        Booking.user_id == WaitlistEntry.user_id,
+        Booking.status.in_(Booking.SEAT_HOLDING_STATUSES)
+    ).exists()
+    head = WaitlistEntry.query.filter_by(class_id=class_.id, status='waiting').filter(~holds_seat) \
+        .order_by(WaitlistEntry.position).first()
+    if not head:
+        return None
+    
+    head.status = 'promoted'
+    head.promoted_at = datetime.utcnow()
+    class_.waitlist_count = Class.waitlist_count - 1
+    
+    booking = Booking(user_id=head.user_id, class_id=class_.id, branch_id=class_.branch_id,
+                      status='confirmed')
+    db.session.add(booking)
+    return booking
+
+
+# Historical cancellation rate per program: {program_id: (rate, computed_at)}
+_cancellation_rates = {}
+CANCELLATION_RATE_TTL = timedelta(minutes=10)
+
+
+def cancellation_rate(program_id):
+    """Share of bookings for a program's classes that end up cancelled"""
+    cached = _cancellation_rates.get(program_id)
+    if cached and datetime.utcnow() - cached[1] < CANCELLATION_RATE_TTL:
+        return cached[0]
+    
+    from sqlalchemy import func, case
+    total, cancelled = db.session.query(
+        func.count(Booking.id),
+        func.sum(case((Booking.status == 'cancelled', 1), else_=0))
+    ).join(Class, Booking.class_id == Class.id).filter(Class.program_id == program_id).one()
+    
+    # Smoothed towards one cancellation in ten while history is thin
+    rate = ((cancelled or 0) + 1) / (total + 10)
+    _cancellation_rates[program_id] = (rate, datetime.utcnow())
+    return rate
+
+
+def waitlist_status(entry, class_):
+    """Waitlist entry with position and estimated chance of getting a seat"""
+    from math import comb
+    
+    status = entry.to_dict()
+    if entry.status != 'waiting':
+        return status
+    
+    ahead = entry.people_ahead()
+    status['position'] = ahead + 1
+    status['waitlist_count'] = class_.waitlist_count
+    
+    # P(at least `ahead + 1` of the enrolled members cancel), cancellations
+    # modelled as independent with the program's historical rate
+    p = cancellation_rate(class_.program_id)
+    n = class_.enrolled_count
+    k = ahead + 1
+    chance = sum(comb(n, i) * p ** i * (1 - p) ** (n - i) for i in range(k, n + 1)) if k <= n else 0.0
+    status['promotion_chance'] = round(chance, 3)
+    return status
+
+
+# ============================================
+# CHECK-IN & ATTENDANCE ROUTES
+# ============================================
+
+@checkin_desk.roster_loader
+def load_checkin_roster(day, class_id=None, booking_id=None):
+    """Seat-holding bookings for the day's classes, from every database"""
+    rows = []
+    for _ in each_database():
+        query = db.session.query(
+            Booking.id, Booking.user_id, Booking.class_id, Class.start_time, Class.end_time,
+            Booking.status == 'attended'
+        ).join(Class, Booking.class_id == Class.id).filter(
+            Class.date == day,
+            Class.is_active == True,
+            Booking.status.in_(Booking.SEAT_HOLDING_STATUSES)
+        )
+        if class_id:
+            query = query.filter(Class.id == class_id)
+        if booking_id:
+            query = query.filter(Booking.id == booking_id)
+        rows.extend(tuple(row) for row in query.all())
+    return rows
+
+
+@checkin_desk.attendance_writer
+def write_checkins(checkins):
+    """Mark checked-in bookings attended, one transaction per database"""
+    from sqlalchemy import bindparam
+    
+    bookings = Booking.__table__
+    # A member marked no-show who turns up late still counts as attended
+    # (two comparisons: an expanding IN can't be used with executemany)
+    statement = bookings.update().where(
+        bookings.c.id == bindparam('b_id'),
+        db.or_(bookings.c.status == 'confirmed', bookings.c.status == 'no_show')
+    ).values(status='attended', attended=True, checked_in_at=bindparam('b_checked_in_at'))
+    params = [
+        {'b_id': booking_id, 'b_checked_in_at': datetime.fromisoformat(checked_in_at)}
+        for booking_id, checked_in_at in checkins
+    ]
+    for _ in each_database():
+        db.session.execute(statement, params)
+        db.session.commit()
+
+
+@app.route('/api/checkin', methods=['POST'])
+@jwt_required()
+def check_in():
+    """Check in to a class: {class_id} for yourself, {booking_id} from a member's QR code"""
+    user_id = get_jwt_identity()
+    data = request.get_json(silent=True) or {}
+    
+    if data.get('booking_id'):
+        # Kiosks and staff check in anyone; members only their own bookings
+        user = User.query.get(user_id)
+        owner = None if user.role in ['admin', 'trainer'] else user_id
+        lookup = {'booking_id': data['booking_id'], 'user_id': owner}
+    elif data.get('class_id'):
+        lookup = {'class_id': data['class_id'], 'user_id': user_id}
+    else:
+        return jsonify({'error': 'booking_id or class_id is required'}), 400
+    
+    try:
+        booking_id, class_id, duplicate = checkin_desk.check_in(**lookup)
+    except CheckInError as e:
+        return jsonify({'error': e.message}), e.status
+    
+    if duplicate:
+        return jsonify({'message': 'Already checked in', 'booking_id': booking_id, 'class_id': class_id}), 200
+    
+    # Journaled; written to the database by the check-in flusher
+    return jsonify({'message': 'Checked in', 'booking_id': booking_id, 'class_id': class_id}), 202
+
+
+def can_take_attendance(class_trainer_user_id, user_id):
+    """The class's own trainer, or an admin"""
+    if class_trainer_user_id is not None and class_trainer_user_id == user_id:
+        return True
+    user = User.query.get(user_id)
+    return user is not None and user.role == 'admin'
+
+
+def roster_rows(class_id):
+    """(class dict, attendee dicts) with program title, trainer user and member names"""
+    class_columns = (Class.id, Class.date, Class.start_time, Class.end_time, Class.location,
+                     Class.max_participants, Class.enrolled_count, Class.program_id, Class.trainer_id)
+    booking_columns = (Booking.id.label('booking_id'), Booking.user_id, Booking.status, Booking.checked_in_at)
+    seat_holding = db.and_(Booking.class_id == Class.id, Booking.status.in_(Booking.SEAT_HOLDING_STATUSES))
+    
+    if not db.session().info.get('branch_bind'):
+        # One round trip: class, program, trainer, bookings and members
+        rows = db.session.query(*class_columns, *booking_columns,
+                                Program.title.label('program_title'), Trainer.user_id.label('trainer_user_id'),
+                                User.first_name, User.last_name, User.profile_image) \
+            .select_from(Class) \
+            .outerjoin(Program, Program.id == Class.program_id) \
+            .outerjoin(Trainer, Trainer.id == Class.trainer_id) \
+            .outerjoin(Booking, seat_holding) \
+            .outerjoin(User, User.id == Booking.user_id) \
+            .filter(Class.id == class_id) \
+            .order_by(User.last_name, User.first_name).all()
+        if not rows:
+            return None, []
+        return rows[0]._asdict(), [row._asdict() for row in rows if row.booking_id is not None]
+    
+    # Classes and bookings are in the branch database, the rest in the main one
+    rows = db.session.query(*class_columns, *booking_columns).outerjoin(Booking, seat_holding) \
+        .filter(Class.id == class_id).all()
+    if not rows:
+        return None, []
+    program = Program.query.get(rows[0].program_id)
+    trainer = Trainer.query.get(rows[0].trainer_id)
+    class_row = {**rows[0]._asdict(), 'program_title': program.title if program else None,
+                 'trainer_user_id': trainer.user_id if trainer else None}
+    user_ids = [row.user_id for row in rows if row.booking_id is not None]
+    people = {u.id: u for u in User.query.filter(User.id.in_(user_ids)).all()} if user_ids else {}
+    attendees = []
+    for row in rows:
+        if row.booking_id is None:
+            continue
+        person = people.get(row.user_id)
+        attendees.append({**row._asdict(), 'first_name': person.first_name if person else None,
+                          'last_name': person.last_name if person else None,
+                          'profile_image': person.profile_image if person else None})
+    attendees.sort(key=lambda a: (a['last_name'] or '', a['first_name'] or ''))
+    return class_row, attendees
+
+
+@app.route('/api/classes/<class_id>/roster', methods=['GET'])
+@jwt_required()
+def get_class_roster(class_id):
+    """Get a class with its attendees (class trainer or admin)"""
+    user_id = get_jwt_identity()
+    
+    class_row, attendee_rows = roster_rows(class_id)
+    if class_row is None:
+        return jsonify({'error': 'Class not found'}), 404
+    
+    if not can_take_attendance(class_row['trainer_user_id'], user_id):
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    attendees = []
+    counts = {status: 0 for status in Booking.SEAT_HOLDING_STATUSES}
+    for row in attendee_rows:
+        counts[row['status']] += 1
+        attendees.append({
+            'booking_id': row['booking_id'],
+            'user_id': row['user_id'],
+            'name': f"{row['first_name']} {row['last_name']}" if row['first_name'] else None,
+            'profile_image': image_store.url(row['profile_image'], 'thumb'),
+            'status': row['status'],
+            'checked_in_at': row['checked_in_at'].isoformat() if row['checked_in_at'] else None
+        })
+    
+    return jsonify({
+        'class': {
+            'id': class_row['id'],
+            'program_title': class_row['program_title'],
+            'trainer_id': class_row['trainer_id'],
+            'date': class_row['date'].isoformat(),
+            'start_time': class_row['start_time'].isoformat(),
+            'end_time': class_row['end_time'].isoformat(),
+            'location': class_row['location'],
+            'max_participants': class_row['max_participants'],
+            'enrolled_count': class_row['enrolled_count']
+        },
+        'attendees': attendees,
+        'counts': counts
+    }), 200
+
+
+@app.route('/api/classes/<class_id>/attendance', methods=['POST'])
+@jwt_required()
+def update_class_attendance(class_id):
+    """Mark bookings attended or no-show in bulk (class trainer or admin)"""
+    user_id = get_jwt_identity()
+    data = request.get_json(silent=True) or {}
+    
+    attended = data.get('attended', [])
+    no_show = data.get('no_show', [])
+    if not isinstance(attended, list) or not isinstance(no_show, list) or not (attended or no_show) \
+            or not all(isinstance(booking_id, str) for booking_id in attended + no_show):
+        return jsonify({'error': 'attended and/or no_show must be lists of booking ids'}), 400
+    if set(attended) & set(no_show):
+        return jsonify({'error': 'A booking cannot be both attended and no_show'}), 400
+    
+    class_ = Class.query.get(class_id)
+    if not class_:
+        return jsonify({'error': 'Class not found'}), 404
+    trainer = Trainer.query.get(class_.trainer_id) if class_.trainer_id else None
+    if not can_take_attendance(trainer.user_id if trainer else None, user_id):
+        return jsonify({'error': 'Unauthorized'}), 403
+    if no_show and datetime.now() < datetime.combine(class_.date, class_.start_time):
+        return jsonify({'error': 'Members can only be marked no-show once the class has started'}), 400
+    
+    # One UPDATE per outcome; bookings of other classes or cancelled ones are
+    # left alone by the WHERE clause
+    bookings = Booking.__table__
+    in_class = db.and_(bookings.c.class_id == class_id,
+                       bookings.c.status.in_(Booking.SEAT_HOLDING_STATUSES))
+    updated = {'attended': 0, 'no_show': 0}
+    if attended:
+        updated['attended'] = db.session.execute(
+            bookings.update().where(in_class, bookings.c.id.in_(attended)).values(
+                status='attended', attended=True,
+                checked_in_at=db.func.coalesce(bookings.c.checked_in_at, datetime.utcnow())
+            )
+        ).rowcount
+    if no_show:
+        updated['no_show'] = db.session.execute(
+            bookings.update().where(in_class, bookings.c.id.in_(no_show)).values(
+                status='no_show', attended=False, checked_in_at=None
+            )
+        ).rowcount
+    db.session.commit()
+    
+    if updated['no_show']:
+        # A member marked no-show who checks in late is recorded as attended
+        checkin_desk.mark_no_show(no_show, class_.date)
+    
+    return jsonify({
+        'message': 'Attendance updated',
+        'updated': updated,
+        'unmatched': len(attended) + len(no_show) - updated['attended'] - updated['no_show']
+    }), 200
+
+
+@app.route('/api/admin/checkin', methods=['GET'])
+@jwt_required()
+def get_checkin_status():
+    """Get check-in counters and backlog for this worker (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    return jsonify({'checkin': checkin_desk.status()}), 200
+
+
+@app.route('/api/admin/query-budget', methods=['GET'])
+@jwt_required()
+def get_query_budget_status():
+    """Get statement counts against route budgets for this worker (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    return jsonify({'query_budget': query_budget.status()}), 200
+
+
+@app.route('/api/admin/slow-queries', methods=['GET'])
+@jwt_required()
+def get_slow_queries():
+    """Get this worker's slow statements by fingerprint, with plans (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    sort = request.args.get('sort', 'total_ms')
+    if sort not in SlowQueryLog.SORTS:
+        return jsonify({'error': f'sort must be one of {", ".join(SlowQueryLog.SORTS)}'}), 400
+    limit = min(request.args.get('limit', 20, type=int), 200)
+    
+    return jsonify({'slow_queries': slow_queries.status(limit, sort)}), 200
+
+
+@request_profiler.authorizer
+def may_profile():
+    """Only admins' requests are profiled; others ignore the header"""
+    from flask_jwt_extended import verify_jwt_in_request
+    
+    try:
+        verify_jwt_in_request()
+    except Exception:
+        return False
+    user = User.query.get(get_jwt_identity())
+    return user is not None and user.role == 'admin'
+
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@jwt_required()
+def get_profiles():
+    """List stored request profiles, newest first (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
     
-    return jsonify({
-        'message': 'Class booked successfully',
-        'booking': new_booking.to_dict()
-    }), 201
+    return jsonify({'profiling': request_profiler.status()}), 200
 
 
-@app.route('/api/bookings/<booking_id>/cancel', methods=['POST'])
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
 @jwt_required()
-def cancel_booking(booking_id):
-    """Cancel a booking"""
-    user_id = get_jwt_identity()
+def download_profile(profile_id):
+    """Download a request profile; format=text renders a pstats profile (admin only)"""
+    from flask import send_file
     
-    booking = Booking.query.get(booking_id)
-    if not booking:
-        return jsonify({'error': 'Booking not found'}), 404
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
     
-    if booking.user_id != user_id:
+    if user.role != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    if booking.status == 'cancelled':
-        return jsonify({'error': 'Booking already cancelled'}), 400
+    located = request_profiler.locate(profile_id)
+    if located is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    path, mimetype = located
     
-    booking.status = 'cancelled'
-    booking.cancelled_at = datetime.utcnow()
+    if request.args.get('format') == 'text':
+        if not profile_id.endswith('.pstats'):
+            return jsonify({'error': 'Only cprofile profiles render as text'}), 400
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in ('cumulative', 'tottime', 'calls'):
+            return jsonify({'error': 'sort must be cumulative, tottime or calls'}), 400
+        report = request_profiler.report(profile_id, sort, min(request.args.get('limit', 50, type=int), 500))
+        return Response(report, mimetype='text/plain')
     
-    if booking.class_:
-        booking.class_.enrolled_count = max(0, booking.class_.enrolled_count - 1)
+    return send_file(os.path.abspath(path), mimetype=mimetype, as_attachment=True, download_name=profile_id)
+
+
+@app.route('/api/admin/contact-queue', methods=['GET'])
+@jwt_required()
+def get_contact_queue_status():
+    """Get contact form queue counters and backlog for this worker (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
     
-    db.session.commit()
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
     
-    return jsonify({'message': 'Booking cancelled successfully'}), 200
+    return jsonify({'contact_queue': contact_queue.status()}), 200
 
 
 # ============================================
@@ -1044,6 +2604,25 @@ def get_meal_plans():
     return jsonify({'meal_plans': [m.to_dict() for m in meal_plans]}), 200
 
 
+@app.route('/api/meal-plans/personal', methods=['GET'])
+@jwt_required()
+def get_personal_meal_plan():
+    """Get the current user's generated meal plan"""
+    user = User.query.get(get_jwt_identity())
+    
+    from nutrition import missing_profile_fields, plan_for
+    
+    missing = missing_profile_fields(user)
+    if missing:
+        return jsonify({'error': 'Profile incomplete', 'missing_fields': missing}), 400
+    
+    plan = plan_for(user, app.config['MEAL_PLAN_DAYS'])
+    if not plan:
+        return jsonify({'error': 'No meals available to build a plan'}), 404
+    
+    return jsonify({'meal_plan': plan.to_dict()}), 200
+
+
 @app.route('/api/meal-plans/<meal_plan_id>', methods=['GET'])
 def get_meal_plan(meal_plan_id):
     """Get meal plan by ID"""
@@ -1133,17 +2712,373 @@ def create_progress_log():
     db.session.add(new_log)
     db.session.commit()
     
+    try:
+        leaderboards.record(new_log.user_id, new_log.log_date, new_log.workouts_completed,
+                            new_log.calories_burned, new_log.created_at)
+    except Exception:
+        # The log is saved; the next leaderboard rebuild counts it
+        app.logger.exception('could not add progress log %s to the leaderboards', new_log.id)
+    
     return jsonify({
         'message': 'Progress log created successfully',
         'progress_log': new_log.to_dict()
     }), 201
 
 
+# ============================================
+# CALENDAR FEED ROUTES
+# ============================================
+
+def class_feed_scopes(class_):
+    """Feeds showing a class: its trainer's and those of members booked into it"""
+    member_ids = db.session.query(Booking.user_id).filter(
+        Booking.class_id == class_.id,
+        Booking.status.in_(Booking.SEAT_HOLDING_STATUSES)
+    ).all()
+    return [feed_scope('trainer', class_.trainer_id)] + [feed_scope('member', user_id) for user_id, in member_ids]
+
+
+def calendar_rows(kind, owner_id):
+    """Classes on a member's or trainer's feed, with program, trainer and branch names"""
+    from datetime import date
+    from sqlalchemy.orm import aliased
+    
+    since = date.today() - timedelta(days=app.config['CALENDAR_PAST_DAYS'])
+    columns = [Class.id.label('class_id'), Class.date, Class.start_time, Class.end_time, Class.location,
+               Class.is_virtual, Class.meeting_link, Class.is_active, Class.created_at,
+               Class.program_id, Class.trainer_id, Class.branch_id]
+    if kind == 'member':
+        columns += [Booking.id.label('booking_id'), Booking.booked_at]
+    
+    rows = []
+    for code in each_database():
+        if kind == 'member':
+            query = db.session.query(*columns).select_from(Booking).join(Class, Booking.class_id == Class.id) \
+                .filter(Booking.user_id == owner_id, Booking.status.in_(Booking.SEAT_HOLDING_STATUSES))
+        else:
+            query = db.session.query(*columns).filter(Class.trainer_id == owner_id, Class.is_active == True)
+        query = query.filter(Class.date >= since)
+        
+        if code is None:
+            # One round trip: bookings, classes, programs, trainers and branches
+            trainer_user = aliased(User)
+            query = query.add_columns(Program.title.label('program_title'), Branch.name.label('branch_name'),
+                                      trainer_user.first_name, trainer_user.last_name) \
+                .outerjoin(Program, Program.id == Class.program_id) \
+                .outerjoin(Branch, Branch.id == Class.branch_id) \
+                .outerjoin(Trainer, Trainer.id == Class.trainer_id) \
+                .outerjoin(trainer_user, trainer_user.id == Trainer.user_id)
+            rows.extend(row._asdict() for row in query.all())
+            continue
+        
+        # Classes and bookings are in the branch database, the rest in the main one
+        branch_rows = [row._asdict() for row in query.all()]
+        if not branch_rows:
+            continue
+        with app.app_context():
+            programs = dict(db.session.query(Program.id, Program.title).filter(
+                Program.id.in_({row['program_id'] for row in branch_rows})).all())
+            branches = dict(db.session.query(Branch.id, Branch.name).filter(
+                Branch.id.in_({row['branch_id'] for row in branch_rows})).all())
+            trainers = {trainer_id: (first_name, last_name) for trainer_id, first_name, last_name in
+                        db.session.query(Trainer.id, User.first_name, User.last_name)
+                        .join(User, User.id == Trainer.user_id)
+                        .filter(Trainer.id.in_({row['trainer_id'] for row in branch_rows})).all()}
+        for row in branch_rows:
+            first_name, last_name = trainers.get(row['trainer_id'], (None, None))
+            rows.append({**row, 'program_title': programs.get(row['program_id']),
+                         'branch_name': branches.get(row['branch_id']),
+                         'first_name': first_name, 'last_name': last_name})
+    
+    rows.sort(key=lambda row: (row['date'], row['start_time'], row['class_id']))
+    return rows
+
+
+@calendar_feeds.token_resolver
+def resolve_calendar_token(token_hash):
+    """(kind, owner_id) of an active member's or trainer's feed"""
+    feed = CalendarFeed.query.get(token_hash)
+    if not feed:
+        return None
+    owner = User if feed.kind == 'member' else Trainer
+    active = db.session.query(owner.is_active).filter(owner.id == feed.owner_id).scalar()
+    return (feed.kind, feed.owner_id) if active else None
+
+
+@calendar_feeds.feed_renderer
+def render_calendar_feed(kind, owner_id):
+    """iCalendar text of a member's bookings or a trainer's classes"""
+    from datetime import timezone
+    from zoneinfo import ZoneInfo
+    
+    local = ZoneInfo(app.config['CALENDAR_TIMEZONE'])
+    events = []
+    for row in calendar_rows(kind, owner_id):
+        trainer = f"{row['first_name']} {row['last_name']}" if row['first_name'] else None
+        stamp = row['booked_at'] if kind == 'member' else row['created_at']
+        events.append({
+            'uid': f"{row['booking_id'] if kind == 'member' else row['class_id']}@fitness-revolution",
+            'stamp': (stamp or datetime(2024, 1, 1)).replace(tzinfo=timezone.utc),
+            'start': datetime.combine(row['date'], row['start_time'], tzinfo=local),
+            'end': datetime.combine(row['date'], row['end_time'], tzinfo=local),
+            'summary': row['program_title'] or 'Class',
+            'location': 'Online' if row['is_virtual'] else ', '.join(
+                part for part in (row['location'], row['branch_name']) if part),
+            'description': f'Trainer: {trainer}' if kind == 'member' and trainer else None,
+            'url': row['meeting_link'] if row['is_virtual'] else None,
+            'status': 'CONFIRMED' if row['is_active'] else 'CANCELLED'
+        })
+    name = 'Fitness Revolution - My Classes' if kind == 'member' else 'Fitness Revolution - Teaching Schedule'
+    return render_calendar(name, events)
+
+
+def calendar_feed_response(kind, token):
+    """The feed, or 304 when the client's copy is current"""
+    status, feed = calendar_feeds.feed(kind, token, request.headers.get('If-None-Match'))
+    if status == 404:
+        return jsonify({'error': 'Calendar feed not found'}), 404
+    
+    headers = {'ETag': feed.etag, 'Cache-Control': 'private, no-cache'}
+    if status == 304:
+        return Response(status=304, headers=headers)
+    return Response(feed.body, mimetype='text/calendar', headers=headers)
+
+
+@app.route('/api/calendar/members/<token>.ics', methods=['GET'])
+def get_member_calendar(token):
+    """A member's booked classes as an iCalendar feed (secret URL)"""
+    return calendar_feed_response('member', token)
+
+
+@app.route('/api/calendar/trainers/<token>.ics', methods=['GET'])
+def get_trainer_calendar(token):
+    """A trainer's classes as an iCalendar feed (secret URL)"""
+    return calendar_feed_response('trainer', token)
+
+
+@app.route('/api/calendar/feeds', methods=['POST'])
+@jwt_required()
+def create_calendar_feed():
+    """Create a secret feed URL, replacing any earlier one
+    
+    Members get their bookings; trainers can ask for kind=trainer to get the
+    classes they teach (admins also pass trainer_id).
+    """
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    data = request.get_json(silent=True) or {}
+    
+    kind = data.get('kind', 'member')
+    if kind not in FEED_KINDS:
+        return jsonify({'error': f"kind must be one of: {', '.join(FEED_KINDS)}"}), 400
+    
+    owner_id = user.id
+    if kind == 'trainer':
+        if user.role == 'admin' and data.get('trainer_id'):
+            trainer = Trainer.query.get(data['trainer_id'])
+        else:
+            trainer = Trainer.query.filter_by(user_id=user.id).first()
+        if not trainer:
+            return jsonify({'error': 'Trainer not found'}), 404
+        owner_id = trainer.id
+    
+    token = new_feed_token()
+    CalendarFeed.query.filter_by(kind=kind, owner_id=owner_id).delete()
+    feed = CalendarFeed(token_hash=hash_feed_token(token), kind=kind, owner_id=owner_id)
+    db.session.add(feed)
+    db.session.commit()
+    
+    # Workers drop their cached copy, so the replaced URL stops working
+    calendar_feeds.bump(feed_scope(kind, owner_id))
+    
+    return jsonify({
+        'message': 'Calendar feed created',
+        'feed': {**feed.to_dict(), 'url': request.host_url + f'api/calendar/{kind}s/{token}.ics'}
+    }), 201
+
+
+@app.route('/api/calendar/feeds/<kind>', methods=['DELETE'])
+@jwt_required()
+def delete_calendar_feed(kind):
+    """Revoke the current user's (or their trainer profile's) feed URL"""
+    user_id = get_jwt_identity()
+    
+    owner_id = user_id
+    if kind == 'trainer':
+        trainer = Trainer.query.filter_by(user_id=user_id).first()
+        owner_id = trainer.id if trainer else None
+    
+    deleted = CalendarFeed.query.filter_by(kind=kind, owner_id=owner_id).delete() if owner_id else 0
+    if not deleted:
+        return jsonify({'error': 'Calendar feed not found'}), 404
+    db.session.commit()
+    
+    calendar_feeds.bump(feed_scope(kind, owner_id))
+    
+    return jsonify({'message': 'Calendar feed revoked'}), 200
+
+
+# ============================================
+# LEADERBOARD ROUTES
+# ============================================
+
+LEADERBOARD_MAX_LIMIT = 100
+
+
+@leaderboards.totals_loader
+def load_leaderboard_totals(periods, created_before):
+    """Workouts and calories per member for each (since, until) log_date range"""
+    columns = []
+    for since, until in periods:
+        conditions = []
+        if since:
+            conditions.append(ProgressLog.log_date >= since)
+        if until:
+            conditions.append(ProgressLog.log_date < until)
+        for value in (ProgressLog.workouts_completed, ProgressLog.calories_burned):
+            columns.append(db.func.sum(db.case((db.and_(*conditions), value)) if conditions else value))
+    
+    return db.session.query(ProgressLog.user_id, *columns) \
+        .filter(ProgressLog.created_at < created_before) \
+        .group_by(ProgressLog.user_id).all()
+
+
+def leaderboard_args(metric):
+    """(period, error response) from the query string"""
+    if metric not in LEADERBOARD_METRICS:
+        return None, (jsonify({'error': f"metric must be one of: {', '.join(LEADERBOARD_METRICS)}"}), 404)
+    period = request.args.get('period', 'week')
+    if period not in LEADERBOARD_PERIODS:
+        return None, (jsonify({'error': f"period must be one of: {', '.join(LEADERBOARD_PERIODS)}"}), 400)
+    return period, None
+
+
+@app.route('/api/leaderboards/<metric>', methods=['GET'])
+def get_leaderboard(metric):
+    """Top members by workouts or calories for the current week, month or all time"""
+    period, error = leaderboard_args(metric)
+    if error:
+        return error
+    limit = min(max(request.args.get('limit', 10, type=int), 1), LEADERBOARD_MAX_LIMIT)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    
+    key, total, entries = leaderboards.top(metric, period, limit, offset)
+    names = {}
+    if entries:
+        users = db.session.query(User.id, User.first_name, User.last_name) \
+            .filter(User.id.in_([user_id for _, user_id, _ in entries])).all()
+        names = {user_id: f"{first_name} {last_name}" for user_id, first_name, last_name in users}
+    
+    return jsonify({
+        'metric': metric,
+        'period': period,
+        'period_key': key,
+        'total': total,
+        'entries': [
+            {'rank': rank, 'user_id': user_id, 'name': names.get(user_id), 'score': score}
+            for rank, user_id, score in entries
+        ]
+    }), 200
+
+
+@app.route('/api/leaderboards/<metric>/me', methods=['GET'])
+@jwt_required()
+def get_my_leaderboard_rank(metric):
+    """Rank and score of the current user"""
+    period, error = leaderboard_args(metric)
+    if error:
+        return error
+    
+    key, total, rank, score = leaderboards.rank(metric, period, get_jwt_identity())
+    
+    return jsonify({
+        'metric': metric,
+        'period': period,
+        'period_key': key,
+        'total': total,
+        'rank': rank,
+        'score': score
+    }), 200
+
+
+@app.route('/api/admin/leaderboards/rebuild', methods=['POST'])
+@jwt_required()
+def rebuild_leaderboards():
+    """Rebuild this worker's leaderboards from progress logs (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    report = leaderboards.rebuild()
+    
+    return jsonify({'message': 'Leaderboards rebuilt', 'report': report, 'status': leaderboards.status()}), 200
+
+
+# ============================================
+# RECOMMENDATION ROUTES
+# ============================================
+
+# Active programs as dicts, refreshed every minute: {program_id: dict}
+_program_directory = {'loaded_at': None, 'programs': {}}
+PROGRAM_DIRECTORY_TTL = timedelta(minutes=1)
+
+
+def active_programs():
+    """Active programs by id from a short-lived cache"""
+    loaded_at = _program_directory['loaded_at']
+    if loaded_at is None or datetime.utcnow() - loaded_at > PROGRAM_DIRECTORY_TTL:
+        programs = Program.query.filter_by(is_active=True).all()
+        _program_directory['programs'] = {p.id: p.to_dict() for p in programs}
+        _program_directory['loaded_at'] = datetime.utcnow()
+    return _program_directory['programs']
+
+
+@app.route('/api/recommendations', methods=['GET'])
+@jwt_required()
+def get_recommendations():
+    """Get recommended programs (and upcoming classes) for the current user"""
+    user_id = get_jwt_identity()
+    programs = active_programs()
+    
+    recommendation = Recommendation.query.get(user_id)
+    if recommendation:
+        stored = recommendation.to_dict()
+        picks, class_ids, generated_at = stored['programs'], stored['class_ids'], stored['generated_at']
+    else:
+        # Not scored yet (e.g. joined since the last refresh)
+        from recommendations import fallback_recommendations
+        user = User.query.get(user_id)
+        picks = fallback_recommendations(user, list(programs.values()), app.config['RECOMMENDATIONS_TOP_K'])
+        class_ids, generated_at = [], None
+    
+    result = {
+        'recommendations': [
+            {**pick, 'program': programs[pick['program_id']]}
+            for pick in picks if pick['program_id'] in programs
+        ],
+        'generated_at': generated_at
+    }
+    
+    if request.args.get('include_classes', 'false').lower() == 'true':
+        by_id = {}
+        # Picks can be classes of any branch database
+        for _ in each_database() if class_ids else ():
+            classes = Class.query.options(*class_details()) \
+                .filter(Class.id.in_(class_ids), Class.is_active == True).all()
+            by_id.update((c.id, c.to_dict()) for c in classes)
+        result['classes'] = [by_id[c] for c in class_ids if c in by_id]
+    
+    return jsonify(result), 200
+
+
 # ============================================
 # CONTACT ROUTES
 # ============================================
 
 @app.route('/api/contact', methods=['POST'])
+@limiter.limit(account=email_from_json)
 def submit_contact():
     """Submit contact form"""
     data = request.get_json()
@@ -1153,33 +3088,91 @@ def submit_contact():
         if not data.get(field):
             return jsonify({'error': f'{field} is required'}), 400
     
-    new_message = ContactMessage(
-        name=data['name'],
-        email=data['email'],
-        phone=data.get('phone'),
-        subject=data.get('subject'),
-        message=data['message']
-    )
-    
-    db.session.add(new_message)
+    # Journaled and written by the contact flusher; duplicates get the same answer
+    contact_queue.submit(data)
+    
+    return jsonify({'message': 'Message sent successfully'}), 202
+
+
+UNREAD_MESSAGES = 'unread_contact_messages'
+
+
+def adjust_counter(name, delta):
+    """Add `delta` to a counter in the current transaction"""
+    if delta:
+        counters = Counter.__table__
+        db.session.execute(counters.update().where(counters.c.name == name)
+                           .values(value=counters.c.value + delta))
+
+
+def unread_message_count():
+    """Unread contact messages, from the counter (seeded by one count if missing)"""
+    counter = db.session.get(Counter, UNREAD_MESSAGES)
+    if counter is None:
+        from sqlalchemy.exc import IntegrityError
+        
+        value = ContactMessage.query.filter_by(is_read=False).count()
+        db.session.add(Counter(name=UNREAD_MESSAGES, value=value))
+        try:
+            db.session.commit()
+            return value
+        except IntegrityError:
+            # Another worker seeded it first
+            db.session.rollback()
+            counter = db.session.get(Counter, UNREAD_MESSAGES)
+    return counter.value
+
+
+@contact_queue.message_writer
+def write_contact_messages(messages, since):
+    """Insert queued messages not stored yet and count them unread, in one transaction"""
+    from sqlalchemy import and_, or_
+    
+    unread_message_count()
+    stored = db.session.query(ContactMessage.id, ContactMessage.content_hash).filter(or_(
+        ContactMessage.id.in_([m['id'] for m in messages]),
+        and_(ContactMessage.content_hash.in_({m['content_hash'] for m in messages}),
+             ContactMessage.created_at >= since)
+    )).all()
+    seen_ids = {row.id for row in stored}
+    seen_hashes = {row.content_hash for row in stored}
+    
+    rows = []
+    for m in messages:
+        if m['id'] in seen_ids or m['content_hash'] in seen_hashes:
+            continue
+        seen_hashes.add(m['content_hash'])
+        rows.append({**m, 'is_read': False, 'created_at': datetime.fromisoformat(m['created_at'])})
+    if rows:
+        db.session.execute(ContactMessage.__table__.insert(), rows)
+        adjust_counter(UNREAD_MESSAGES, len(rows))
     db.session.commit()
-    
-    return jsonify({'message': 'Message sent successfully'}), 201
+    return len(rows)
 
 
 @app.route('/api/contact', methods=['GET'])
 @jwt_required()
 def get_contact_messages():
-    """Get all contact messages (admin only)"""
+    """Get contact messages, newest first (admin only)"""
     user_id = get_jwt_identity()
     user = User.query.get(user_id)
     
     if user.role != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    messages = ContactMessage.query.order_by(ContactMessage.created_at.desc()).all()
+    query = ContactMessage.query
+    if request.args.get('unread') == 'true':
+        query = query.filter_by(is_read=False)
+    query = query.order_by(ContactMessage.created_at.desc())
+    if request.args.get('limit'):
+        query = query.offset(request.args.get('offset', 0, type=int)) \
+            .limit(min(request.args.get('limit', type=int), 500))
+    messages = query.all()
     
-    return jsonify({'messages': [m.to_dict() for m in messages]}), 200
+    return jsonify({
+        'messages': [m.to_dict() for m in messages],
+        'unread_count': unread_message_count()
+    }), 200
 
 
 @app.route('/api/contact/<message_id>/read', methods=['POST'])
@@ -1192,13 +3185,17 @@ def mark_message_read(message_id):
     if user.role != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    message = ContactMessage.query.get(message_id)
-    if not message:
+    messages = ContactMessage.__table__
+    # Only the request that flips is_read decrements the counter
+    result = db.session.execute(messages.update().where(
+        messages.c.id == message_id, messages.c.is_read == False
+    ).values(is_read=True))
+    if result.rowcount:
+        adjust_counter(UNREAD_MESSAGES, -1)
+        db.session.commit()
+    elif not ContactMessage.query.get(message_id):
         return jsonify({'error': 'Message not found'}), 404
     
-    message.is_read = True
-    db.session.commit()
-    
     return jsonify({'message': 'Message marked as read'}), 200
 
 
@@ -1216,17 +3213,21 @@ def admin_dashboard():
     if user.role != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
     
+    # Unread messages (first, as seeding the counter commits and would
+    # expire the rows loaded below)
+    unread_messages = unread_message_count()
+    
     # Statistics
     total_users = User.query.count()
     active_members = User.query.filter_by(is_active=True).count()
-    total_trainers = Trainer.query.filter_by(is_active=True).count()
-    total_bookings = Booking.query.filter_by(status='confirmed').count()
+    # Trainer and booking figures are for the selected branch, if any
+    total_trainers = scope_to_branch(Trainer.query.filter_by(is_active=True), Trainer).count()
+    total_bookings = scope_to_branch(Booking.query.filter_by(status='confirmed'), Booking).count()
     
     # Recent bookings
-    recent_bookings = Booking.query.order_by(Booking.booked_at.desc()).limit(10).all()
-    
-    # Unread messages
-    unread_messages = ContactMessage.query.filter_by(is_read=False).count()
+    recent_bookings = scope_to_branch(Booking.query, Booking) \
+        .options(*class_details(db.selectinload(Booking.class_))) \
+        .order_by(Booking.booked_at.desc()).limit(10).all()
     
     return jsonify({
         'stats': {
@@ -1236,10 +3237,372 @@ def admin_dashboard():
             'total_bookings': total_bookings,
             'unread_messages': unread_messages
         },
+        'branch_id': current_branch_id(),
         'recent_bookings': [b.to_dict() for b in recent_bookings]
     }), 200
 
 
+@app.route('/api/admin/reconcile', methods=['GET'])
+@jwt_required()
+def get_reconcile_metrics():
+    """Get enrolled_count reconciliation metrics (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    from reconcile import run_metrics
+    
+    return jsonify({'metrics': run_metrics()}), 200
+
+
+@app.route('/api/admin/reconcile', methods=['POST'])
+@jwt_required()
+def run_reconcile():
+    """Recount enrolled_count for a date range (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    from datetime import date
+    from reconcile import reconcile_enrolled_counts, upcoming_window
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        window_days = int(data.get('window_days', 14))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'window_days must be a number of days'}), 400
+    if window_days < 0:
+        return jsonify({'error': 'window_days must be at least 0'}), 400
+    start, end = upcoming_window(window_days)
+    try:
+        if data.get('start'):
+            start = date.fromisoformat(data['start'])
+        if data.get('end'):
+            end = date.fromisoformat(data['end'])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+    if start > end:
+        return jsonify({'error': 'start must not be after end'}), 400
+    
+    report = reconcile_enrolled_counts(start, end, repair=not data.get('dry_run', False))
+    
+    return jsonify({'report': report}), 200
+
+
+@app.route('/api/admin/recommendations/refresh', methods=['POST'])
+@jwt_required()
+def run_recommendations_refresh():
+    """Recompute every member's recommendations (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    from recommendations import refresh_recommendations
+    
+    data = request.get_json(silent=True) or {}
+    report = refresh_recommendations(data.get('top_k', app.config['RECOMMENDATIONS_TOP_K']),
+                                     dry_run=data.get('dry_run', False))
+    
+    return jsonify({'report': report}), 200
+
+
+@app.route('/api/admin/meal-plans/refresh', methods=['POST'])
+@jwt_required()
+def run_meal_plans_refresh():
+    """Regenerate every member's personal meal plan (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    from nutrition import refresh_meal_plans
+    
+    data = request.get_json(silent=True) or {}
+    report = refresh_meal_plans(data.get('days', app.config['MEAL_PLAN_DAYS']),
+                                dry_run=data.get('dry_run', False))
+    
+    return jsonify({'report': report}), 200
+
+
+@app.route('/api/admin/forecasts/occupancy', methods=['GET'])
+@jwt_required()
+def get_occupancy_forecasts():
+    """Get predicted occupancy and suggested capacity of upcoming classes (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    from datetime import date
+    
+    query = scope_to_branch(OccupancyForecast.query, OccupancyForecast)
+    if request.args.get('program_id'):
+        query = query.filter(OccupancyForecast.program_id == request.args['program_id'])
+    try:
+        if request.args.get('start'):
+            query = query.filter(OccupancyForecast.class_date >= date.fromisoformat(request.args['start']))
+        if request.args.get('end'):
+            query = query.filter(OccupancyForecast.class_date <= date.fromisoformat(request.args['end']))
+    except ValueError:
+        return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+    if request.args.get('over_capacity', '').lower() == 'true':
+        # Classes expected to turn members away
+        query = query.filter(OccupancyForecast.suggested_capacity > OccupancyForecast.max_participants)
+    
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    offset = request.args.get('offset', 0, type=int)
+    forecasts = query.order_by(OccupancyForecast.class_date, OccupancyForecast.start_time) \
+        .limit(limit).offset(offset).all()
+    
+    return jsonify({
+        'forecasts': [f.to_dict() for f in forecasts],
+        'limit': limit,
+        'offset': offset
+    }), 200
+
+
+@app.route('/api/admin/forecasts/refresh', methods=['POST'])
+@jwt_required()
+def run_forecasts_refresh():
+    """Refit the occupancy model and forecast upcoming classes (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    from forecasting import refresh_forecasts
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        history_days = int(data.get('history_days', app.config['FORECAST_HISTORY_DAYS']))
+        horizon_days = int(data.get('horizon_days', app.config['FORECAST_HORIZON_DAYS']))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'history_days and horizon_days must be numbers of days'}), 400
+    if history_days < 1 or horizon_days < 1:
+        return jsonify({'error': 'history_days and horizon_days must be at least 1'}), 400
+    
+    report = refresh_forecasts(history_days, horizon_days, dry_run=data.get('dry_run', False))
+    
+    return jsonify({'report': report}), 200
+
+
+@app.route('/api/admin/reports/revenue', methods=['GET'])
+@jwt_required()
+def get_revenue_report():
+    """MRR, plan mix, churn and upgrades over time from daily snapshots (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    from datetime import date
+    from revenue import revenue_report
+    
+    interval = request.args.get('interval', 'day')
+    if interval not in ('day', 'week', 'month'):
+        return jsonify({'error': 'interval must be day, week or month'}), 400
+    try:
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else date.today()
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else \
+            end - timedelta(days=app.config['REVENUE_REPORT_DAYS'] - 1)
+    except ValueError:
+        return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+    
+    return jsonify({
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'interval': interval,
+        'periods': revenue_report(start, end, interval)
+    }), 200
+
+
+@app.route('/api/admin/reports/revenue/snapshot', methods=['POST'])
+@jwt_required()
+def run_revenue_snapshot():
+    """Take today's revenue snapshot, or backfill the last `days` (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    from datetime import date
+    from revenue import backfill, take_snapshot
+    
+    data = request.get_json(silent=True) or {}
+    if data.get('days') is not None:
+        try:
+            days = int(data['days'])
+        except (TypeError, ValueError):
+            return jsonify({'error': 'days must be a number of days'}), 400
+        if days < 1:
+            return jsonify({'error': 'days must be at least 1'}), 400
+        report = backfill(days, dry_run=data.get('dry_run', False))
+    else:
+        try:
+            day = date.fromisoformat(data['date']) if data.get('date') else date.today()
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+        report = [take_snapshot(day, dry_run=data.get('dry_run', False))]
+    
+    return jsonify({'report': report}), 200
+
+
+@app.route('/api/admin/archive', methods=['POST'])
+@jwt_required()
+def run_archive():
+    """Move past classes and their bookings to the archive (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    from datetime import date
+    from archive import archive_before, archive_cutoff
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        days = int(data['days']) if data.get('days') is not None else None
+        batch_size = int(data.get('batch_size', 500))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'days and batch_size must be numbers'}), 400
+    if (days is not None and days < 0) or batch_size < 1:
+        return jsonify({'error': 'days must be at least 0 and batch_size at least 1'}), 400
+    try:
+        cutoff = date.fromisoformat(data['before']) if data.get('before') else archive_cutoff(days)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+    
+    report = archive_before(cutoff, batch_size=batch_size, dry_run=data.get('dry_run', False))
+    
+    return jsonify({'report': report}), 200
+
+
+def history_query(live, archived, columns, filters, order_by):
+    """UNION ALL of a live table and its archive table over `columns`"""
+    def part(table, is_archived):
+        return db.select(
+            *[table.c[name] for name in columns],
+            db.literal(is_archived).label('archived')
+        ).where(*[f(table) for f in filters])
+    
+    union = db.union_all(part(live, False), part(archived, True)).subquery()
+    return db.select(union).order_by(*[union.c[name].desc() for name in order_by])
+
+
+def history_page(query, model):
+    """Run a history query with ?limit=&offset= and serialize the rows"""
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    offset = request.args.get('offset', 0, type=int)
+    # Bound like `model` so branch databases are used
+    rows = db.session.execute(query.limit(limit).offset(offset),
+                              bind_arguments={'mapper': model}).mappings()
+    return [
+        {key: value.isoformat() if hasattr(value, 'isoformat') else value for key, value in row.items()}
+        for row in rows
+    ], limit, offset
+
+
+@app.route('/api/admin/history/bookings', methods=['GET'])
+@jwt_required()
+def get_booking_history():
+    """Get live and archived bookings (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    filters = []
+    for param in ('user_id', 'class_id', 'status'):
+        if request.args.get(param):
+            value = request.args[param]
+            filters.append(lambda t, param=param, value=value: t.c[param] == value)
+    if current_branch_id():
+        branch_id = current_branch_id()
+        filters.append(lambda t: t.c.branch_id == branch_id)
+    
+    query = history_query(
+        Booking.__table__, ArchivedBooking.__table__,
+        ['id', 'user_id', 'class_id', 'branch_id', 'status', 'booked_at', 'cancelled_at', 'attended',
+         'checked_in_at'],
+        filters, order_by=['booked_at', 'id']
+    )
+    bookings, limit, offset = history_page(query, Booking)
+    
+    return jsonify({'bookings': bookings, 'limit': limit, 'offset': offset}), 200
+
+
+@app.route('/api/admin/history/classes', methods=['GET'])
+@jwt_required()
+def get_class_history():
+    """Get live and archived classes (admin only)"""
+    user_id = get_jwt_identity()
+    user = User.query.get(user_id)
+    
+    if user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    from datetime import date
+    
+    filters = []
+    for param in ('trainer_id', 'program_id'):
+        if request.args.get(param):
+            value = request.args[param]
+            filters.append(lambda t, param=param, value=value: t.c[param] == value)
+    try:
+        if request.args.get('start'):
+            start = date.fromisoformat(request.args['start'])
+            filters.append(lambda t: t.c.date >= start)
+        if request.args.get('end'):
+            end = date.fromisoformat(request.args['end'])
+            filters.append(lambda t: t.c.date <= end)
+    except ValueError:
+        return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+    if current_branch_id():
+        branch_id = current_branch_id()
+        filters.append(lambda t: t.c.branch_id == branch_id)
+    
+    query = history_query(
+        Class.__table__, ArchivedClass.__table__,
+        ['id', 'branch_id', 'program_id', 'trainer_id', 'date', 'start_time', 'end_time',
+         'location', 'max_participants', 'enrolled_count', 'is_active'],
+        filters, order_by=['date', 'start_time', 'id']
+    )
+    classes, limit, offset = history_page(query, Class)
+    
+    return jsonify({'classes': classes, 'limit': limit, 'offset': offset}), 200
+
+
+# ============================================
+# BATCH ROUTES
+# ============================================
+
+@app.route('/api/batch', methods=['POST'])
+def batch_requests():
+    """Run several GET requests in one round trip"""
+    try:
+        sub_requests, parallel = parse_batch(request.get_json(silent=True),
+                                             app.config['BATCH_MAX_REQUESTS'])
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    responses = batch_executor.run(sub_requests, parallel=parallel)
+    
+    return jsonify({'responses': responses}), 200
+
+
 # ============================================
 # ERROR HANDLERS
 # ============================================
@@ -1266,6 +3629,7 @@ def init_db():
     
     # Create tables
     db.create_all()
+    create_branch_tables()
     
     # Check if data already exists
     if Membership.query.first():
@@ -1338,6 +3702,14 @@ def init_db():
     for m in memberships:
         db.session.add(m)
     
+    # Create the first branch
+    main_branch = Branch(
+        code='main',
+        name='The Fitness Revolution - Main',
+        city='Bengaluru'
+    )
+    db.session.add(main_branch)
+    
     # Create programs
     programs = [
         Program(
@@ -1497,7 +3869,8 @@ def init_db():
             experience_years=10,
             certifications=json.dumps(['ACE Certified', 'NSCA-CPT']),
             bio='Expert strength coach with 10+ years of experience in powerlifting and bodybuilding.',
-            available_days=json.dumps(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday'])
+            available_days=json.dumps(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']),
+            branch_id=main_branch.id
         ),
         Trainer(
             user_id=trainer_users[1].id,
@@ -1505,7 +3878,8 @@ def init_db():
             experience_years=8,
             certifications=json.dumps(['ACE Certified', 'CrossFit L2']),
             bio='HIIT specialist helping clients achieve their weight loss goals through high-intensity workouts.',
-            available_days=json.dumps(['Monday', 'Wednesday', 'Friday', 'Saturday'])
+            available_days=json.dumps(['Monday', 'Wednesday', 'Friday', 'Saturday']),
+            branch_id=main_branch.id
         ),
         Trainer(
             user_id=trainer_users[2].id,
@@ -1513,7 +3887,8 @@ def init_db():
             experience_years=15,
             certifications=json.dumps(['RYT-500', 'Yoga Alliance']),
             bio='Yoga master with 15 years of practice in Hatha and Vinyasa yoga.',
-            available_days=json.dumps(['Tuesday', 'Thursday', 'Saturday', 'Sunday'])
+            available_days=json.dumps(['Tuesday', 'Thursday', 'Saturday', 'Sunday']),
+            branch_id=main_branch.id
         )
     ]
     
@@ -1526,6 +3901,7 @@ def init_db():
         'message': 'Database initialized successfully with sample data',
         'data': {
             'memberships': len(memberships),
+            'branches': 1,
             'programs': len(programs),
             'meal_plans': len(meal_plans),
             'trainers': len(trainers),
@@ -1535,6 +3911,101 @@ def init_db():
     }), 201
 
 
+# ============================================
+# QUERY BUDGETS
+# ============================================
+
+# Most SQL statements one request to each route may run on one database
+# (see querybudget.py). Set from measured counts with a little headroom; a
+# budget that a route outgrows as its result grows is an N+1 to fix, not a
+# number to raise. None: admin-triggered jobs whose work scales with the data.
+app.config['QUERY_BUDGETS'] = {
+    'index': 0,
+    'api_docs': 0,
+    'get_media': 0,
+    # Auth and users
+    'register': 4,
+    'login': 2,
+    'logout': 1,
+    'change_password': 4,
+    'get_current_user': 2,
+    'get_users': 3,
+    'get_user': 3,
+    'update_user': 7,
+    'delete_user': 6,
+    'upload_profile_image': 5,
+    'delete_profile_image': 5,
+    'assign_membership': 9,
+    'cancel_membership': 8,
+    # Branches, memberships, trainers, programs
+    'get_branches': 2,
+    'create_branch': 5,
+    'get_memberships': 2,
+    'create_membership': 4,
+    'update_membership': 5,
+    'get_trainers': 3,
+    'get_trainer': 3,
+    'create_trainer': 5,
+    'get_trainer_reviews': 2,
+    'create_trainer_review': 10,
+    'get_programs': 2,
+    'create_program': 4,
+    'update_program': 5,
+    # Classes, bookings, check-in
+    'get_classes': 6,
+    'create_class': 9,
+    'get_bookings': 6,
+    'create_booking': 12,
+    'cancel_booking': 11,
+    'get_booking_history': 3,
+    'get_waitlist_position': 4,
+    'leave_waitlist': 5,
+    'stream_class_availability': 1,
+    'check_in': 3,
+    'get_checkin_status': 2,
+    'get_class_roster': 3,
+    'update_class_attendance': 5,
+    'get_class_history': 4,
+    'get_occupancy_forecasts': 3,
+    # Meal plans, progress, calendars, leaderboards, recommendations
+    'get_meal_plans': 2,
+    'get_meal_plan': 2,
+    'create_meal_plan': 4,
+    'get_personal_meal_plan': 3,
+    'get_progress_logs': 3,
+    'create_progress_log': 4,
+    'create_calendar_feed': 5,
+    'delete_calendar_feed': 4,
+    'get_member_calendar': 4,
+    'get_trainer_calendar': 4,
+    'get_leaderboard': 2,
+    'get_my_leaderboard_rank': 1,
+    'get_recommendations': 6,
+    # Contact and admin
+    'submit_contact': 1,
+    'get_contact_messages': 7,
+    'mark_message_read': 4,
+    'admin_dashboard': 14,
+    'get_reconcile_metrics': 3,
+    'get_revenue_report': 3,
+    'get_contact_queue_status': 2,
+    'get_query_budget_status': 2,
+    'get_slow_queries': 2,
+    'get_profiles': 2,
+    'download_profile': 2,
+    # Batches run each sub-request against its own route's budget
+    'batch_requests': 1,
+    'init_db': None,
+    'run_archive': None,
+    'run_reconcile': None,
+    'run_revenue_snapshot': None,
+    'run_forecasts_refresh': None,
+    'run_meal_plans_refresh': None,
+    'run_recommendations_refresh': None,
+    'rebuild_leaderboards': None
+}
+
+
 # ============================================
 # MAIN
 # ============================================
@@ -1542,5 +4013,6 @@ def init_db():
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        create_branch_tables()
     
     app.run(debug=True, host='0.0.0.0', port=5000)
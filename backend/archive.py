@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+The Fitness Revolution - archival of past classes and their bookings
+
+Classes dated before the archive horizon (ARCHIVE_AFTER_DAYS) are moved with
+their bookings into archived_classes / archived_bookings, and their waitlist
+entries are dropped. This keeps `classes` and `bookings`, and their indexes,
+down to the recent rows the schedule and booking routes actually touch.
+
+Work is done in chunks of classes, each moved in one transaction: the rows are
+copied with INSERT ... SELECT and deleted from the live tables. A chunk either
+moves completely or not at all, and the next run picks up whatever is still
+older than the horizon, so an interrupted run can simply be started again.
+
+Usage:
+    python archive.py                          # horizon from ARCHIVE_AFTER_DAYS
+    python archive.py --before 2023-01-01 --batch-size 200
+    python archive.py --branch blr-indiranagar # a branch with its own database
+    python archive.py --dry-run
+"""
+
+import argparse
+import json
+import logging
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import literal, select, text
+
+from app import app, db, Class, Booking, WaitlistEntry, ArchivedClass, ArchivedBooking
+
+logger = logging.getLogger('archive')
+
+
+def archive_cutoff(days=None):
+    """Classes dated before this day are archived"""
+    if days is None:
+        days = app.config['ARCHIVE_AFTER_DAYS']
+    return date.today() - timedelta(days=days)
+
+
+def _copy_rows(source, target, where, archived_at):
+    """INSERT INTO target SELECT <shared columns> FROM source WHERE ..."""
+    columns = [column.name for column in source.columns]
+    query = select(*[source.c[name] for name in columns], literal(archived_at)).where(where)
+    return target.insert().from_select(columns + ['archived_at'], query)
+
+
+def archive_chunk(class_ids):
+    """Move `class_ids` and their bookings to the archive in one transaction
+
+    Returns (classes_moved, bookings_moved).
+    """
+    classes, bookings = Class.__table__, Booking.__table__
+    now = datetime.utcnow()
+    try:
+        moved = db.session.execute(_copy_rows(
+            bookings, ArchivedBooking.__table__, bookings.c.class_id.in_(class_ids), now
+        )).rowcount
+        db.session.execute(bookings.delete().where(bookings.c.class_id.in_(class_ids)))
+        db.session.execute(WaitlistEntry.__table__.delete().where(
+            WaitlistEntry.__table__.c.class_id.in_(class_ids)
+        ))
+        db.session.execute(_copy_rows(
+            classes, ArchivedClass.__table__, classes.c.id.in_(class_ids), now
+        ))
+        db.session.execute(classes.delete().where(classes.c.id.in_(class_ids)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(class_ids), moved
+
+
+def archive_before(cutoff, batch_size=500, pause=0.0, dry_run=False):
+    """Archive every class dated before `cutoff`; returns a report dict"""
+    started = time.perf_counter()
+    report = {
+        'cutoff': cutoff.isoformat(),
+        'classes_archived': 0,
+        'bookings_archived': 0,
+        'chunks': 0,
+        'dry_run': dry_run
+    }
+
+    if dry_run:
+        report['classes_archived'] = Class.query.filter(Class.date < cutoff).count()
+        report['bookings_archived'] = Booking.query.join(Class, Booking.class_id == Class.id) \
+            .filter(Class.date < cutoff).count()
+    else:
+        while True:
+            # Oldest first, via the (date, start_time) index
+            class_ids = [row[0] for row in db.session.query(Class.id)
+                         .filter(Class.date < cutoff)
+                         .order_by(Class.date, Class.start_time, Class.id)
+                         .limit(batch_size).all()]
+            if not class_ids:
+                break
+            classes_moved, bookings_moved = archive_chunk(class_ids)
+            report['classes_archived'] += classes_moved
+            report['bookings_archived'] += bookings_moved
+            report['chunks'] += 1
+            logger.info('archived %s classes, %s bookings', classes_moved, bookings_moved)
+            if pause:
+                time.sleep(pause)
+
+        if report['chunks']:
+            # Refresh planner statistics for the shrunken live tables
+            engine = db.session.get_bind(mapper=Class)
+            if engine.dialect.name in ('sqlite', 'postgresql'):
+                with engine.begin() as conn:
+                    conn.execute(text('ANALYZE classes'))
+                    conn.execute(text('ANALYZE bookings'))
+
+    report['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move past classes and their bookings to archive tables')
+    parser.add_argument('--before', type=date.fromisoformat, help='Archive classes dated before (YYYY-MM-DD)')
+    parser.add_argument('--days', type=int, help='Archive classes older than this many days')
+    parser.add_argument('--batch-size', type=int, default=500, help='Classes moved per transaction')
+    parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between chunks')
+    parser.add_argument('--branch', help='Branch code, for a branch with its own database')
+    parser.add_argument('--dry-run', action='store_true', help='Count what would be archived')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    with app.app_context():
+        if args.branch and not db.session().use_branch(args.branch):
+            parser.error(f'No database configured for branch {args.branch!r}')
+        cutoff = args.before or archive_cutoff(args.days)
+        report = archive_before(cutoff, args.batch_size, args.pause, args.dry_run)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
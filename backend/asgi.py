@@ -0,0 +1,257 @@
+"""
+The Fitness Revolution - ASGI entry point for public read endpoints
+
+Serves the read-heavy public catalog endpoints with an async SQLAlchemy engine,
+so one process can hold thousands of keep-alive clients without tying up a
+worker per connection:
+
+    GET /api/memberships   GET /api/programs   GET /api/trainers
+    GET /api/meal-plans    GET /api/classes
+
+and the live capacity stream, GET /api/classes/stream, from an asyncio
+subscription, so an open stream costs a queue rather than a thread.
+
+It reuses the models and to_dict() serializers from app.py; relationships the
+serializers touch are eager-loaded, so no lazy load happens on the event loop.
+Everything else (auth, writes, admin) stays on the Flask app: route those
+paths to gunicorn at the proxy, or install asgiref and this app forwards them
+to Flask in a thread pool.
+
+Run with:
+    uvicorn asgi:app --workers 4 --port 8000
+"""
+
+import asyncio
+import json
+import os
+from datetime import date
+from urllib.parse import parse_qs
+
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import selectinload
+
+from app import app as flask_app, db, capacity_feed, Branch, Membership, Trainer, Program, Class, MealPlan
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:  # optional: forwarding non-read paths to Flask
+    WsgiToAsgi = None
+
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql'
+}
+
+
+def async_database_url():
+    """The app's database URL with its async driver"""
+    if os.environ.get('ASYNC_DATABASE_URL'):
+        return os.environ['ASYNC_DATABASE_URL']
+    with flask_app.app_context():
+        # Resolved URL, so relative SQLite paths match the Flask app
+        url = db.engine.url
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f'No async driver known for {backend!r}; set ASYNC_DATABASE_URL')
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+engine = create_async_engine(async_database_url(), pool_pre_ping=True)
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+
+# ============================================
+# READ HANDLERS
+# ============================================
+
+async def branch_filter(session, query, model, params, include_shared=False):
+    """Same scoping as scope_to_branch() in app.py (X-Branch or ?branch=)"""
+    ref = params.get('branch')
+    if not ref:
+        return query
+    branch_id = (await session.execute(
+        select(Branch.id).where(or_(Branch.id == ref, Branch.code == ref))
+    )).scalar() or ref
+    if include_shared:
+        return query.where(or_(model.branch_id == branch_id, model.branch_id.is_(None)))
+    return query.where(model.branch_id == branch_id)
+
+
+async def get_memberships(session, params):
+    query = select(Membership).where(Membership.is_active.is_(True))
+    query = await branch_filter(session, query, Membership, params, include_shared=True)
+    memberships = (await session.scalars(query)).all()
+    return 200, {'memberships': [m.to_dict() for m in memberships]}
+
+
+async def get_programs(session, params):
+    programs = (await session.scalars(select(Program).where(Program.is_active.is_(True)))).all()
+    return 200, {'programs': [p.to_dict() for p in programs]}
+
+
+async def get_trainers(session, params):
+    query = select(Trainer).where(Trainer.is_active.is_(True)).options(selectinload(Trainer.user))
+    query = await branch_filter(session, query, Trainer, params)
+
+    if params.get('sort') == 'ranking':
+        # Served from ix_trainers_active_ranking
+        query = query.order_by(Trainer.ranking_score.desc())
+        try:
+            limit = int(params.get('limit', ''))
+        except ValueError:
+            limit = None
+        if limit:
+            query = query.limit(min(limit, 100))
+
+    trainers = (await session.scalars(query)).all()
+    return 200, {'trainers': [t.to_dict() for t in trainers]}
+
+
+async def get_meal_plans(session, params):
+    query = select(MealPlan).where(MealPlan.is_active.is_(True))
+    if params.get('category'):
+        query = query.where(MealPlan.category == params['category'])
+    meal_plans = (await session.scalars(query)).all()
+    return 200, {'meal_plans': [m.to_dict() for m in meal_plans]}
+
+
+async def get_classes(session, params):
+    query = select(Class).where(Class.is_active.is_(True)).options(
+        selectinload(Class.program),
+        selectinload(Class.trainer).selectinload(Trainer.user)
+    )
+    query = await branch_filter(session, query, Class, params)
+
+    if params.get('date'):
+        try:
+            query = query.where(Class.date == date.fromisoformat(params['date']))
+        except ValueError:
+            return 400, {'error': 'Invalid date'}
+    else:
+        query = query.where(Class.date >= date.today())
+
+    if params.get('trainer_id'):
+        query = query.where(Class.trainer_id == params['trainer_id'])
+
+    if params.get('program_id'):
+        query = query.where(Class.program_id == params['program_id'])
+
+    classes = (await session.scalars(query.order_by(Class.date, Class.start_time))).all()
+    return 200, {'classes': [c.to_dict() for c in classes]}
+
+
+ROUTES = {
+    '/api/memberships': get_memberships,
+    '/api/programs': get_programs,
+    '/api/trainers': get_trainers,
+    '/api/meal-plans': get_meal_plans,
+    '/api/classes': get_classes
+}
+
+
+# ============================================
+# ASGI APPLICATION
+# ============================================
+
+flask_fallback = WsgiToAsgi(flask_app) if WsgiToAsgi else None
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'access-control-allow-origin', b'*')
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def stream_capacity(scope, receive, send, params):
+    """Same stream as stream_class_availability() in app.py"""
+    class_ids = set(params['class_id'].split(',')) if params.get('class_id') else None
+    headers = dict(scope['headers'])
+    try:
+        last_event_id = int(headers.get(b'last-event-id', b''))
+    except ValueError:
+        last_event_id = None
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+            (b'access-control-allow-origin', b'*')
+        ]
+    })
+
+    async def pump():
+        frames = capacity_feed.stream_async(class_ids, last_event_id)
+        try:
+            async for frame in frames:
+                await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+        finally:
+            await frames.aclose()
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    # Stop on whichever comes first: the client leaving or the stream ending
+    # (a slow client overflowed and resumes with Last-Event-ID)
+    tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(disconnected())]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if tasks[0] in done:
+        tasks[0].result()
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    params = {key: values[0] for key, values in query.items()}
+
+    if scope['path'] == '/api/classes/stream' and scope['method'] == 'GET':
+        await stream_capacity(scope, receive, send, params)
+        return
+
+    handler = ROUTES.get(scope['path']) if scope['method'] == 'GET' else None
+    if handler is None:
+        if flask_fallback is not None:
+            await flask_fallback(scope, receive, send)
+        else:
+            await send_json(send, 404, {'error': 'Not found'})
+        return
+
+    # The header wins over the query parameter, as in current_branch_id()
+    branch = dict(scope['headers']).get(b'x-branch')
+    if branch:
+        params['branch'] = branch.decode('latin-1')
+
+    async with Session() as session:
+        status, payload = await handler(session, params)
+    await send_json(send, status, payload)
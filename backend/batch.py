@@ -0,0 +1,108 @@
+"""
+Batched GET requests for The Fitness Revolution API
+
+POST /api/batch runs a list of GET sub-requests in-process and returns their
+responses together, so a client's first paint costs one HTTP round trip
+instead of one per resource:
+
+    {"requests": [{"id": "classes", "path": "/api/classes?date=2024-06-01"},
+                  {"id": "plans", "path": "/api/memberships"}]}
+
+Sub-requests go through the normal dispatch (before_request hooks, JWT checks,
+error handlers) with the caller's headers. By default they run one after the
+other inside the batch request's app context, so they share its database
+session and identity map: a trainer loaded for /api/trainers is not loaded
+again for /api/classes. With "parallel": true they run on a thread pool; a
+SQLAlchemy session cannot be shared between threads, so each sub-request then
+gets its own app context and session.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, request
+
+logger = logging.getLogger('batch')
+
+# Caller headers passed through to every sub-request
+FORWARDED_HEADERS = ('Authorization', 'X-Branch', 'X-Forwarded-For', 'Accept-Language')
+
+
+class BatchError(ValueError):
+    """The batch payload itself is invalid"""
+
+
+def parse_batch(payload, max_requests):
+    """Validate a batch payload; returns (sub_requests, parallel)"""
+    if not isinstance(payload, dict) or not isinstance(payload.get('requests'), list):
+        raise BatchError('Body must be an object with a "requests" list')
+    items = payload['requests']
+    if not items:
+        raise BatchError('No requests given')
+    if len(items) > max_requests:
+        raise BatchError(f'At most {max_requests} requests per batch')
+
+    sub_requests = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'path': item}
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+            raise BatchError(f'Request {index} needs a "path"')
+        if item.get('method', 'GET').upper() != 'GET':
+            raise BatchError(f'Request {index}: only GET requests can be batched')
+        if not item['path'].startswith('/api/'):
+            raise BatchError(f'Request {index}: path must start with /api/')
+        sub_requests.append({'id': item.get('id', index), 'path': item['path']})
+    return sub_requests, bool(payload.get('parallel'))
+
+
+class BatchExecutor:
+    """Dispatches GET sub-requests through a Flask app"""
+
+    def __init__(self, app, excluded_endpoints=(), max_workers=4):
+        self.app = app
+        self.excluded_endpoints = set(excluded_endpoints)
+        self.max_workers = max_workers
+
+    def run(self, sub_requests, parallel=False):
+        """Responses for `sub_requests`, in order (call inside a request)"""
+        headers = {name: request.headers[name] for name in FORWARDED_HEADERS if name in request.headers}
+        environ = {'REMOTE_ADDR': request.remote_addr}
+
+        if not parallel or len(sub_requests) == 1:
+            return [self._dispatch(item, headers, environ) for item in sub_requests]
+
+        def dispatch_isolated(item):
+            with self.app.app_context():
+                return self._dispatch(item, headers, environ)
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(sub_requests))) as pool:
+            return list(pool.map(dispatch_isolated, sub_requests))
+
+    def _dispatch(self, item, headers, environ):
+        # Per-request state that lives on the shared app context
+        saved_g = g.__dict__.copy()
+        session = self.app.extensions['sqlalchemy'].session()
+        saved_branch_bind = session.info.get('branch_bind')
+        try:
+            with self.app.test_request_context(item['path'], method='GET', headers=headers,
+                                               environ_base=environ):
+                rule = request.url_rule
+                if rule is not None and rule.endpoint in self.excluded_endpoints:
+                    return {'id': item['id'], 'status': 400,
+                            'body': {'error': 'This endpoint cannot be batched'}}
+                try:
+                    response = self.app.full_dispatch_request()
+                except Exception:
+                    logger.exception('batched request %s failed', item['path'])
+                    session.rollback()
+                    return {'id': item['id'], 'status': 500, 'body': {'error': 'Internal server error'}}
+                return {
+                    'id': item['id'],
+                    'status': response.status_code,
+                    'body': response.get_json(silent=True)
+                }
+        finally:
+            g.__dict__.clear()
+            g.__dict__.update(saved_g)
+            session.info['branch_bind'] = saved_branch_bind
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the public read endpoints: Flask on gunicorn vs asgi.py
+
+Opens many concurrent keep-alive connections and reports throughput and
+latency percentiles. Start both servers against the same database first:
+
+    gunicorn -w 4 -b 127.0.0.1:8001 app:app
+    uvicorn asgi:app --workers 4 --port 8002 --log-level warning
+
+then:
+
+    python bench_asgi.py --url http://127.0.0.1:8001/api/classes --url http://127.0.0.1:8002/api/classes
+    python bench_asgi.py --url http://127.0.0.1:8002/api/programs --connections 2000 --duration 20
+"""
+
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response; returns (status, keep_alive)"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length:
+        await reader.readexactly(length)
+    return status, headers.get('connection', '').lower() != 'close'
+
+
+async def client(host, port, request, deadline, latencies, errors):
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            started = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status, keep_alive = await read_response(reader)
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors['status'] += 1
+            if not keep_alive:
+                # gunicorn sync workers close the connection after each response
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError):
+            errors['connection'] += 1
+            writer = None
+            await asyncio.sleep(0.05)
+    if writer is not None:
+        writer.close()
+
+
+async def run(url, connections, duration):
+    parts = urlsplit(url)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    request = (f'GET {path} HTTP/1.1\r\nHost: {parts.hostname}\r\n'
+               f'Connection: keep-alive\r\n\r\n').encode()
+    latencies = []
+    errors = {'status': 0, 'connection': 0}
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[
+        client(parts.hostname, parts.port or 80, request, deadline, latencies, errors)
+        for _ in range(connections)
+    ])
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test read endpoints')
+    parser.add_argument('--url', action='append', required=True, help='Endpoint URL (repeat to compare)')
+    parser.add_argument('--connections', type=int, default=500, help='Concurrent keep-alive clients')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per URL')
+    args = parser.parse_args()
+
+    print(f"{'url':<45} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for url in args.url:
+        latencies, errors = asyncio.run(run(url, args.connections, args.duration))
+        latencies.sort()
+        print(f'{url:<45} {len(latencies) / args.duration:>9.0f} '
+              f'{percentile(latencies, 0.5):>8.1f} {percentile(latencies, 0.99):>8.1f} '
+              f'{errors["status"] + errors["connection"]:>7}')
+
+
+if __name__ == '__main__':
+    main()
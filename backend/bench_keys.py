@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Benchmark: 36-character text uuid4 keys vs 16-byte UUIDv7 keys
+
+Builds the users/classes/bookings tables twice in SQLite, once with the old
+String(36) uuid4 keys and once with the CompactUUID UUIDv7 keys from keys.py.
+It reports insert time, the on-disk size of every table and index, and the
+latency of the booking joins the API runs.
+
+    python bench_keys.py --bookings 200000
+    python bench_keys.py --compare fitness_revolution.db migrated.db
+
+--compare prints the table and index sizes of two existing SQLite files, e.g.
+before and after migrate_keys.py.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import date, time as clock_time, timedelta
+
+import sqlalchemy as sa
+
+from keys import CompactUUID, new_id
+
+VARIANTS = {
+    'text uuid4': (sa.String(36), lambda: str(uuid.uuid4())),
+    'binary uuid7': (CompactUUID(), new_id)
+}
+
+
+def build_schema(key_type):
+    metadata = sa.MetaData()
+    users = sa.Table(
+        'users', metadata,
+        sa.Column('id', key_type, primary_key=True),
+        sa.Column('email', sa.String(120), nullable=False)
+    )
+    classes = sa.Table(
+        'classes', metadata,
+        sa.Column('id', key_type, primary_key=True),
+        sa.Column('date', sa.Date, nullable=False),
+        sa.Column('start_time', sa.Time, nullable=False),
+        sa.Index('ix_classes_date_start_time', 'date', 'start_time')
+    )
+    bookings = sa.Table(
+        'bookings', metadata,
+        sa.Column('id', key_type, primary_key=True),
+        sa.Column('user_id', key_type, sa.ForeignKey('users.id')),
+        sa.Column('class_id', key_type, sa.ForeignKey('classes.id')),
+        sa.Column('status', sa.String(20)),
+        sa.Index('ix_bookings_class_status', 'class_id', 'status'),
+        sa.Index('ix_bookings_user', 'user_id')
+    )
+    return metadata, users, classes, bookings
+
+
+def object_sizes(path):
+    """{table or index name: bytes} from SQLite's dbstat table"""
+    engine = sa.create_engine(f'sqlite:///{path}')
+    with engine.connect() as conn:
+        rows = conn.execute(sa.text(
+            "SELECT name, SUM(pgsize) FROM dbstat WHERE name NOT LIKE 'sqlite_%' GROUP BY name"
+        )).fetchall()
+        # Primary keys on non-integer columns live in an automatic index
+        autoindexes = conn.execute(sa.text(
+            "SELECT name, tbl_name FROM sqlite_master WHERE name LIKE 'sqlite_autoindex_%'"
+        )).fetchall()
+        for name, table in autoindexes:
+            size = conn.execute(sa.text('SELECT SUM(pgsize) FROM dbstat WHERE name = :n'),
+                                {'n': name}).scalar()
+            rows.append((f'{table} (primary key index)', size))
+    engine.dispose()
+    return dict(rows)
+
+
+def timed(conn, statement, params, repeat):
+    samples = []
+    for value in params[:repeat]:
+        started = time.perf_counter()
+        conn.execute(statement, value).fetchall()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+def run_variant(path, key_type, make_id, n_users, n_classes, n_bookings, repeat):
+    metadata, users, classes, bookings = build_schema(key_type)
+    engine = sa.create_engine(f'sqlite:///{path}')
+    metadata.create_all(engine)
+    result = {}
+
+    user_ids = [make_id() for _ in range(n_users)]
+    class_rows = [
+        {'id': make_id(), 'date': date.today() + timedelta(days=i % 90), 'start_time': clock_time(7, 0)}
+        for i in range(n_classes)
+    ]
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        conn.execute(users.insert(), [{'id': i, 'email': f'{i}@example.com'} for i in user_ids])
+        conn.execute(classes.insert(), class_rows)
+        # Bookings arrive over time, in batches of 1000
+        for offset in range(0, n_bookings, 1000):
+            conn.execute(bookings.insert(), [
+                {'id': make_id(), 'user_id': random.choice(user_ids),
+                 'class_id': random.choice(class_rows)['id'], 'status': 'confirmed'}
+                for _ in range(min(1000, n_bookings - offset))
+            ])
+    result['insert_s'] = time.perf_counter() - started
+
+    with engine.connect() as conn:
+        # Roster of one class, as in the booking and waitlist routes
+        roster = sa.select(bookings.c.id, users.c.email) \
+            .join(users, users.c.id == bookings.c.user_id) \
+            .where(bookings.c.class_id == sa.bindparam('class_id'), bookings.c.status == 'confirmed')
+        result['roster_ms'] = timed(conn, roster,
+                                    [{'class_id': random.choice(class_rows)['id']} for _ in range(repeat)],
+                                    repeat)
+        # A member's bookings with their classes, as in GET /api/bookings
+        history = sa.select(bookings.c.id, classes.c.date) \
+            .join(classes, classes.c.id == bookings.c.class_id) \
+            .where(bookings.c.user_id == sa.bindparam('user_id')) \
+            .order_by(classes.c.date)
+        result['history_ms'] = timed(conn, history,
+                                     [{'user_id': random.choice(user_ids)} for _ in range(repeat)],
+                                     repeat)
+        # Seats per class over a date range, as in reconcile.py
+        seats = sa.select(classes.c.id, sa.func.count(bookings.c.id)) \
+            .outerjoin(bookings, bookings.c.class_id == classes.c.id) \
+            .where(classes.c.date.between(sa.bindparam('start'), sa.bindparam('end'))) \
+            .group_by(classes.c.id)
+        ranges = [{'start': date.today() + timedelta(days=d), 'end': date.today() + timedelta(days=d + 14)}
+                  for d in (random.randrange(75) for _ in range(repeat))]
+        result['seats_ms'] = timed(conn, seats, ranges, max(1, repeat // 10))
+    engine.dispose()
+
+    result['sizes'] = object_sizes(path)
+    result['file_bytes'] = os.path.getsize(path)
+    return result
+
+
+def print_sizes(columns):
+    names = sorted(set().union(*[sizes for _, sizes in columns]))
+    print(f"{'object':<40}" + ''.join(f'{label:>16}' for label, _ in columns))
+    for name in names:
+        print(f'{name:<40}' + ''.join(f'{sizes.get(name, 0) / 1024:>13.0f} KB' for _, sizes in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare text uuid4 keys with binary UUIDv7 keys')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--classes', type=int, default=5000)
+    parser.add_argument('--bookings', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=500, help='Timed queries per join')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Compare two SQLite files')
+    args = parser.parse_args()
+
+    if args.compare:
+        print_sizes([(os.path.basename(path), object_sizes(path)) for path in args.compare])
+        return
+
+    random.seed(7)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for label, (key_type, make_id) in VARIANTS.items():
+            path = os.path.join(directory, label.replace(' ', '_') + '.db')
+            results[label] = run_variant(path, key_type, make_id, args.users, args.classes,
+                                         args.bookings, args.repeat)
+
+    print(f'{args.users} users, {args.classes} classes, {args.bookings} bookings\n')
+    print_sizes([(label, r['sizes']) for label, r in results.items()])
+    print(f"{'file size':<40}" + ''.join(f"{r['file_bytes'] / 1024:>13.0f} KB" for r in results.values()))
+    print()
+    print(f"{'timing':<40}" + ''.join(f'{label:>16}' for label in results))
+    print(f"{'insert (s)':<40}" + ''.join(f"{r['insert_s']:>16.2f}" for r in results.values()))
+    for key, name in (('roster_ms', 'class roster p50/p99 (ms)'),
+                      ('history_ms', 'member history p50/p99 (ms)'),
+                      ('seats_ms', 'seats per class p50/p99 (ms)')):
+        print(f'{name:<40}' + ''.join(f'{r[key][0]:>8.3f}/{r[key][1]:<7.3f}' for r in results.values()))
+
+
+if __name__ == '__main__':
+    main()
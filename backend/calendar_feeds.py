@@ -0,0 +1,275 @@
+"""
+iCalendar feeds for The Fitness Revolution API
+
+Members subscribe their phone calendars to a feed of their bookings, and
+trainers to a feed of the classes they teach. Calendar apps poll feeds every
+few minutes, almost always for a feed that hasn't changed, so every worker
+caches rendered feeds along with the version of the feed's scope
+('member:<user_id>' or 'trainer:<trainer_id>') they were rendered at.
+
+Bookings, cancellations and class changes bump the versions of the scopes
+they affect in a pluggable version store (the SQLite store is shared by the
+gunicorn workers on a host). A poll reads one version: if it still matches
+the cached feed, the cached body is served, or 304 Not Modified when the
+client's ETag matches, without touching the database.
+
+Feeds are addressed by unguessable tokens. The app resolves a token and
+renders a feed with two decorators:
+
+    @calendar_feeds.token_resolver
+    def resolve(token): ...             # -> (kind, owner_id) or None
+
+    @calendar_feeds.feed_renderer
+    def render(kind, owner_id): ...     # -> iCalendar text
+"""
+
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import timezone
+
+from shared_store import SharedSQLite, sqlite_path_from_url
+
+FEED_KINDS = ('member', 'trainer')
+
+
+def new_feed_token():
+    """Unguessable token for a feed URL (256 bits)"""
+    return secrets.token_urlsafe(32)
+
+
+def hash_feed_token(token):
+    """Tokens are stored hashed, like passwords"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def feed_scope(kind, owner_id):
+    return f'{kind}:{owner_id}'
+
+
+# ============================================
+# ICALENDAR
+# ============================================
+
+def escape_text(value):
+    """Escape a TEXT property value (RFC 5545 3.3.11)"""
+    return (str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold(line):
+    """Fold a content line at 75 octets (RFC 5545 3.1)"""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+    parts, start, limit = [], 0, 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Never split a UTF-8 sequence
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode('utf-8'))
+        start, limit = end, 74
+    return '\r\n '.join(parts)
+
+
+def utc_stamp(moment, tz=None):
+    """DATE-TIME in UTC form; naive `moment`s are in `tz` (None = already UTC)"""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=tz or timezone.utc)
+    return moment.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def render_calendar(name, events):
+    """VCALENDAR text for `events`, dicts with uid, start, end, stamp (aware
+    datetimes), summary and optional location, description, url, status"""
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//The Fitness Revolution//Class Schedule//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{escape_text(name)}'
+    ]
+    for event in events:
+        lines += [
+            'BEGIN:VEVENT',
+            f"UID:{event['uid']}",
+            f"DTSTAMP:{utc_stamp(event['stamp'])}",
+            f"DTSTART:{utc_stamp(event['start'])}",
+            f"DTEND:{utc_stamp(event['end'])}",
+            f"SUMMARY:{escape_text(event['summary'])}"
+        ]
+        for key, prop in (('location', 'LOCATION'), ('description', 'DESCRIPTION')):
+            if event.get(key):
+                lines.append(f'{prop}:{escape_text(event[key])}')
+        if event.get('url'):
+            lines.append(f"URL:{event['url']}")
+        lines += [f"STATUS:{event.get('status', 'CONFIRMED')}", 'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(fold(line) for line in lines) + '\r\n'
+
+
+# ============================================
+# VERSION STORES
+# ============================================
+
+class VersionStore:
+    """Interface for feed version storage backends"""
+
+    def version(self, scope):
+        """Current version of `scope` (0 if it was never bumped)"""
+        raise NotImplementedError
+
+    def bump(self, scopes):
+        """Increment the version of every scope in `scopes`"""
+        raise NotImplementedError
+
+
+class MemoryVersionStore(VersionStore):
+    """In-process versions; only correct with a single worker process"""
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version(self, scope):
+        return self._versions.get(scope, 0)
+
+    def bump(self, scopes):
+        with self._lock:
+            for scope in scopes:
+                self._versions[scope] = self._versions.get(scope, 0) + 1
+
+
+class SQLiteVersionStore(VersionStore):
+    """Versions in a SQLite file shared by all workers on the host"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS feed_versions (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.db = SharedSQLite(path, self.SCHEMA)
+
+    def version(self, scope):
+        row = self.db.execute('SELECT version FROM feed_versions WHERE scope = ?', (scope,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, scopes):
+        with self.db.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO feed_versions (scope, version) VALUES (?, 1) '
+                'ON CONFLICT (scope) DO UPDATE SET version = version + 1',
+                [(scope,) for scope in scopes]
+            )
+
+
+# Storage URL scheme -> factory(url). Register more (e.g. redis) with
+# CalendarFeeds.register_store().
+STORE_FACTORIES = {
+    'memory': lambda url: MemoryVersionStore(),
+    'sqlite': lambda url: SQLiteVersionStore(sqlite_path_from_url(url))
+}
+
+
+# ============================================
+# FEED CACHE
+# ============================================
+
+class CachedFeed:
+    __slots__ = ('kind', 'scope', 'version', 'body', 'etag')
+
+    def __init__(self, kind, scope, version, body):
+        self.kind = kind
+        self.scope = scope
+        self.version = version
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+class CalendarFeeds:
+    """Serves feeds from a per-worker cache validated by scope versions"""
+
+    def __init__(self, app=None):
+        self.store = None
+        self.cache_size = 10000
+        self._resolve = None
+        self._render = None
+        self._cache = OrderedDict()     # token hash -> CachedFeed
+        self._lock = threading.Lock()
+        self.metrics = {'not_modified': 0, 'hits': 0, 'renders': 0, 'not_found': 0}
+        if app is not None:
+            self.init_app(app)
+
+    @staticmethod
+    def register_store(scheme, factory):
+        """Make a storage backend available under `scheme://` URLs"""
+        STORE_FACTORIES[scheme] = factory
+
+    def init_app(self, app):
+        url = app.config.get('CALENDAR_VERSION_STORAGE_URL', 'memory://')
+        scheme = url.split(':', 1)[0]
+        if scheme not in STORE_FACTORIES:
+            raise ValueError(f'No calendar version store registered for {scheme!r}')
+        self.store = STORE_FACTORIES[scheme](url)
+        self.cache_size = app.config.get('CALENDAR_CACHE_SIZE', 10000)
+        app.extensions['calendar_feeds'] = self
+
+    def token_resolver(self, func):
+        """Register `func(token_hash)` returning (kind, owner_id) or None"""
+        self._resolve = func
+        return func
+
+    def feed_renderer(self, func):
+        """Register `func(kind, owner_id)` returning the feed's iCalendar text"""
+        self._render = func
+        return func
+
+    def bump(self, *scopes):
+        """Invalidate every worker's cached feeds for `scopes` (call after commit)"""
+        scopes = {scope for scope in scopes if scope}
+        if scopes:
+            self.store.bump(sorted(scopes))
+
+    def feed(self, kind, token, if_none_match=None):
+        """(status, CachedFeed) for a feed request: 200, 304 or 404 (feed None)"""
+        token_hash = hash_feed_token(token)
+        with self._lock:
+            cached = self._cache.get(token_hash)
+            if cached is not None:
+                self._cache.move_to_end(token_hash)
+        if cached is not None and cached.kind == kind and self.store.version(cached.scope) == cached.version:
+            return self._answer(cached, if_none_match, 'hits')
+
+        resolved = self._resolve(token_hash)
+        if resolved is None or resolved[0] != kind:
+            with self._lock:
+                self._cache.pop(token_hash, None)
+            self.metrics['not_found'] += 1
+            return 404, None
+        scope = feed_scope(*resolved)
+        # Read before rendering: a bump while rendering makes this entry stale
+        version = self.store.version(scope)
+        cached = CachedFeed(kind, scope, version, self._render(*resolved))
+        with self._lock:
+            self._cache[token_hash] = cached
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return self._answer(cached, if_none_match, 'renders')
+
+    def _answer(self, cached, if_none_match, counter):
+        if if_none_match and cached.etag in [tag.strip() for tag in if_none_match.split(',')]:
+            self.metrics['not_modified'] += 1
+            return 304, cached
+        self.metrics[counter] += 1
+        return 200, cached
+
+    def status(self):
+        with self._lock:
+            cached = len(self._cache)
+        return {**self.metrics, 'cached_feeds': cached}
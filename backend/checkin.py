@@ -0,0 +1,465 @@
+"""
+Class check-in for The Fitness Revolution API
+
+At class start dozens of members check in within a minute, in every room at
+once. Check-ins are validated against an in-memory roster of the day's
+confirmed bookings and acknowledged right away; the attendance updates are
+written to the database by a background thread in batched transactions, so a
+burst costs a handful of commits instead of one per member.
+
+Durability: before a check-in is acknowledged it is appended to this
+worker's journal file and fsync'd. A batch is removed from the journal only
+after its transaction commits. Journals left behind by a worker that died
+are replayed by the next worker to start. Replaying is safe because marking
+a booking attended is idempotent.
+
+Each worker caches the roster, so cancellations and no-show marks are also
+recorded in a pluggable store (the SQLite store is shared by the gunicorn
+workers on a host) that every worker checks before accepting a check-in: a
+booking cancelled through another worker is refused at once instead of
+after the roster's next reload, and a member marked no-show who turns up
+late is checked in even by a worker that saw an earlier check-in.
+
+The app supplies the database side with two decorators:
+
+    @checkin_desk.roster_loader
+    def load(day, class_id=None, booking_id=None): ...
+        # -> [(booking_id, user_id, class_id, start, end, attended)]
+
+    @checkin_desk.attendance_writer
+    def write(checkins): ...                # [(booking_id, checked_in_at)], one transaction
+"""
+
+import fcntl
+import glob
+import json
+import os
+import secrets
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from shared_store import SharedSQLite, sqlite_path_from_url
+
+
+class CheckInError(Exception):
+    """A check-in that can't be accepted; carries the HTTP status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+# ============================================
+# JOURNAL
+# ============================================
+
+class Journal:
+    """Append-only JSON-lines file owned (flock'd) by one process"""
+
+    def __init__(self, directory, prefix):
+        self.directory = directory
+        self.prefix = prefix
+        self.path = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Pids are reused (container restarts), so a pid alone could reopen a
+        # dead worker's journal, which would then never be replayed
+        self.path = os.path.join(self.directory, f'{self.prefix}-{os.getpid()}-{secrets.token_hex(4)}.jsonl')
+        self._file = open(self.path, 'x', encoding='utf-8')
+        # Held for the life of the process; orphaned journals are unlocked
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+
+    def append(self, record):
+        """Write one record and fsync it before returning"""
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def rewrite(self, records):
+        """Replace the journal with `records` (the ones not yet flushed)"""
+        with self._lock:
+            self._file.seek(0)
+            self._file.truncate()
+            for record in records:
+                self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def orphans(self):
+        """Paths of journals whose owning process is gone"""
+        for path in glob.glob(os.path.join(self.directory, f'{self.prefix}-*.jsonl')):
+            if path != self.path:
+                yield path
+
+    @staticmethod
+    def claim(path):
+        """Read an orphaned journal if no live process holds it, else None
+
+        Returns (records, release) where release() deletes the file.
+        """
+        try:
+            handle = open(path, 'r+', encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            handle.close()
+            return None
+        records = []
+        for line in handle:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Torn final line from a crash mid-write; it was never acknowledged
+                continue
+
+        def release():
+            os.remove(path)
+            handle.close()
+        return records, release
+
+
+# ============================================
+# ROSTER CHANGE STORES
+# ============================================
+
+class RosterStore:
+    """Interface for storage backends of bookings cancelled or marked no-show"""
+
+    def record(self, booking_ids, day, change):
+        """Record that `booking_ids`, of classes on `day`, were 'cancelled' or
+        marked 'no_show' (now)"""
+        raise NotImplementedError
+
+    def change(self, booking_id):
+        """(change, recorded_at) of the last change to `booking_id`, or None"""
+        raise NotImplementedError
+
+    def prune(self, before):
+        """Forget changes to classes before the date `before`"""
+        raise NotImplementedError
+
+
+class MemoryRosterStore(RosterStore):
+    """In-process changes; only correct with a single worker process"""
+
+    def __init__(self):
+        self._changes = {}      # booking_id -> (change, recorded_at, day)
+        self._lock = threading.Lock()
+
+    def record(self, booking_ids, day, change):
+        now = time.time()
+        with self._lock:
+            for booking_id in booking_ids:
+                self._changes[booking_id] = (change, now, day)
+
+    def change(self, booking_id):
+        found = self._changes.get(booking_id)
+        return found[:2] if found else None
+
+    def prune(self, before):
+        with self._lock:
+            for booking_id in [b for b, found in self._changes.items() if found[2] < before]:
+                del self._changes[booking_id]
+
+
+class SQLiteRosterStore(RosterStore):
+    """Changes in a SQLite file shared by all workers on the host"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS roster_changes (
+            booking_id TEXT PRIMARY KEY,
+            day TEXT NOT NULL,
+            change TEXT NOT NULL,
+            recorded_at REAL NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.db = SharedSQLite(path, self.SCHEMA)
+
+    def record(self, booking_ids, day, change):
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO roster_changes (booking_id, day, change, recorded_at) VALUES (?, ?, ?, ?)',
+                [(booking_id, day.isoformat(), change, now) for booking_id in booking_ids]
+            )
+
+    def change(self, booking_id):
+        row = self.db.execute('SELECT change, recorded_at FROM roster_changes WHERE booking_id = ?',
+                              (booking_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def prune(self, before):
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM roster_changes WHERE day < ?', (before.isoformat(),))
+
+
+# Storage URL scheme -> factory(url)
+STORE_FACTORIES = {
+    'memory': lambda url: MemoryRosterStore(),
+    'sqlite': lambda url: SQLiteRosterStore(sqlite_path_from_url(url))
+}
+
+
+# ============================================
+# CHECK-IN DESK
+# ============================================
+
+class CheckInDesk:
+    """Validates check-ins against the day's roster and batches the writes"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.journal = None
+        self.store = None
+        self.flush_interval = 0.5
+        self.batch_size = 100
+        self.opens_before = timedelta(minutes=30)
+        self.roster_ttl = 60
+        self._load_roster = None
+        self._write_attendance = None
+        self._lock = threading.Lock()
+        # Serializes journal writes with the pending list, so a rewrite after
+        # a flush never drops a record that is journaled but not yet pending
+        self._journal_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._checked_in = {}   # booking_id -> time.time() when accepted (or loaded attended)
+        self._reset_roster(None)
+        self._pending = []
+        self.metrics = {'accepted': 0, 'duplicates': 0, 'rejected': 0, 'flushed': 0,
+                        'batches': 0, 'replayed': 0, 'flush_errors': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.journal = Journal(app.config.get('CHECKIN_JOURNAL_DIR', 'checkin-journal'), 'checkin')
+        url = app.config.get('CHECKIN_STORAGE_URL', 'memory://')
+        scheme = url.split(':', 1)[0]
+        if scheme not in STORE_FACTORIES:
+            raise ValueError(f'No check-in store registered for {scheme!r}')
+        self.store = STORE_FACTORIES[scheme](url)
+        self.flush_interval = app.config.get('CHECKIN_FLUSH_INTERVAL', 0.5)
+        self.batch_size = app.config.get('CHECKIN_BATCH_SIZE', 100)
+        self.opens_before = timedelta(minutes=app.config.get('CHECKIN_OPENS_MINUTES', 30))
+        app.extensions['checkin'] = self
+
+    def roster_loader(self, func):
+        """Register `func(day, class_id=None, booking_id=None)` returning the day's
+        confirmed and attended bookings, optionally of one class or booking"""
+        self._load_roster = func
+        return func
+
+    def attendance_writer(self, func):
+        """Register `func(checkins)` marking bookings attended in one transaction"""
+        self._write_attendance = func
+        return func
+
+    # ----- roster -----
+
+    def _reset_roster(self, day):
+        self._day = day
+        self._loaded_at = 0.0
+        self._classes = {}      # class_id -> {'start', 'end', 'members': {user_id: booking_id}}
+        self._bookings = {}     # booking_id -> (class_id, user_id)
+
+    def _add_rows(self, rows):
+        for booking_id, user_id, class_id, start_time, end_time, attended in rows:
+            roster = self._classes.setdefault(class_id, {'start': start_time, 'end': end_time, 'members': {}})
+            roster['members'][user_id] = booking_id
+            self._bookings[booking_id] = (class_id, user_id)
+            if attended:
+                self._checked_in.setdefault(booking_id, time.time())
+
+    def _refresh(self, class_id=None, booking_id=None):
+        """Reload after a miss: the whole roster if it is stale, else only the
+        class or booking asked for (made since the last full load)"""
+        now, today = time.monotonic(), date.today()
+        with self._app_context():
+            if self._day != today or now - self._loaded_at > self.roster_ttl:
+                rows = self._load_roster(today)
+                if self._day != today:
+                    self.store.prune(today)
+                with self._lock:
+                    if self._day != today:
+                        self._checked_in.clear()
+                    self._reset_roster(today)
+                    self._add_rows(rows)
+                    self._loaded_at = now
+            else:
+                rows = self._load_roster(today, class_id=class_id, booking_id=booking_id)
+                with self._lock:
+                    self._add_rows(rows)
+
+    def forget(self, booking_id, day=None):
+        """Drop a cancelled booking from every worker's roster (call after commit)"""
+        self.store.record([booking_id], day or date.today(), 'cancelled')
+        self._drop(booking_id)
+
+    def mark_no_show(self, booking_ids, day=None):
+        """Let bookings marked no-show be checked in again, on every worker
+        (call after commit)"""
+        self.store.record(booking_ids, day or date.today(), 'no_show')
+        with self._lock:
+            for booking_id in booking_ids:
+                self._checked_in.pop(booking_id, None)
+
+    def _drop(self, booking_id):
+        with self._lock:
+            class_id, user_id = self._bookings.pop(booking_id, (None, None))
+            if class_id in self._classes:
+                self._classes[class_id]['members'].pop(user_id, None)
+
+    # ----- check-in -----
+
+    def check_in(self, booking_id=None, class_id=None, user_id=None, now=None):
+        """Accept a check-in by booking id, or by class and member
+
+        With both `booking_id` and `user_id`, the booking must be the member's.
+
+        Returns (booking_id, class_id, duplicate). Raises CheckInError.
+        """
+        self._ensure_flusher()
+        # Local time for the class window (class times are local); the
+        # check-in itself is stored in UTC like every other timestamp
+        now = now or datetime.now()
+        booking = self._find(booking_id, class_id, user_id)
+        if booking is None:
+            self._refresh(class_id, booking_id)
+            booking = self._find(booking_id, class_id, user_id)
+        change = self.store.change(booking[0]) if booking is not None else None
+        if change and change[0] == 'cancelled':
+            # Cancelled through another worker since this roster was loaded
+            self._drop(booking[0])
+            booking = None
+        if booking is None:
+            self.metrics['rejected'] += 1
+            raise CheckInError('No confirmed booking for this class today', 404)
+        booking_id, class_id, roster = booking
+
+        starts = datetime.combine(now.date(), roster['start'])
+        ends = datetime.combine(now.date(), roster['end'])
+        if not starts - self.opens_before <= now <= ends:
+            self.metrics['rejected'] += 1
+            raise CheckInError('Check-in is not open for this class', 409)
+
+        with self._lock:
+            accepted_at = self._checked_in.get(booking_id)
+            # Marked no-show (through any worker) since then: a late check-in counts
+            if accepted_at is not None and not (change and change[0] == 'no_show' and change[1] > accepted_at):
+                self.metrics['duplicates'] += 1
+                return booking_id, class_id, True
+            self._checked_in[booking_id] = time.time()
+        record = {'booking_id': booking_id, 'checked_in_at': datetime.utcnow().isoformat()}
+        with self._journal_lock:
+            try:
+                self.journal.append(record)
+            except OSError:
+                with self._lock:
+                    self._checked_in.pop(booking_id, None)
+                raise
+            with self._lock:
+                self._pending.append(record)
+                self.metrics['accepted'] += 1
+                full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+        return booking_id, class_id, False
+
+    def _find(self, booking_id, class_id, user_id):
+        if self._day != date.today():
+            return None
+        with self._lock:
+            if booking_id is not None:
+                class_id, owner = self._bookings.get(booking_id, (None, None))
+                if user_id is not None and owner != user_id:
+                    return None
+                user_id = owner
+            roster = self._classes.get(class_id)
+            found = roster['members'].get(user_id) if roster else None
+            if found is None or (booking_id is not None and found != booking_id):
+                return None
+            return found, class_id, roster
+
+    # ----- flushing -----
+
+    def _app_context(self):
+        return self.app.app_context()
+
+    def _ensure_flusher(self):
+        # One flusher thread per worker process (re-created after fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.journal.open()
+            self._pending = []
+            thread = threading.Thread(target=self._flush_loop, name='checkin-flush', daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def _flush_loop(self):
+        self._replay_orphans()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.metrics['flush_errors'] += 1
+                self.app.logger.exception('check-in flush failed')
+                time.sleep(self.flush_interval)
+
+    def flush(self):
+        """Write pending check-ins in batches; returns how many were written"""
+        written = 0
+        while True:
+            with self._lock:
+                batch = self._pending[:self.batch_size]
+            if not batch:
+                return written
+            with self._app_context():
+                self._write_attendance([(r['booking_id'], r['checked_in_at']) for r in batch])
+            with self._journal_lock:
+                with self._lock:
+                    del self._pending[:len(batch)]
+                    remaining = list(self._pending)
+                    self.metrics['flushed'] += len(batch)
+                    self.metrics['batches'] += 1
+                # Committed, so only the unflushed tail needs to stay in the journal
+                self.journal.rewrite(remaining)
+            written += len(batch)
+
+    def _replay_orphans(self):
+        for path in self.journal.orphans():
+            claimed = Journal.claim(path)
+            if claimed is None:
+                continue
+            records, release = claimed
+            for start in range(0, len(records), self.batch_size):
+                batch = records[start:start + self.batch_size]
+                with self._app_context():
+                    self._write_attendance([(r['booking_id'], r['checked_in_at']) for r in batch])
+            self.metrics['replayed'] += len(records)
+            release()
+
+    def status(self):
+        self._ensure_flusher()
+        with self._lock:
+            pending = len(self._pending)
+            classes = len(self._classes)
+            bookings = len(self._bookings)
+        return {**self.metrics, 'pending': pending, 'roster_day': self._day.isoformat() if self._day else None,
+                'roster_classes': classes, 'roster_bookings': bookings}
@@ -0,0 +1,196 @@
+"""
+Write-behind queue for contact form submissions
+
+Campaigns bring thousands of contact form posts an hour, many of them
+resubmissions or spam repeating the same text. Committing each one contends
+for the database's write lock with booking traffic, so submissions are
+acknowledged as soon as they are appended (and fsync'd) to this worker's
+journal, and a background thread inserts them in batched transactions.
+
+Duplicates, identified by a hash of the normalized name, email, subject and
+message, are dropped twice: on arrival if this worker saw the same content
+within the dedup window, and when a batch is written, against rows any
+worker stored within the window. The writer also skips ids already stored,
+which makes replaying an orphaned journal safe. Journals are checkin.Journal
+files, named per process start rather than per pid, so a worker that reuses
+a dead worker's pid still finds that worker's journal orphaned and replays
+it before anything is trimmed.
+
+The app supplies the database side with one decorator:
+
+    @contact_queue.message_writer
+    def write(messages, since): ...     # -> rows inserted, in one transaction
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from checkin import Journal
+from keys import new_id
+
+FIELDS = ('name', 'email', 'phone', 'subject', 'message')
+
+
+def content_hash(fields):
+    """Hash of a submission's content, ignoring case and whitespace"""
+    parts = [' '.join(str(fields.get(field) or '').split()).casefold()
+             for field in ('name', 'email', 'subject', 'message')]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+class ContactQueue:
+    """Journals contact submissions and writes them in deduplicated batches"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.journal = None
+        self.flush_interval = 1.0
+        self.batch_size = 500
+        self.dedup_window = timedelta(hours=1)
+        self.max_recent = 100000
+        self._write = None
+        self._lock = threading.Lock()
+        # Serializes journal writes with the pending list (see CheckInDesk)
+        self._journal_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._pending = []
+        self._recent = OrderedDict()    # content hash -> monotonic time accepted
+        self.metrics = {'accepted': 0, 'duplicates': 0, 'flushed': 0, 'dropped': 0,
+                        'batches': 0, 'replayed': 0, 'flush_errors': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.journal = Journal(app.config.get('CONTACT_JOURNAL_DIR', 'contact-journal'), 'contact')
+        self.flush_interval = app.config.get('CONTACT_FLUSH_INTERVAL', 1.0)
+        self.batch_size = app.config.get('CONTACT_BATCH_SIZE', 500)
+        self.dedup_window = timedelta(seconds=app.config.get('CONTACT_DEDUP_SECONDS', 3600))
+        app.extensions['contact_queue'] = self
+
+    def message_writer(self, func):
+        """Register `func(messages, since)` inserting the messages whose id is not
+        stored and whose content_hash was not stored since `since`, in one
+        transaction, and returning how many it inserted"""
+        self._write = func
+        return func
+
+    # ----- submitting -----
+
+    def submit(self, fields, now=None):
+        """Queue a submission; returns (id, duplicate)"""
+        self._ensure_flusher()
+        digest = content_hash(fields)
+        moment = time.monotonic()
+        with self._lock:
+            self._forget_expired(moment)
+            if digest in self._recent:
+                self.metrics['duplicates'] += 1
+                return None, True
+            self._recent[digest] = moment
+            while len(self._recent) > self.max_recent:
+                self._recent.popitem(last=False)
+
+        record = {field: fields.get(field) for field in FIELDS}
+        record.update(id=new_id(), content_hash=digest,
+                      created_at=(now or datetime.utcnow()).isoformat())
+        with self._journal_lock:
+            try:
+                self.journal.append(record)
+            except OSError:
+                with self._lock:
+                    self._recent.pop(digest, None)
+                raise
+            with self._lock:
+                self._pending.append(record)
+                self.metrics['accepted'] += 1
+                full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+        return record['id'], False
+
+    def _forget_expired(self, moment):
+        horizon = moment - self.dedup_window.total_seconds()
+        while self._recent:
+            digest, accepted = next(iter(self._recent.items()))
+            if accepted >= horizon:
+                break
+            del self._recent[digest]
+
+    # ----- flushing -----
+
+    def _app_context(self):
+        return self.app.app_context()
+
+    def _ensure_flusher(self):
+        # One flusher thread per worker process (re-created after fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.journal.open()
+            self._pending = []
+            self._recent.clear()
+            thread = threading.Thread(target=self._flush_loop, name='contact-flush', daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def _flush_loop(self):
+        self._replay_orphans()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.metrics['flush_errors'] += 1
+                self.app.logger.exception('contact flush failed')
+                time.sleep(self.flush_interval)
+
+    def _write_batch(self, batch):
+        with self._app_context():
+            inserted = self._write(batch, datetime.utcnow() - self.dedup_window)
+        self.metrics['dropped'] += len(batch) - inserted
+        return inserted
+
+    def flush(self):
+        """Write pending submissions in batches; returns how many were inserted"""
+        written = 0
+        while True:
+            with self._lock:
+                batch = self._pending[:self.batch_size]
+            if not batch:
+                return written
+            written += self._write_batch(batch)
+            with self._journal_lock:
+                with self._lock:
+                    del self._pending[:len(batch)]
+                    remaining = list(self._pending)
+                    self.metrics['flushed'] += len(batch)
+                    self.metrics['batches'] += 1
+                # Committed, so only the unflushed tail needs to stay in the journal
+                self.journal.rewrite(remaining)
+
+    def _replay_orphans(self):
+        for path in self.journal.orphans():
+            claimed = Journal.claim(path)
+            if claimed is None:
+                continue
+            records, release = claimed
+            for start in range(0, len(records), self.batch_size):
+                self._write_batch(records[start:start + self.batch_size])
+            self.metrics['replayed'] += len(records)
+            release()
+
+    def status(self):
+        self._ensure_flusher()
+        with self._lock:
+            pending = len(self._pending)
+            recent = len(self._recent)
+        return {**self.metrics, 'pending': pending, 'recent_hashes': recent}
@@ -0,0 +1,337 @@
+"""
+Live class capacity events for The Fitness Revolution API
+
+Booking changes publish (class_id, enrolled_count) deltas that are pushed to
+browsers over Server-Sent Events instead of clients polling GET /api/classes.
+
+Every worker keeps an in-process fan-out of subscriber queues. Events travel
+between gunicorn workers through a broker: the SQLite event log is a local
+stand-in for an external broker, tailed by a single relay thread per worker,
+so idle connections cost one small queue each and never touch the database.
+
+Flask streams with a blocking generator (a thread per open stream); asgi.py
+streams from an asyncio subscription fed by the same relay thread, so one
+uvicorn worker holds thousands of idle streams.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+
+from shared_store import SharedSQLite, sqlite_path_from_url
+
+
+class Subscription:
+    """A single SSE client's queue of pending events"""
+
+    def __init__(self, class_ids=None, maxsize=256):
+        self.class_ids = set(class_ids) if class_ids else None
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def wants(self, event):
+        return self.class_ids is None or event['class_id'] in self.class_ids
+
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # Slow client; it is disconnected and resumes with Last-Event-ID
+            self.overflowed = True
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscription(Subscription):
+    """A subscription read from an asyncio event loop"""
+
+    def __init__(self, loop, class_ids=None, maxsize=256):
+        self.class_ids = set(class_ids) if class_ids else None
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def push(self, event):
+        # Called from the relay (or a publishing) thread
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            self.overflowed = True      # event loop closed
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+# ============================================
+# BROKERS
+# ============================================
+
+class Broker:
+    """Transports events between processes and fans them out locally"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, class_ids=None, loop=None):
+        """A queue of matching events; an AsyncSubscription on `loop` if given"""
+        subscription = AsyncSubscription(loop, class_ids) if loop else Subscription(class_ids)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def _fan_out(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            if subscription.wants(event):
+                subscription.push(event)
+
+    def publish(self, class_id, enrolled_count, max_participants):
+        raise NotImplementedError
+
+    def replay(self, after_id, class_ids=None):
+        """Events newer than `after_id` still held by the broker"""
+        return []
+
+
+class MemoryBroker(Broker):
+    """Single-process broker; events never leave this worker"""
+
+    def __init__(self):
+        super().__init__()
+        self._ids = itertools.count(1)
+
+    def publish(self, class_id, enrolled_count, max_participants):
+        self._fan_out({
+            'id': next(self._ids),
+            'class_id': class_id,
+            'enrolled_count': enrolled_count,
+            'max_participants': max_participants
+        })
+
+
+class SQLiteBroker(Broker):
+    """Cross-worker broker backed by an append-only SQLite event log"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS capacity_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            class_id TEXT NOT NULL,
+            enrolled_count INTEGER NOT NULL,
+            max_participants INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        );
+    """
+
+    POLL_INTERVAL = 0.25
+    RETENTION_SECONDS = 600
+
+    def __init__(self, path):
+        super().__init__()
+        self.db = SharedSQLite(path, self.SCHEMA)
+        # Id of the last event relayed; None while nobody is subscribed
+        self._last_id = None
+        self._relay_pid = None
+        self._relay_lock = threading.Lock()
+
+    def publish(self, class_id, enrolled_count, max_participants):
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT INTO capacity_events (class_id, enrolled_count, max_participants, created_at) '
+                'VALUES (?, ?, ?, ?)',
+                (class_id, enrolled_count, max_participants, now)
+            )
+            conn.execute('DELETE FROM capacity_events WHERE created_at < ?',
+                         (now - self.RETENTION_SECONDS,))
+
+    def subscribe(self, class_ids=None, loop=None):
+        self._ensure_relay()
+        try:
+            tail = self._tail()
+        except Exception:
+            tail = None     # the relay takes the tail on its next poll instead
+        subscription = AsyncSubscription(loop, class_ids) if loop else Subscription(class_ids)
+        with self._lock:
+            # The first subscriber starts the relay at the log's tail as of now,
+            # so events published before the relay's next poll still reach it
+            if self._last_id is None:
+                self._last_id = tail
+            self._subscribers.add(subscription)
+        return subscription
+
+    def _tail(self):
+        return self.db.execute('SELECT MAX(id) FROM capacity_events').fetchone()[0] or 0
+
+    def replay(self, after_id, class_ids=None):
+        rows = self.db.execute(
+            'SELECT id, class_id, enrolled_count, max_participants FROM capacity_events '
+            'WHERE id > ? ORDER BY id', (after_id,)
+        ).fetchall()
+        events = [self._row_to_event(row) for row in rows]
+        if class_ids:
+            events = [e for e in events if e['class_id'] in class_ids]
+        return events
+
+    @staticmethod
+    def _row_to_event(row):
+        return {
+            'id': row[0],
+            'class_id': row[1],
+            'enrolled_count': row[2],
+            'max_participants': row[3]
+        }
+
+    def _ensure_relay(self):
+        # One relay thread per worker process (re-created after fork)
+        if self._relay_pid == os.getpid():
+            return
+        with self._relay_lock:
+            if self._relay_pid == os.getpid():
+                return
+            thread = threading.Thread(target=self._relay, name='capacity-relay', daemon=True)
+            thread.start()
+            self._relay_pid = os.getpid()
+
+    def _relay(self):
+        while True:
+            time.sleep(self.POLL_INTERVAL)
+            with self._lock:
+                if not self._subscribers:
+                    # Nobody listening: don't poll; the next subscriber sets the tail
+                    self._last_id = None
+                    continue
+                last_id = self._last_id
+            try:
+                if last_id is None:
+                    tail = self._tail()
+                    with self._lock:
+                        if self._last_id is None:
+                            self._last_id = tail
+                    continue
+                rows = self.db.execute(
+                    'SELECT id, class_id, enrolled_count, max_participants FROM capacity_events '
+                    'WHERE id > ? ORDER BY id', (last_id,)
+                ).fetchall()
+            except Exception:
+                continue
+            for row in rows:
+                self._fan_out(self._row_to_event(row))
+            if rows:
+                with self._lock:
+                    if self._last_id is not None:
+                        self._last_id = max(self._last_id, rows[-1][0])
+
+
+BROKER_FACTORIES = {
+    'memory': lambda url: MemoryBroker(),
+    'sqlite': lambda url: SQLiteBroker(sqlite_path_from_url(url))
+}
+
+
+# ============================================
+# CAPACITY FEED
+# ============================================
+
+class CapacityFeed:
+    """Publishes class capacity changes and streams them as SSE"""
+
+    KEEPALIVE_SECONDS = 15
+
+    def __init__(self, app=None):
+        self.broker = None
+        if app is not None:
+            self.init_app(app)
+
+    @staticmethod
+    def register_broker(scheme, factory):
+        """Make a broker available under `scheme://` URLs"""
+        BROKER_FACTORIES[scheme] = factory
+
+    def init_app(self, app):
+        url = app.config.get('EVENTS_BROKER_URL', 'memory://')
+        scheme = url.split(':', 1)[0]
+        if scheme not in BROKER_FACTORIES:
+            raise ValueError(f'No event broker registered for {scheme!r}')
+        self.broker = BROKER_FACTORIES[scheme](url)
+        app.extensions['capacity_feed'] = self
+
+    def publish(self, class_):
+        """Announce the current enrolled_count of a class (call after commit)"""
+        try:
+            self.broker.publish(class_.id, class_.enrolled_count, class_.max_participants)
+        except Exception:
+            # Live updates are best effort; the booking itself already committed
+            pass
+
+    def stream(self, class_ids=None, last_event_id=None):
+        """Generator of SSE frames for one client"""
+        subscription = self.broker.subscribe(class_ids)
+        try:
+            yield 'retry: 3000\n\n'
+            last_sent = 0
+            if last_event_id:
+                for event in self.broker.replay(last_event_id, class_ids):
+                    last_sent = event['id']
+                    yield self._frame(event)
+            while not subscription.overflowed:
+                event = subscription.get(timeout=self.KEEPALIVE_SECONDS)
+                if event is None:
+                    yield ': keep-alive\n\n'
+                elif event['id'] > last_sent:
+                    yield self._frame(event)
+        finally:
+            self.broker.unsubscribe(subscription)
+
+    async def stream_async(self, class_ids=None, last_event_id=None):
+        """Async generator of SSE frames for one client (see asgi.py)"""
+        subscription = self.broker.subscribe(class_ids, loop=asyncio.get_running_loop())
+        try:
+            yield 'retry: 3000\n\n'
+            last_sent = 0
+            if last_event_id:
+                for event in await asyncio.to_thread(self.broker.replay, last_event_id, class_ids):
+                    last_sent = event['id']
+                    yield self._frame(event)
+            while not subscription.overflowed:
+                event = await subscription.get(timeout=self.KEEPALIVE_SECONDS)
+                if event is None:
+                    yield ': keep-alive\n\n'
+                elif event['id'] > last_sent:
+                    yield self._frame(event)
+        finally:
+            self.broker.unsubscribe(subscription)
+
+    @staticmethod
+    def _frame(event):
+        data = json.dumps({
+            'class_id': event['class_id'],
+            'enrolled_count': event['enrolled_count'],
+            'available_spots': event['max_participants'] - event['enrolled_count']
+        })
+        return f"id: {event['id']}\nevent: capacity\ndata: {data}\n\n"
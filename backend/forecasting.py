@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+The Fitness Revolution - class occupancy forecasting
+
+Fits a fill-rate model on past classes and stores the predicted occupancy and
+a suggested max_participants for every upcoming class in the
+occupancy_forecasts table, so GET /api/admin/forecasts/occupancy only reads
+precomputed rows.
+
+A class's fill rate is its demand (seat-holding bookings plus members still
+on the waitlist) over its capacity. It is modelled with a ridge regression,
+solved with NumPy over every past class at once, on:
+    program, weekday and time slot    one-hot effects
+    trailing fill                     mean fill of the previous 4 and 12
+                                      classes of the same program, weekday
+                                      and time slot (windowed aggregates)
+    trend                             years since the start of the history
+Recent classes weigh more (HALF_LIFE_DAYS). The suggested capacity covers the
+predicted demand plus a safety margin from the slot's forecast error, so it
+is exceeded about one class in ten.
+
+Usage:
+    python forecasting.py                 # forecast once
+    python forecasting.py --watch --interval 86400
+    python forecasting.py --history-days 365 --dry-run
+"""
+
+import argparse
+import json
+import logging
+import math
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func
+
+from app import app, db, Class, Booking, ArchivedClass, ArchivedBooking, OccupancyForecast, each_database
+
+logger = logging.getLogger('forecasting')
+
+# Start hours bounding the time slots (before 8, 8-11, ... 20 and later)
+SLOT_BOUNDS = (8, 11, 14, 17, 20)
+SLOTS = ('early_morning', 'morning', 'midday', 'afternoon', 'evening', 'night')
+WINDOWS = (4, 12)
+HALF_LIFE_DAYS = 180
+RIDGE_PENALTY = 1.0
+# Classes in the last HOLDOUT_DAYS are held out once to measure the error
+HOLDOUT_DAYS = 28
+# Forecast errors of a slot are shrunk towards the overall error as if it had
+# this many more classes
+ERROR_PRIOR_WEIGHT = 5
+# One-sided z for the suggested capacity (90% of classes fit)
+SERVICE_Z = 1.2816
+CHUNK_SIZE = 5000
+
+# Process-wide counters for the last run
+metrics = {'last_run_at': None, 'last_duration_ms': None, 'classes': 0, 'forecasts': 0,
+           'holdout_mae': None, 'baseline_mae': None}
+
+
+def class_rows(table, bookings_table, since, until):
+    """(id, branch_id, program_id, date, start_time, max_participants, demand)
+    of active classes dated since..until-1 in one table pair"""
+    booked = db.session.query(bookings_table.c.class_id, func.count().label('booked')) \
+        .filter(bookings_table.c.status.in_(Booking.SEAT_HOLDING_STATUSES)) \
+        .group_by(bookings_table.c.class_id).subquery()
+    return db.session.query(
+        table.c.id, table.c.branch_id, table.c.program_id, table.c.date, table.c.start_time,
+        table.c.max_participants, func.coalesce(booked.c.booked, 0) + table.c.waitlist_count
+    ).outerjoin(booked, booked.c.class_id == table.c.id).filter(
+        table.c.date >= since, table.c.date < until, table.c.is_active == True
+    ).all()
+
+
+def load_classes(since, until, archived=True):
+    """Rows of live (and archived) classes from every database"""
+    rows = []
+    pairs = [(Class.__table__, Booking.__table__)]
+    if archived:
+        pairs.append((ArchivedClass.__table__, ArchivedBooking.__table__))
+    for _ in each_database():
+        for table, bookings_table in pairs:
+            rows.extend(tuple(row) for row in class_rows(table, bookings_table, since, until))
+    return rows
+
+
+def encode(rows, program_index, origin):
+    """Column arrays of class rows: program, weekday, slot, cell, day, capacity, demand"""
+    programs = np.array([program_index.get(row[2], -1) for row in rows], dtype=np.int64)
+    days = np.array([(row[3] - origin).days for row in rows], dtype=np.int64)
+    hours = np.array([row[4].hour for row in rows], dtype=np.int64)
+    capacity = np.array([max(row[5] or 0, 1) for row in rows], dtype=np.float64)
+    demand = np.array([row[6] or 0 for row in rows], dtype=np.float64)
+    weekdays = (days + origin.weekday()) % 7
+    slots = np.searchsorted(SLOT_BOUNDS, hours, side='right')
+    cells = (programs * 7 + weekdays) * len(SLOTS) + slots
+    return {'program': programs, 'weekday': weekdays, 'slot': slots, 'cell': cells,
+            'day': days, 'capacity': capacity, 'demand': demand}
+
+
+def trailing_means(cells, values, window):
+    """Mean of the previous `window` values of the same cell for every row
+    (rows sorted by cell, then date); NaN for a cell's first row"""
+    count = len(values)
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    index = np.arange(count)
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    group_start = np.repeat(starts, np.diff(np.r_[starts, count]))
+    taken = np.minimum(index - group_start, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums[index] - sums[index - taken]) / taken
+
+
+def latest_means(cells, values, window, wanted):
+    """Mean of the last `window` values of each cell in `wanted` (rows sorted
+    by cell, then date); NaN for cells without history"""
+    means = np.full(len(wanted), np.nan)
+    if not len(cells):
+        return means
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    ends = np.r_[starts[1:], len(cells)]
+    taken = np.minimum(ends - starts, window)
+    cell_means = (sums[ends] - sums[ends - taken]) / taken
+    position = np.searchsorted(cells[starts], wanted)
+    found = (position < len(starts)) & (cells[starts][np.minimum(position, len(starts) - 1)] == wanted)
+    means[found] = cell_means[position[found]]
+    return means
+
+
+def design_matrix(data, trailing, prior, program_count):
+    """Features: intercept, one-hot program/weekday/slot, trailing fills with
+    history flags and trend"""
+    count = len(data['day'])
+    onehots = []
+    for key, width in (('program', program_count), ('weekday', 7), ('slot', len(SLOTS))):
+        block = np.zeros((count, width))
+        valid = data[key] >= 0
+        block[np.flatnonzero(valid), data[key][valid]] = 1.0
+        onehots.append(block)
+    columns = [np.ones((count, 1))] + onehots
+    for means in trailing:
+        known = ~np.isnan(means)
+        columns.append(np.where(known, means, prior)[:, None])
+        columns.append(known[:, None].astype(np.float64))
+    columns.append((data['day'] / 365.0)[:, None])
+    return np.hstack(columns)
+
+
+def fit_ridge(features, target, weights, penalty=RIDGE_PENALTY):
+    """Weighted ridge coefficients (the intercept is not penalized)"""
+    root = np.sqrt(weights)[:, None]
+    weighted = features * root
+    gram = weighted.T @ weighted
+    regularizer = np.full(features.shape[1], penalty)
+    regularizer[0] = 0.0
+    gram[np.diag_indices_from(gram)] += regularizer
+    return np.linalg.solve(gram, weighted.T @ (target * root[:, 0]))
+
+
+def train(history, program_count, window_end):
+    """Fit on history (sorted by cell, then day); returns (model, report)"""
+    fill = history['demand'] / history['capacity']
+    weights = 0.5 ** ((window_end - history['day']) / HALF_LIFE_DAYS)
+    prior = float(np.average(fill, weights=weights))
+    trailing = [trailing_means(history['cell'], fill, window) for window in WINDOWS]
+    features = design_matrix(history, trailing, prior, program_count)
+
+    report = {}
+    holdout = history['day'] >= window_end - HOLDOUT_DAYS
+    if holdout.any() and (~holdout).sum() > features.shape[1]:
+        coefficients = fit_ridge(features[~holdout], fill[~holdout], weights[~holdout])
+        predicted = np.clip(features[holdout] @ coefficients, 0.0, None)
+        seats = history['capacity'][holdout]
+        report['holdout_classes'] = int(holdout.sum())
+        report['holdout_mae'] = round(float(np.mean(np.abs(predicted - fill[holdout]) * seats)), 3)
+        # Naive baseline: the slot's last 4 classes
+        naive = np.where(np.isnan(trailing[0][holdout]), prior, trailing[0][holdout])
+        report['baseline_mae'] = round(float(np.mean(np.abs(naive - fill[holdout]) * seats)), 3)
+
+    coefficients = fit_ridge(features, fill, weights)
+    residuals = fill - features @ coefficients
+    total = np.sum(weights * (fill - prior) ** 2)
+    report['r2'] = round(float(1 - np.sum(weights * residuals ** 2) / total), 4) if total > 0 else None
+
+    # Per-slot forecast error, shrunk towards the overall error
+    overall = float(np.mean(residuals ** 2))
+    cells, inverse, counts = np.unique(history['cell'], return_inverse=True, return_counts=True)
+    squared = np.bincount(inverse, weights=residuals ** 2)
+    errors = np.sqrt((squared + ERROR_PRIOR_WEIGHT * overall) / (counts + ERROR_PRIOR_WEIGHT))
+    model = {'coefficients': coefficients, 'prior': prior, 'fill': fill,
+             'error_cells': cells, 'errors': errors, 'overall_error': math.sqrt(overall)}
+    return model, report
+
+
+def predict(model, history, upcoming, program_count):
+    """(fill rate, demand in seats, suggested capacity) arrays for upcoming classes"""
+    trailing = [latest_means(history['cell'], model['fill'], window, upcoming['cell']) for window in WINDOWS]
+    features = design_matrix(upcoming, trailing, model['prior'], program_count)
+    fill = np.clip(features @ model['coefficients'], 0.0, None)
+
+    error = np.full(len(fill), model['overall_error'])
+    position = np.searchsorted(model['error_cells'], upcoming['cell'])
+    position = np.minimum(position, max(len(model['error_cells']) - 1, 0))
+    if len(model['error_cells']):
+        known = model['error_cells'][position] == upcoming['cell']
+        error[known] = model['errors'][position[known]]
+
+    demand = fill * upcoming['capacity']
+    suggested = np.maximum(np.ceil((fill + SERVICE_Z * error) * upcoming['capacity']), 1)
+    return fill, demand, suggested.astype(np.int64)
+
+
+def refresh_forecasts(history_days=730, horizon_days=28, dry_run=False):
+    """Fit on past classes and store forecasts for upcoming ones"""
+    started = time.perf_counter()
+    run_started_at = datetime.utcnow()
+    today = date.today()
+    origin = today - timedelta(days=history_days)
+
+    history_rows = load_classes(origin, today)
+    upcoming_rows = load_classes(today, today + timedelta(days=horizon_days), archived=False)
+    report = {'classes': len(history_rows), 'upcoming': len(upcoming_rows), 'dry_run': dry_run}
+    report['loaded_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+    program_ids = sorted({row[2] for row in history_rows if row[2]}, key=str)
+    program_index = {program_id: i for i, program_id in enumerate(program_ids)}
+    history = encode(history_rows, program_index, origin)
+    if len(history_rows) < 2 * len(SLOTS) or not upcoming_rows:
+        report['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        report['forecasts'] = 0
+        return report
+
+    order = np.lexsort((history['day'], history['cell']))
+    history = {key: values[order] for key, values in history.items()}
+    model, fit_report = train(history, len(program_ids), (today - origin).days)
+    report.update(fit_report)
+
+    upcoming = encode(upcoming_rows, program_index, origin)
+    fill, demand, suggested = predict(model, history, upcoming, len(program_ids))
+    report['fitted_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+    rows = [{
+        'class_id': row[0],
+        'branch_id': row[1],
+        'program_id': row[2],
+        'class_date': row[3],
+        'start_time': row[4],
+        'max_participants': row[5],
+        'predicted_bookings': round(float(demand[i]), 2),
+        'predicted_fill_rate': round(float(fill[i]), 4),
+        'suggested_capacity': int(suggested[i]),
+        'generated_at': run_started_at
+    } for i, row in enumerate(upcoming_rows)]
+
+    if not dry_run:
+        table = OccupancyForecast.__table__
+        for start in range(0, len(rows), CHUNK_SIZE):
+            chunk = rows[start:start + CHUNK_SIZE]
+            db.session.execute(table.delete().where(table.c.class_id.in_([r['class_id'] for r in chunk])))
+            db.session.execute(table.insert(), chunk)
+        # Classes that were cancelled or have taken place since the last run
+        db.session.execute(table.delete().where(table.c.generated_at < run_started_at))
+        db.session.commit()
+
+    report['forecasts'] = len(rows)
+    report['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    metrics.update(last_run_at=run_started_at.isoformat(), last_duration_ms=report['duration_ms'],
+                   classes=len(history_rows), forecasts=len(rows),
+                   holdout_mae=report.get('holdout_mae'), baseline_mae=report.get('baseline_mae'))
+    logger.info('forecast %s classes from %s past classes in %sms (holdout MAE %s seats)',
+                len(rows), len(history_rows), report['duration_ms'], report.get('holdout_mae'))
+    return report
+
+
+def run_continuously(interval=86400, history_days=730, horizon_days=28):
+    """Refresh every `interval` seconds"""
+    while True:
+        try:
+            with app.app_context():
+                refresh_forecasts(history_days, horizon_days)
+        except Exception:
+            logger.exception('occupancy forecast failed')
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Forecast class occupancy and suggest capacities')
+    parser.add_argument('--history-days', type=int, default=None, help='Days of past classes to learn from')
+    parser.add_argument('--horizon-days', type=int, default=None, help='Days of upcoming classes to forecast')
+    parser.add_argument('--watch', action='store_true', help='Keep refreshing')
+    parser.add_argument('--interval', type=int, default=86400, help='Seconds between refreshes with --watch')
+    parser.add_argument('--dry-run', action='store_true', help='Fit and forecast without storing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    history_days = args.history_days or app.config['FORECAST_HISTORY_DAYS']
+    horizon_days = args.horizon_days or app.config['FORECAST_HORIZON_DAYS']
+
+    if args.watch:
+        run_continuously(args.interval, history_days, horizon_days)
+        return
+
+    with app.app_context():
+        report = refresh_forecasts(history_days, horizon_days, dry_run=args.dry_run)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
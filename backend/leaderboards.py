@@ -0,0 +1,542 @@
+"""
+Workout and calorie leaderboards for The Fitness Revolution API
+
+Weekly, monthly and all-time boards rank members by the workouts_completed
+and calories_burned of their progress logs. Each worker keeps every board in
+memory as an order-statistics list, so "top K" and "my rank" are answered in
+O(log n) without touching the database, even with hundreds of thousands of
+members on a board.
+
+Boards are maintained incrementally: a new progress log is published to a
+pluggable event store and added to the boards of every worker (the SQLite
+store is shared by the gunicorn workers on a host and tailed by a sync
+thread). Every LEADERBOARD_REBUILD_INTERVAL seconds, and when a week or month
+rolls over, the boards are rebuilt from the progress_logs table, so anything
+missed along the way is corrected. A rebuild leaves the most recent logs out
+of its snapshot and replays their events instead: a log can commit well after
+its created_at, and a snapshot cut at "now" would miss it without the event
+being counted either.
+
+The app supplies the totals used for rebuilds with a decorator:
+
+    @leaderboards.totals_loader
+    def load(periods, created_before): ...
+        # periods: [(since, until), ...] log_date ranges (None = unbounded)
+        # -> [(user_id, workouts_0, calories_0, workouts_1, calories_1, ...)]
+        #    over logs created before `created_before` (naive UTC)
+"""
+
+import bisect
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from shared_store import SharedSQLite, sqlite_path_from_url
+
+METRICS = ('workouts', 'calories')
+PERIODS = ('week', 'month', 'all')
+
+
+def period_bounds(period, day):
+    """(key, since, until) of the `period` containing `day`"""
+    if period == 'week':
+        since = day - timedelta(days=day.weekday())
+        year, week, _ = day.isocalendar()
+        return f'{year}-W{week:02d}', since, since + timedelta(days=7)
+    if period == 'month':
+        since = day.replace(day=1)
+        until = (since + timedelta(days=32)).replace(day=1)
+        return since.strftime('%Y-%m'), since, until
+    if period == 'all':
+        return 'all', None, None
+    raise ValueError(f'Unknown leaderboard period {period!r}')
+
+
+def _epoch(moment):
+    # Progress log timestamps are naive UTC
+    return moment.replace(tzinfo=timezone.utc).timestamp()
+
+
+# ============================================
+# ORDER-STATISTICS LIST
+# ============================================
+
+class RankedList:
+    """Sorted list with O(log n) positional lookups
+
+    Keys are kept in chunks of at most 2 * LOAD sorted keys. A Fenwick tree
+    over the chunk lengths turns a chunk index into the number of keys before
+    it (and a position into a chunk) in O(log n); inside a chunk it's a bisect.
+    """
+
+    LOAD = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self._chunks = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self._maxes = [chunk[-1] for chunk in self._chunks]
+        self._len = len(keys)
+        self._reindex()
+
+    def __len__(self):
+        return self._len
+
+    def _reindex(self):
+        # O(number of chunks) Fenwick build; only needed when chunks split or vanish
+        tree = [0] + [len(chunk) for chunk in self._chunks]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _grow(self, index, amount):
+        tree = self._tree
+        index += 1
+        while index < len(tree):
+            tree[index] += amount
+            index += index & -index
+
+    def _keys_before(self, index):
+        """Number of keys in the chunks before chunk `index`"""
+        tree, total = self._tree, 0
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+    def _locate(self, position):
+        """(chunk index, offset in chunk) of the key at `position`"""
+        tree, index = self._tree, 0
+        step = 1 << (len(tree).bit_length() - 1)
+        while step:
+            ahead = index + step
+            if ahead < len(tree) and tree[ahead] <= position:
+                index = ahead
+                position -= tree[ahead]
+            step >>= 1
+        return index, position
+
+    def add(self, key):
+        if not self._chunks:
+            self._chunks, self._maxes, self._len = [[key]], [key], 1
+            self._reindex()
+            return
+        index = bisect.bisect_left(self._maxes, key)
+        if index == len(self._chunks):
+            index -= 1
+            self._chunks[index].append(key)
+            self._maxes[index] = key
+        else:
+            bisect.insort(self._chunks[index], key)
+        self._len += 1
+        chunk = self._chunks[index]
+        if len(chunk) > 2 * self.LOAD:
+            self._chunks[index:index + 1] = [chunk[:self.LOAD], chunk[self.LOAD:]]
+            self._maxes[index:index + 1] = [chunk[self.LOAD - 1], chunk[-1]]
+            self._reindex()
+        else:
+            self._grow(index, 1)
+
+    def remove(self, key):
+        index = bisect.bisect_left(self._maxes, key)
+        chunk = self._chunks[index] if index < len(self._chunks) else ()
+        offset = bisect.bisect_left(chunk, key)
+        if offset == len(chunk) or chunk[offset] != key:
+            raise KeyError(key)
+        del chunk[offset]
+        self._len -= 1
+        if chunk:
+            self._maxes[index] = chunk[-1]
+            self._grow(index, -1)
+        else:
+            del self._chunks[index], self._maxes[index]
+            self._reindex()
+
+    def index(self, key):
+        """Number of keys less than `key`"""
+        index = bisect.bisect_left(self._maxes, key)
+        if index == len(self._chunks):
+            return self._len
+        return self._keys_before(index) + bisect.bisect_left(self._chunks[index], key)
+
+    def slice(self, start, stop):
+        """Keys at positions start..stop-1"""
+        stop = min(stop, self._len)
+        if start >= stop:
+            return []
+        index, offset = self._locate(start)
+        keys = []
+        while len(keys) < stop - start:
+            keys.extend(self._chunks[index][offset:offset + stop - start - len(keys)])
+            index, offset = index + 1, 0
+        return keys
+
+
+class Board:
+    """Scores of one metric over one period, ranked highest first
+
+    Ties share a rank (1, 2, 2, 4). Members with no positive score are unranked.
+    """
+
+    def __init__(self, scores=None):
+        self.scores = {member: score for member, score in (scores or {}).items() if score}
+        self.ranked = RankedList((-score, member) for member, score in self.scores.items() if score > 0)
+
+    def add(self, member, amount):
+        old = self.scores.get(member, 0)
+        new = old + amount
+        if old > 0:
+            self.ranked.remove((-old, member))
+        if new > 0:
+            self.ranked.add((-new, member))
+        self.scores[member] = new
+
+    def __len__(self):
+        return len(self.ranked)
+
+    def rank(self, member):
+        """(rank, score); rank is None if the member is unranked"""
+        score = self.scores.get(member, 0)
+        if score <= 0:
+            return None, score
+        # (-score,) sorts before every (-score, member) key
+        return self.ranked.index((-score,)) + 1, score
+
+    def top(self, limit, offset=0):
+        """[(rank, member, score), ...] of positions offset..offset+limit-1"""
+        entries, rank, previous = [], None, None
+        for position, (negative, member) in enumerate(self.ranked.slice(offset, offset + limit), offset):
+            if negative != previous:
+                rank = position + 1 if rank is not None else self.ranked.index((negative,)) + 1
+                previous = negative
+            entries.append((rank, member, -negative))
+        return entries
+
+
+# ============================================
+# EVENT STORES
+# ============================================
+
+class LeaderboardStore:
+    """Interface for progress event storage backends
+
+    Events are (origin, user_id, log_date ISO string, workouts, calories,
+    created_at epoch seconds).
+    """
+
+    # True if other processes write to the store and it must be polled
+    shared = False
+    # Epoch seconds since which the store has every event
+    started_at = 0.0
+
+    def publish(self, event):
+        raise NotImplementedError
+
+    def changes(self, after):
+        """(cursor, [event, ...]) for events published after `after`"""
+        raise NotImplementedError
+
+    def created_since(self, moment):
+        """(cursor, [event, ...]) of every stored event created at or after
+        `moment`; the cursor is the latest event in the store"""
+        raise NotImplementedError
+
+    def prune(self, before):
+        """Forget events created before `before`"""
+        raise NotImplementedError
+
+
+class MemoryLeaderboardStore(LeaderboardStore):
+    """Recent events of this process; only correct with a single worker"""
+
+    def __init__(self):
+        self._events = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def publish(self, event):
+        with self._lock:
+            self._seq += 1
+            self._events.append((self._seq, event))
+
+    def changes(self, after):
+        # Every event came from this process and was applied when published
+        return after, []
+
+    def created_since(self, moment):
+        with self._lock:
+            return self._seq, [event for _, event in self._events if event[5] >= moment]
+
+    def prune(self, before):
+        with self._lock:
+            self._events = [(seq, event) for seq, event in self._events if event[5] >= before]
+
+
+class SQLiteLeaderboardStore(LeaderboardStore):
+    """Event log in a SQLite file shared by all workers on the host"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leaderboard_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            log_date TEXT NOT NULL,
+            workouts INTEGER NOT NULL,
+            calories INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_leaderboard_events_created_at ON leaderboard_events (created_at);
+        CREATE TABLE IF NOT EXISTS leaderboard_store (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            started_at REAL NOT NULL
+        );
+    """
+    COLUMNS = 'seq, origin, user_id, log_date, workouts, calories, created_at'
+
+    shared = True
+
+    def __init__(self, path):
+        self.db = SharedSQLite(path, self.SCHEMA)
+        # The file outlives worker restarts; it has every event since it was created
+        with self.db.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO leaderboard_store (id, started_at) VALUES (1, ?)', (time.time(),))
+            self.started_at = conn.execute('SELECT started_at FROM leaderboard_store').fetchone()[0]
+
+    def publish(self, event):
+        with self.db.transaction() as conn:
+            conn.execute('INSERT INTO leaderboard_events (origin, user_id, log_date, workouts, calories, '
+                         'created_at) VALUES (?, ?, ?, ?, ?, ?)', event)
+
+    def changes(self, after):
+        rows = self.db.execute(
+            f'SELECT {self.COLUMNS} FROM leaderboard_events WHERE seq > ? ORDER BY seq', (after,)
+        ).fetchall()
+        cursor = rows[-1][0] if rows else after
+        return cursor, [row[1:] for row in rows]
+
+    def created_since(self, moment):
+        with self.db.transaction() as conn:
+            cursor = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM leaderboard_events').fetchone()[0]
+            rows = conn.execute(
+                f'SELECT {self.COLUMNS} FROM leaderboard_events WHERE created_at >= ? AND seq <= ? ORDER BY seq',
+                (moment, cursor)
+            ).fetchall()
+        return cursor, [row[1:] for row in rows]
+
+    def prune(self, before):
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM leaderboard_events WHERE created_at < ?', (before,))
+
+
+# Storage URL scheme -> factory(url). Register more (e.g. redis) with
+# Leaderboards.register_store().
+STORE_FACTORIES = {
+    'memory': lambda url: MemoryLeaderboardStore(),
+    'sqlite': lambda url: SQLiteLeaderboardStore(sqlite_path_from_url(url))
+}
+
+
+# ============================================
+# LEADERBOARDS
+# ============================================
+
+class Leaderboards:
+    """Every period's boards, kept current by progress events and rebuilds"""
+
+    # Events are kept this long; a rebuild only replays the recent ones
+    EVENT_RETENTION = 3600
+    # Logs created this recently are left out of a rebuild's snapshot and
+    # replayed from their events, which covers a log committed up to this
+    # long after its created_at (a slower one waits for the next rebuild)
+    REPLAY_OVERLAP = 300
+
+    def __init__(self, app=None):
+        self.app = None
+        self.store = None
+        self.sync_interval = 1.0
+        self.rebuild_interval = 3600
+        self._load_totals = None
+        self._boards = {}           # period -> (key, {metric: Board})
+        self._cursor = 0
+        # Logs created before this moment (epoch seconds) are in the current boards
+        self._watermark = 0.0
+        self._origin = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._sync_pid = None
+        self._rebuilt_at = 0.0
+        self.metrics = {'events': 0, 'synced': 0, 'rebuilds': 0, 'last_rebuild_ms': None,
+                        'last_rebuild_at': None, 'errors': 0}
+        if app is not None:
+            self.init_app(app)
+
+    @staticmethod
+    def register_store(scheme, factory):
+        """Make a storage backend available under `scheme://` URLs"""
+        STORE_FACTORIES[scheme] = factory
+
+    def init_app(self, app):
+        self.app = app
+        url = app.config.get('LEADERBOARD_STORAGE_URL', 'memory://')
+        scheme = url.split(':', 1)[0]
+        if scheme not in STORE_FACTORIES:
+            raise ValueError(f'No leaderboard store registered for {scheme!r}')
+        self.store = STORE_FACTORIES[scheme](url)
+        self.sync_interval = app.config.get('LEADERBOARD_SYNC_INTERVAL', 1.0)
+        self.rebuild_interval = app.config.get('LEADERBOARD_REBUILD_INTERVAL', 3600)
+        app.extensions['leaderboards'] = self
+
+    def totals_loader(self, func):
+        """Register `func(periods, created_before)` returning per-member totals"""
+        self._load_totals = func
+        return func
+
+    # ----- reads -----
+
+    def board(self, metric, period, day=None):
+        """(period key, Board) for the current `period`"""
+        if metric not in METRICS:
+            raise ValueError(f'Unknown leaderboard metric {metric!r}')
+        key = period_bounds(period, day or datetime.utcnow().date())[0]
+        self._ensure_sync()
+        current_key, boards = self._boards.get(period, (None, None))
+        if current_key != key:
+            # Rolled over and the sync thread hasn't rebuilt yet: nobody has scored
+            return key, Board()
+        return key, boards[metric]
+
+    def top(self, metric, period, limit=10, offset=0):
+        """(period key, members on the board, [(rank, user_id, score), ...])"""
+        key, board = self.board(metric, period)
+        with self._lock:
+            return key, len(board), board.top(limit, offset)
+
+    def rank(self, metric, period, user_id):
+        """(period key, members on the board, rank or None, score)"""
+        key, board = self.board(metric, period)
+        with self._lock:
+            rank, score = board.rank(user_id)
+            return key, len(board), rank, score
+
+    # ----- writes -----
+
+    def record(self, user_id, log_date, workouts, calories, created_at):
+        """Add a committed progress log to every board (call after commit)"""
+        if not workouts and not calories:
+            return
+        self._ensure_sync()
+        event = (self._origin, user_id, log_date.isoformat(), workouts or 0, calories or 0, _epoch(created_at))
+        # Publishing and applying under one lock keeps a concurrent rebuild
+        # from replaying this event into boards that already have it
+        with self._lock:
+            self.store.publish(event)
+            self._apply(self._boards, event)
+        self.metrics['events'] += 1
+
+    def _apply(self, boards, event):
+        _, user_id, log_date, workouts, calories, created_at = event
+        if created_at < self._watermark:
+            # Counted by the rebuild that produced these boards
+            return
+        day = datetime.strptime(log_date, '%Y-%m-%d').date()
+        for period, (key, period_boards) in boards.items():
+            if period_bounds(period, day)[0] != key:
+                continue
+            if workouts:
+                period_boards['workouts'].add(user_id, workouts)
+            if calories:
+                period_boards['calories'].add(user_id, calories)
+
+    # ----- rebuilding -----
+
+    def rebuild(self):
+        """Rebuild every board from the database; returns a report"""
+        self._ensure_sync()
+        return self._rebuild()
+
+    def _rebuild(self):
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        today = now.date()
+        # The snapshot stops short of now; later logs come from the event store,
+        # as far back as it reaches
+        overlap = min(self.REPLAY_OVERLAP, max(_epoch(now) - self.store.started_at, 0))
+        created_before = now - timedelta(seconds=overlap)
+        bounds = [period_bounds(period, today) for period in PERIODS]
+        # One pass over progress_logs for every period
+        with self.app.app_context():
+            rows = self._load_totals([(since, until) for _, since, until in bounds], created_before)
+        boards = {}
+        for column, (period, (key, _, _)) in enumerate(zip(PERIODS, bounds)):
+            workouts, calories = 1 + 2 * column, 2 + 2 * column
+            boards[period] = (key, {
+                'workouts': Board({row[0]: row[workouts] or 0 for row in rows}),
+                'calories': Board({row[0]: row[calories] or 0 for row in rows})
+            })
+        with self._lock:
+            # Logs created since the snapshot's cut are replayed from their events
+            self._watermark = _epoch(created_before)
+            cursor, events = self.store.created_since(self._watermark)
+            for event in events:
+                self._apply(boards, event)
+            self._boards = boards
+            self._cursor = cursor
+        self._rebuilt_at = time.monotonic()
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        self.metrics.update(rebuilds=self.metrics['rebuilds'] + 1, last_rebuild_ms=duration_ms,
+                            last_rebuild_at=now.isoformat())
+        return {'periods': {period: {'key': key, 'workouts': len(b['workouts']), 'calories': len(b['calories'])}
+                            for period, (key, b) in boards.items()},
+                'replayed': len(events), 'duration_ms': duration_ms}
+
+    def _stale(self):
+        today = datetime.utcnow().date()
+        if time.monotonic() - self._rebuilt_at > self.rebuild_interval:
+            return True
+        return any(self._boards.get(period, (None,))[0] != period_bounds(period, today)[0] for period in PERIODS)
+
+    def _sync(self):
+        with self._lock:
+            cursor, events = self.store.changes(self._cursor)
+            foreign = [event for event in events if event[0] != self._origin]
+            for event in foreign:
+                self._apply(self._boards, event)
+            self._cursor = cursor
+        self.metrics['synced'] += len(foreign)
+
+    def _ensure_sync(self):
+        # One sync thread per worker process (re-created after fork)
+        if self._sync_pid == os.getpid():
+            return
+        with self._sync_lock:
+            if self._sync_pid == os.getpid():
+                return
+            self._origin = f'{os.getpid()}-{uuid.uuid4().hex[:12]}'
+            # Build the boards before the first read is answered
+            self._rebuild()
+            thread = threading.Thread(target=self._sync_loop, name='leaderboard-sync', daemon=True)
+            thread.start()
+            self._sync_pid = os.getpid()
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                if self.store.shared:
+                    self._sync()
+                if self._stale():
+                    self._rebuild()
+                    self.store.prune(time.time() - self.EVENT_RETENTION)
+            except Exception:
+                self.metrics['errors'] += 1
+                self.app.logger.exception('leaderboard sync failed')
+
+    def status(self):
+        self._ensure_sync()
+        return {**self.metrics, 'cursor': self._cursor,
+                'periods': {period: {'key': key, 'workouts': len(b['workouts']), 'calories': len(b['calories'])}
+                            for period, (key, b) in self._boards.items()}}
@@ -0,0 +1,224 @@
+"""
+Profile images for The Fitness Revolution API
+
+Uploads are stored content-addressed: an image's key is the SHA-256 of the
+uploaded bytes, so the same photo uploaded twice (or by two accounts) is
+stored and processed once. Each upload is decoded once and resized into a
+few variants, each encoded as WebP and JPEG, in a pool of worker threads
+(Pillow releases the GIL while resizing and encoding). Only the variants are
+served: they carry no EXIF metadata, and a URL never changes content, so
+they are sent with a one-year immutable Cache-Control.
+
+    MEDIA_ROOT/originals/ab/<key>            as uploaded, for regenerating variants
+    MEDIA_ROOT/ab/<key>-<variant>.<ext>      served under MEDIA_URL
+
+User.profile_image holds the key. Values that aren't keys (URLs set before
+uploads existed) are passed through unchanged.
+"""
+
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# name -> (longest edge in pixels, cropped to a square)
+VARIANTS = {
+    'thumb': (96, True),
+    'card': (400, True),
+    'large': (1200, False)
+}
+
+# URL extension -> (Pillow format, mimetype)
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg')
+}
+
+ACCEPTED_FORMATS = {'JPEG', 'PNG', 'WEBP', 'GIF'}
+
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+FILENAME_PATTERN = re.compile(r'^([0-9a-f]{64})-([a-z]+)\.([a-z]+)$')
+
+
+class MediaError(Exception):
+    """An upload that can't be accepted; carries the HTTP status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def image_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_image_key(value):
+    return isinstance(value, str) and KEY_PATTERN.match(value) is not None
+
+
+def render_variant(image, size, square):
+    """Resized copy of `image` (never enlarged)"""
+    if square:
+        edge = min(size, image.width, image.height)
+        # Faces sit above the middle of most portraits
+        return ImageOps.fit(image, (edge, edge), Image.LANCZOS, centering=(0.5, 0.4))
+    resized = image.copy()
+    resized.thumbnail((size, size), Image.LANCZOS)
+    return resized
+
+
+def encode(image, fmt, quality):
+    buffer = io.BytesIO()
+    if fmt == 'JPEG':
+        if image.mode != 'RGB':
+            # JPEG has no alpha: flatten onto white
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+            image = background
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, 'WEBP', quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def write_atomically(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=directory, prefix='.upload-')
+    try:
+        with os.fdopen(handle, 'wb') as temp:
+            temp.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+class ImageStore:
+    """Stores uploads by content hash and renders their variants in a pool"""
+
+    def __init__(self, app=None):
+        self.root = 'media'
+        self.url_prefix = '/media'
+        self.max_bytes = 10 * 1024 * 1024
+        self.max_pixels = 40_000_000
+        self.quality = 82
+        self.workers = 4
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.metrics = {'uploads': 0, 'deduplicated': 0, 'rejected': 0, 'variants_written': 0,
+                        'bytes_uploaded': 0, 'bytes_written': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config.get('MEDIA_ROOT', 'media')
+        self.url_prefix = app.config.get('MEDIA_URL', '/media').rstrip('/')
+        self.max_bytes = app.config.get('MEDIA_MAX_UPLOAD_BYTES', 10 * 1024 * 1024)
+        self.max_pixels = app.config.get('MEDIA_MAX_PIXELS', 40_000_000)
+        self.quality = app.config.get('MEDIA_QUALITY', 82)
+        self.workers = app.config.get('MEDIA_WORKERS', 4)
+        app.extensions['media'] = self
+
+    # ----- paths and URLs -----
+
+    def variant_path(self, key, variant, ext):
+        return os.path.join(self.root, key[:2], f'{key}-{variant}.{ext}')
+
+    def original_path(self, key):
+        return os.path.join(self.root, 'originals', key[:2], key)
+
+    def url(self, value, variant='card', ext='jpg'):
+        """URL of one variant of an image key; other values unchanged"""
+        if not is_image_key(value):
+            return value
+        return f'{self.url_prefix}/{value}-{variant}.{ext}'
+
+    def urls(self, value):
+        """{variant: {'webp': url, 'jpg': url}} for an image key, else None"""
+        if not is_image_key(value):
+            return None
+        return {variant: {ext: self.url(value, variant, ext) for ext in FORMATS} for variant in VARIANTS}
+
+    def locate(self, filename):
+        """(path, mimetype) of a served variant file name, or None"""
+        match = FILENAME_PATTERN.match(filename)
+        if not match or match.group(2) not in VARIANTS or match.group(3) not in FORMATS:
+            return None
+        key, variant, ext = match.groups()
+        path = self.variant_path(key, variant, ext)
+        return (path, FORMATS[ext][1]) if os.path.exists(path) else None
+
+    # ----- uploads -----
+
+    def _executor(self):
+        # Threads don't survive fork: one pool per worker process
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='media')
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _stored(self, key):
+        return all(os.path.exists(self.variant_path(key, variant, ext))
+                   for variant in VARIANTS for ext in FORMATS)
+
+    def store(self, data):
+        """Store uploaded image bytes; returns (key, deduplicated). Raises MediaError."""
+        if len(data) > self.max_bytes:
+            self.metrics['rejected'] += 1
+            raise MediaError(f'Images are limited to {self.max_bytes // (1024 * 1024)} MB', 413)
+        key = image_key(data)
+        self.metrics['uploads'] += 1
+        self.metrics['bytes_uploaded'] += len(data)
+        if self._stored(key):
+            self.metrics['deduplicated'] += 1
+            return key, True
+
+        image = self._decode(data)
+        write_atomically(self.original_path(key), data)
+        jobs = [self._executor().submit(self._write_variant, image, key, variant, size, square)
+                for variant, (size, square) in VARIANTS.items()]
+        for job in jobs:
+            job.result()
+        return key, False
+
+    def _decode(self, data):
+        try:
+            image = Image.open(io.BytesIO(data))
+            if image.format not in ACCEPTED_FORMATS:
+                raise MediaError('Upload a JPEG, PNG, WebP or GIF image', 415)
+            if image.width * image.height > self.max_pixels:
+                raise MediaError('Image dimensions are too large', 413)
+            # JPEGs decode straight at a reduced scale when far bigger than needed
+            largest = max(size for size, _ in VARIANTS.values())
+            image.draft('RGB', (largest, largest))
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        except MediaError:
+            self.metrics['rejected'] += 1
+            raise
+        except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+            self.metrics['rejected'] += 1
+            raise MediaError('Not a readable image', 415)
+        return image
+
+    def _write_variant(self, image, key, variant, size, square):
+        resized = render_variant(image, size, square)
+        for ext, (fmt, _) in FORMATS.items():
+            encoded = encode(resized, fmt, self.quality)
+            write_atomically(self.variant_path(key, variant, ext), encoded)
+            self.metrics['variants_written'] += 1
+            self.metrics['bytes_written'] += len(encoded)
+
+    def status(self):
+        return dict(self.metrics)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+The Fitness Revolution - migrate a database to compact keys
+
+Databases created before ids became 16-byte values (see keys.py) store them
+as 36-character text. This copies such a database into a new one created from
+the current models, converting every id and foreign key on the way. Existing
+ids keep their value, so tokens, links and API clients are unaffected.
+
+The copy runs while the old database keeps serving traffic: every table is
+read in primary key order in small chunks, each written to the target in its
+own transaction, and chunks already present in the target are skipped, so the
+copy can be interrupted and resumed. To switch over:
+
+    1. python migrate_keys.py --source sqlite:///old.db --target sqlite:///new.db
+       (repeat as often as you like while the app is running)
+    2. stop writes (maintenance mode or stop the workers)
+    3. python migrate_keys.py --source ... --target ... --sync
+       (only rows that changed since the copy are written)
+    4. point DATABASE_URL at the target and restart
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import sqlalchemy as sa
+
+from app import db
+from keys import CompactUUID, parse_uuid
+
+logger = logging.getLogger('migrate_keys')
+
+
+def _normalize(target_column, value):
+    """Source value as the target column returns it"""
+    if isinstance(target_column.type, CompactUUID) and value is not None:
+        value = parse_uuid(value)
+        return str(value) if value is not None else None
+    return value
+
+
+def migrate_table(source, target, table, batch_size=1000, sync=False):
+    """Copy one table from `source` to `target`; returns per-table counts
+
+    With `sync`, rows that differ are updated and rows missing from the
+    source are deleted from the target as well.
+    """
+    source_table = sa.Table(table.name, sa.MetaData(), autoload_with=source)
+    columns = [c.name for c in table.columns if c.name in source_table.c]
+    pk = table.primary_key.columns.values()[0].name
+    counts = {'copied': 0, 'updated': 0, 'deleted': 0, 'skipped': 0}
+
+    last = None
+    while True:
+        query = sa.select(*[source_table.c[name] for name in columns]) \
+            .order_by(source_table.c[pk]).limit(batch_size)
+        if last is not None:
+            query = query.where(source_table.c[pk] > last)
+        with source.connect() as conn:
+            chunk = [dict(row) for row in conn.execute(query).mappings()]
+        is_last = len(chunk) < batch_size
+
+        rows = {}
+        for row in chunk:
+            converted = {name: _normalize(table.c[name], row[name]) for name in columns}
+            if converted[pk] is None:
+                counts['skipped'] += 1
+                logger.warning('%s: skipping row with malformed id %r', table.name, row[pk])
+                continue
+            rows[converted[pk]] = converted
+
+        with target.begin() as conn:
+            # Target rows for the same key range (text and binary UUIDs sort alike)
+            existing = sa.select(*[table.c[name] for name in columns])
+            if last is not None:
+                existing = existing.where(table.c[pk] > _normalize(table.c[pk], last))
+            if not is_last:
+                existing = existing.where(table.c[pk] <= _normalize(table.c[pk], chunk[-1][pk]))
+            if not sync:
+                existing = existing.where(table.c[pk].in_(list(rows)))
+            current = {row[pk]: dict(row) for row in conn.execute(existing).mappings()}
+
+            missing = [row for key, row in rows.items() if key not in current]
+            if missing:
+                conn.execute(table.insert(), missing)
+                counts['copied'] += len(missing)
+
+            if sync:
+                changed = [row for key, row in rows.items() if key in current and current[key] != row]
+                for row in changed:
+                    conn.execute(table.update().where(table.c[pk] == row[pk]).values(**row))
+                counts['updated'] += len(changed)
+                gone = [key for key in current if key not in rows]
+                if gone:
+                    conn.execute(table.delete().where(table.c[pk].in_(gone)))
+                    counts['deleted'] += len(gone)
+
+        if is_last:
+            break
+        last = chunk[-1][pk]
+
+    return counts
+
+
+def migrate(source_url, target_url, batch_size=1000, sync=False):
+    """Copy every model table present in the source; returns a report dict"""
+    started = time.perf_counter()
+    source = sa.create_engine(source_url)
+    target = sa.create_engine(target_url)
+    db.metadata.create_all(target)
+
+    source_tables = set(sa.inspect(source).get_table_names())
+    report = {'sync': sync, 'tables': {}}
+    for table in db.metadata.sorted_tables:
+        if table.name not in source_tables:
+            continue
+        table_started = time.perf_counter()
+        counts = migrate_table(source, target, table, batch_size, sync)
+        counts['duration_ms'] = round((time.perf_counter() - table_started) * 1000, 2)
+        report['tables'][table.name] = counts
+        logger.info('%s: %s', table.name, counts)
+
+    report['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy a database with text ids into one with compact keys')
+    parser.add_argument('--source', required=True, help='Database URL with 36-character text ids')
+    parser.add_argument('--target', required=True, help='Database URL to create or resume')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Rows per chunk')
+    parser.add_argument('--sync', action='store_true', help='Also update changed rows and delete removed ones')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    report = migrate(args.source, args.target, args.batch_size, args.sync)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
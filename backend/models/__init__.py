@@ -2,22 +2,41 @@
 Database models for The Fitness Revolution
 """
 
+from .branch import Branch
 from .user import User
-from .membership import Membership
-from .trainer import Trainer
-from .program import Program, Class, Booking
+from .membership import Membership, MembershipChange
+from .trainer import Trainer, TrainerReview
+from .program import Program, Class, Booking, WaitlistEntry
+from .archive import ArchivedClass, ArchivedBooking
 from .meal_plan import MealPlan
+from .personal_meal_plan import PersonalMealPlan
 from .progress import ProgressLog
-from .contact import ContactMessage
+from .contact import ContactMessage, Counter
+from .recommendation import Recommendation
+from .forecast import OccupancyForecast
+from .calendar_feed import CalendarFeed
+from .revenue import RevenueSnapshot
 
 __all__ = [
+    'Branch',
     'User',
     'Membership', 
+    'MembershipChange',
     'Trainer',
+    'TrainerReview',
     'Program',
     'Class',
     'Booking',
+    'WaitlistEntry',
+    'ArchivedClass',
+    'ArchivedBooking',
     'MealPlan',
+    'PersonalMealPlan',
     'ProgressLog',
-    'ContactMessage'
+    'ContactMessage',
+    'Counter',
+    'Recommendation',
+    'OccupancyForecast',
+    'CalendarFeed',
+    'RevenueSnapshot'
 ]
@@ -0,0 +1,58 @@
+"""
+Archive models for The Fitness Revolution
+"""
+
+from app import db
+from datetime import datetime
+from keys import CompactUUID
+
+class ArchivedClass(db.Model):
+    """Past class moved out of `classes` by archive.py"""
+    __tablename__ = 'archived_classes'
+    __table_args__ = (
+        db.Index('ix_archived_classes_date', 'date', 'start_time'),
+        db.Index('ix_archived_classes_branch_date', 'branch_id', 'date'),
+    )
+    
+    # Same columns as Class, without foreign keys
+    id = db.Column(CompactUUID, primary_key=True)
+    branch_id = db.Column(CompactUUID)
+    program_id = db.Column(CompactUUID)
+    trainer_id = db.Column(CompactUUID)
+    date = db.Column(db.Date, nullable=False)
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    location = db.Column(db.String(100))
+    is_virtual = db.Column(db.Boolean, default=False)
+    meeting_link = db.Column(db.String(255))
+    max_participants = db.Column(db.Integer, default=20)
+    enrolled_count = db.Column(db.Integer, default=0)
+    waitlist_tail = db.Column(db.Integer, default=0, nullable=False)
+    waitlist_count = db.Column(db.Integer, default=0, nullable=False)
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime)
+    
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ArchivedBooking(db.Model):
+    """Booking of an archived class"""
+    __tablename__ = 'archived_bookings'
+    __table_args__ = (
+        db.Index('ix_archived_bookings_user_booked_at', 'user_id', 'booked_at'),
+        db.Index('ix_archived_bookings_class', 'class_id'),
+        db.Index('ix_archived_bookings_branch_booked_at', 'branch_id', 'booked_at'),
+    )
+    
+    # Same columns as Booking, without foreign keys
+    id = db.Column(CompactUUID, primary_key=True)
+    user_id = db.Column(CompactUUID)
+    class_id = db.Column(CompactUUID)
+    branch_id = db.Column(CompactUUID)
+    status = db.Column(db.String(20))
+    booked_at = db.Column(db.DateTime)
+    cancelled_at = db.Column(db.DateTime)
+    attended = db.Column(db.Boolean, default=False)
+    checked_in_at = db.Column(db.DateTime)
+    
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,32 @@
+"""
+Branch model for The Fitness Revolution
+"""
+
+from app import db
+from datetime import datetime
+from keys import CompactUUID, new_id
+
+class Branch(db.Model):
+    """Gym location (branch) model"""
+    __tablename__ = 'branches'
+    
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    code = db.Column(db.String(20), unique=True, nullable=False)  # short slug, e.g. blr-indiranagar
+    name = db.Column(db.String(100), nullable=False)
+    city = db.Column(db.String(100))
+    address = db.Column(db.Text)
+    phone = db.Column(db.String(20))
+    
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'code': self.code,
+            'name': self.name,
+            'city': self.city,
+            'address': self.address,
+            'phone': self.phone,
+            'is_active': self.is_active
+        }
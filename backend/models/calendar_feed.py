@@ -0,0 +1,27 @@
+"""
+Calendar feed model for The Fitness Revolution
+"""
+
+from app import db
+from datetime import datetime
+from keys import CompactUUID
+
+
+class CalendarFeed(db.Model):
+    """Secret iCalendar feed of a member's bookings or a trainer's classes"""
+    __tablename__ = 'calendar_feeds'
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'owner_id', name='uq_calendar_feeds_owner'),
+    )
+    
+    token_hash = db.Column(db.String(64), primary_key=True)  # sha256 of the URL token
+    kind = db.Column(db.String(20), nullable=False)  # member, trainer
+    owner_id = db.Column(CompactUUID, nullable=False)  # users.id or trainers.id
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'owner_id': self.owner_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
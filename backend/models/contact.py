@@ -4,21 +4,22 @@ Contact Message model for The Fitness Revolution
 
 from app import db
 from datetime import datetime
-import uuid
+from keys import CompactUUID, new_id
 
 class ContactMessage(db.Model):
     """Contact form messages"""
     __tablename__ = 'contact_messages'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), nullable=False)
     phone = db.Column(db.String(20))
     subject = db.Column(db.String(200))
     message = db.Column(db.Text, nullable=False)
+    content_hash = db.Column(db.String(64), index=True)  # for dropping resubmissions
     
     is_read = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     def to_dict(self):
         return {
@@ -31,3 +32,10 @@ class ContactMessage(db.Model):
             'is_read': self.is_read,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
+
+class Counter(db.Model):
+    """Denormalized counts, updated in the transactions that change what they count"""
+    __tablename__ = 'counters'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
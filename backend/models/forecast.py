@@ -0,0 +1,39 @@
+"""
+Occupancy forecast model for The Fitness Revolution
+"""
+
+from app import db
+from datetime import datetime
+from keys import CompactUUID
+
+
+class OccupancyForecast(db.Model):
+    """Predicted demand and suggested capacity per upcoming class, written by forecasting.py"""
+    __tablename__ = 'occupancy_forecasts'
+    
+    # Not a foreign key: the class may live in a branch database
+    class_id = db.Column(CompactUUID, primary_key=True)
+    branch_id = db.Column(CompactUUID, index=True)
+    program_id = db.Column(CompactUUID)
+    class_date = db.Column(db.Date, nullable=False, index=True)
+    start_time = db.Column(db.Time, nullable=False)
+    max_participants = db.Column(db.Integer)  # when forecast
+    predicted_bookings = db.Column(db.Float, nullable=False)  # bookings plus waitlist
+    predicted_fill_rate = db.Column(db.Float, nullable=False)  # can exceed 1 when oversubscribed
+    suggested_capacity = db.Column(db.Integer, nullable=False)
+    generated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def to_dict(self):
+        return {
+            'class_id': self.class_id,
+            'branch_id': self.branch_id,
+            'program_id': self.program_id,
+            'date': self.class_date.isoformat() if self.class_date else None,
+            'start_time': self.start_time.isoformat() if self.start_time else None,
+            'max_participants': self.max_participants,
+            'predicted_bookings': self.predicted_bookings,
+            'predicted_fill_rate': self.predicted_fill_rate,
+            'suggested_capacity': self.suggested_capacity,
+            'capacity_change': self.suggested_capacity - (self.max_participants or 0),
+            'generated_at': self.generated_at.isoformat() if self.generated_at else None
+        }
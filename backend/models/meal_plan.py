@@ -4,13 +4,13 @@ Meal Plan model for The Fitness Revolution
 
 from app import db
 from datetime import datetime
-import uuid
+from keys import CompactUUID, new_id
 
 class MealPlan(db.Model):
     """Nutrition meal plans model"""
     __tablename__ = 'meal_plans'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     category = db.Column(db.String(50))  # weight_loss, muscle_gain, vegetarian, maintenance
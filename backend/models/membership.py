@@ -4,13 +4,17 @@ Membership model for The Fitness Revolution
 
 from app import db
 from datetime import datetime
-import uuid
+from keys import CompactUUID, new_id
 
 class Membership(db.Model):
     """Membership plans model"""
     __tablename__ = 'memberships'
+    __table_args__ = (
+        db.Index('ix_memberships_branch_active', 'branch_id', 'is_active'),
+    )
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    branch_id = db.Column(CompactUUID, db.ForeignKey('branches.id'))  # None = all branches
     name = db.Column(db.String(50), nullable=False)  # Basic, Premium, Elite
     description = db.Column(db.Text)
     price_monthly = db.Column(db.Float, nullable=False)
@@ -25,8 +29,8 @@ class Membership(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # Relationships
-    users = db.relationship('User', backref='membership', lazy=True)
+    # Relationships (a query: plans can have many thousands of members)
+    users = db.relationship('User', backref='membership', lazy='dynamic')
     
     def to_dict(self):
         import json
@@ -40,5 +44,51 @@ class Membership(db.Model):
             'features': json.loads(self.features) if self.features else [],
             'not_included': json.loads(self.not_included) if self.not_included else [],
             'is_popular': self.is_popular,
+            'branch_id': self.branch_id,
             'is_active': self.is_active
         }
+    
+    def monthly_revenue(self, billing_cycle):
+        """What one member on this plan brings in per month"""
+        return self.price_yearly / 12 if billing_cycle == 'yearly' else self.price_monthly
+
+class MembershipChange(db.Model):
+    """Log of plan assignments and cancellations, aggregated by revenue.py"""
+    __tablename__ = 'membership_changes'
+    
+    KINDS = ('new', 'renewal', 'upgrade', 'downgrade', 'change', 'cancel')
+    
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'), nullable=False, index=True)
+    from_membership_id = db.Column(CompactUUID, db.ForeignKey('memberships.id'))
+    to_membership_id = db.Column(CompactUUID, db.ForeignKey('memberships.id'))  # None on cancel
+    billing_cycle = db.Column(db.String(10))
+    from_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    to_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    kind = db.Column(db.String(20), nullable=False)
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    @staticmethod
+    def classify(from_membership_id, to_membership_id, from_mrr, to_mrr):
+        if to_membership_id is None:
+            return 'cancel'
+        if from_membership_id is None:
+            return 'new'
+        if to_mrr > from_mrr:
+            return 'upgrade'
+        if to_mrr < from_mrr:
+            return 'downgrade'
+        return 'renewal' if from_membership_id == to_membership_id else 'change'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'from_membership_id': self.from_membership_id,
+            'to_membership_id': self.to_membership_id,
+            'billing_cycle': self.billing_cycle,
+            'from_mrr': self.from_mrr,
+            'to_mrr': self.to_mrr,
+            'kind': self.kind,
+            'changed_at': self.changed_at.isoformat() if self.changed_at else None
+        }
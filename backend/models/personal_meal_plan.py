@@ -0,0 +1,30 @@
+"""
+Personal meal plan model for The Fitness Revolution
+"""
+
+from app import db
+from datetime import datetime
+from keys import CompactUUID
+
+
+class PersonalMealPlan(db.Model):
+    """Generated daily meal plans per member, written by nutrition.py"""
+    __tablename__ = 'personal_meal_plans'
+    
+    # User fields the targets are computed from
+    PROFILE_FIELDS = ('height', 'weight', 'date_of_birth', 'gender', 'activity_level', 'fitness_goal')
+    
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'), primary_key=True)
+    profile_hash = db.Column(db.String(40), nullable=False)
+    targets = db.Column(db.Text, nullable=False)  # JSON: daily calories and macro grams
+    days = db.Column(db.Text, nullable=False)  # JSON: [{day, meals, totals}, ...]
+    generated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def to_dict(self):
+        import json
+        return {
+            'user_id': self.user_id,
+            'targets': json.loads(self.targets),
+            'days': json.loads(self.days),
+            'generated_at': self.generated_at.isoformat() if self.generated_at else None
+        }
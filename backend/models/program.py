@@ -4,13 +4,13 @@ Program, Class, and Booking models for The Fitness Revolution
 
 from app import db
 from datetime import datetime
-import uuid
+from keys import CompactUUID, new_id
 
 class Program(db.Model):
     """Fitness programs/classes model"""
     __tablename__ = 'programs'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     category = db.Column(db.String(50))  # HIIT, Yoga, Strength, Cardio
@@ -46,10 +46,15 @@ class Program(db.Model):
 class Class(db.Model):
     """Scheduled classes model"""
     __tablename__ = 'classes'
+    __table_args__ = (
+        db.Index('ix_classes_date_start_time', 'date', 'start_time'),
+        db.Index('ix_classes_branch_date_start_time', 'branch_id', 'date', 'start_time'),
+    )
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    program_id = db.Column(db.String(36), db.ForeignKey('programs.id'))
-    trainer_id = db.Column(db.String(36), db.ForeignKey('trainers.id'))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    branch_id = db.Column(CompactUUID, db.ForeignKey('branches.id'))
+    program_id = db.Column(CompactUUID, db.ForeignKey('programs.id'))
+    trainer_id = db.Column(CompactUUID, db.ForeignKey('trainers.id'))
     
     # Schedule
     date = db.Column(db.Date, nullable=False)
@@ -65,6 +70,10 @@ class Class(db.Model):
     max_participants = db.Column(db.Integer, default=20)
     enrolled_count = db.Column(db.Integer, default=0)
     
+    # Waitlist (tail is the last position handed out)
+    waitlist_tail = db.Column(db.Integer, default=0, nullable=False)
+    waitlist_count = db.Column(db.Integer, default=0, nullable=False)
+    
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -74,6 +83,7 @@ class Class(db.Model):
     def to_dict(self):
         return {
             'id': self.id,
+            'branch_id': self.branch_id,
             'program': self.program.to_dict() if self.program else None,
             'trainer': self.trainer.to_dict() if self.trainer else None,
             'date': self.date.isoformat() if self.date else None,
@@ -84,6 +94,7 @@ class Class(db.Model):
             'max_participants': self.max_participants,
             'enrolled_count': self.enrolled_count,
             'available_spots': self.max_participants - self.enrolled_count,
+            'waitlist_count': self.waitlist_count or 0,
             'is_active': self.is_active
         }
 
@@ -91,23 +102,72 @@ class Class(db.Model):
 class Booking(db.Model):
     """Class booking model"""
     __tablename__ = 'bookings'
+    __table_args__ = (
+        db.Index('ix_bookings_class_status', 'class_id', 'status'),
+        db.Index('ix_bookings_branch_status_booked_at', 'branch_id', 'status', 'booked_at'),
+    )
+    
+    # Statuses that occupy a seat and count towards Class.enrolled_count
+    # (a no-show still held the seat until the class started)
+    SEAT_HOLDING_STATUSES = ('confirmed', 'attended', 'no_show')
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = db.Column(db.String(36), db.ForeignKey('users.id'))
-    class_id = db.Column(db.String(36), db.ForeignKey('classes.id'))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'))
+    class_id = db.Column(CompactUUID, db.ForeignKey('classes.id'))
+    branch_id = db.Column(CompactUUID, db.ForeignKey('branches.id'))  # copied from the class
     
-    status = db.Column(db.String(20), default='confirmed')  # confirmed, cancelled, attended
+    status = db.Column(db.String(20), default='confirmed')  # confirmed, cancelled, attended, no_show
     booked_at = db.Column(db.DateTime, default=datetime.utcnow)
     cancelled_at = db.Column(db.DateTime)
     attended = db.Column(db.Boolean, default=False)
+    checked_in_at = db.Column(db.DateTime)
     
     def to_dict(self):
         return {
             'id': self.id,
             'user_id': self.user_id,
             'class_id': self.class_id,
+            'branch_id': self.branch_id,
             'class_details': self.class_.to_dict() if self.class_ else None,
             'status': self.status,
             'booked_at': self.booked_at.isoformat() if self.booked_at else None,
-            'attended': self.attended
+            'attended': self.attended,
+            'checked_in_at': self.checked_in_at.isoformat() if self.checked_in_at else None
+        }
+
+
+class WaitlistEntry(db.Model):
+    """Class waitlist entry; members are promoted in position order"""
+    __tablename__ = 'waitlist_entries'
+    __table_args__ = (
+        db.UniqueConstraint('class_id', 'user_id', name='uq_waitlist_class_user'),
+        db.UniqueConstraint('class_id', 'position', name='uq_waitlist_class_position'),
+        db.Index('ix_waitlist_class_status_position', 'class_id', 'status', 'position')
+    )
+    
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    class_id = db.Column(CompactUUID, db.ForeignKey('classes.id'), nullable=False)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'), nullable=False)
+    
+    position = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), default='waiting')  # waiting, promoted, left
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    promoted_at = db.Column(db.DateTime)
+    
+    def people_ahead(self):
+        """Number of members still waiting in front of this entry"""
+        return WaitlistEntry.query.filter(
+            WaitlistEntry.class_id == self.class_id,
+            WaitlistEntry.status == 'waiting',
+            WaitlistEntry.position < self.position
+        ).count()
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'class_id': self.class_id,
+            'user_id': self.user_id,
+            'status': self.status,
+            'joined_at': self.created_at.isoformat() if self.created_at else None,
+            'promoted_at': self.promoted_at.isoformat() if self.promoted_at else None
         }
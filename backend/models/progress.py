@@ -4,14 +4,14 @@ Progress Log model for The Fitness Revolution
 
 from app import db
 from datetime import datetime
-import uuid
+from keys import CompactUUID, new_id
 
 class ProgressLog(db.Model):
     """User fitness progress tracking"""
     __tablename__ = 'progress_logs'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = db.Column(db.String(36), db.ForeignKey('users.id'))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'))
     
     # Measurements
     weight = db.Column(db.Float)
@@ -25,7 +25,8 @@ class ProgressLog(db.Model):
     calories_burned = db.Column(db.Integer)
     
     notes = db.Column(db.Text)
-    log_date = db.Column(db.Date, default=datetime.utcnow)
+    # Indexed for the weekly and monthly leaderboard rebuilds
+    log_date = db.Column(db.Date, default=datetime.utcnow, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def to_dict(self):
@@ -0,0 +1,26 @@
+"""
+Recommendation model for The Fitness Revolution
+"""
+
+from app import db
+from datetime import datetime
+from keys import CompactUUID
+
+
+class Recommendation(db.Model):
+    """Precomputed top programs per member, written by recommendations.py"""
+    __tablename__ = 'recommendations'
+    
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'), primary_key=True)
+    programs = db.Column(db.Text, nullable=False)  # JSON: [{program_id, score, reason}, ...]
+    class_ids = db.Column(db.Text, nullable=False)  # JSON: next open class per program
+    generated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def to_dict(self):
+        import json
+        return {
+            'user_id': self.user_id,
+            'programs': json.loads(self.programs),
+            'class_ids': json.loads(self.class_ids),
+            'generated_at': self.generated_at.isoformat() if self.generated_at else None
+        }
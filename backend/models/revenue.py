@@ -0,0 +1,36 @@
+"""
+Revenue snapshot model for The Fitness Revolution
+"""
+
+from app import db
+from datetime import datetime
+from keys import CompactUUID
+
+
+class RevenueSnapshot(db.Model):
+    """Members, MRR and plan movements per plan per day, written by revenue.py"""
+    __tablename__ = 'revenue_snapshots'
+    __table_args__ = (
+        db.UniqueConstraint('snapshot_date', 'membership_id', name='uq_revenue_snapshots_plan_day'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    snapshot_date = db.Column(db.Date, nullable=False, index=True)
+    membership_id = db.Column(CompactUUID, nullable=False)
+    plan_name = db.Column(db.String(50))  # as of the snapshot
+    active_members = db.Column(db.Integer, nullable=False, default=0)
+    yearly_members = db.Column(db.Integer, nullable=False, default=0)
+    mrr = db.Column(db.Float, nullable=False, default=0.0)
+    
+    # Movements during the day
+    new_members = db.Column(db.Integer, nullable=False, default=0)
+    renewals = db.Column(db.Integer, nullable=False, default=0)
+    upgrades = db.Column(db.Integer, nullable=False, default=0)
+    downgrades = db.Column(db.Integer, nullable=False, default=0)
+    cancellations = db.Column(db.Integer, nullable=False, default=0)
+    expirations = db.Column(db.Integer, nullable=False, default=0)
+    new_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    expansion_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    contraction_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    churned_mrr = db.Column(db.Float, nullable=False, default=0.0)
+    generated_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -2,16 +2,21 @@
 Trainer model for The Fitness Revolution
 """
 
-from app import db
+from app import app, db, image_store
 from datetime import datetime
-import uuid
+from keys import CompactUUID, new_id
 
 class Trainer(db.Model):
     """Trainer model"""
     __tablename__ = 'trainers'
+    __table_args__ = (
+        db.Index('ix_trainers_branch_active', 'branch_id', 'is_active'),
+        db.Index('ix_trainers_active_ranking', 'is_active', 'ranking_score'),
+    )
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = db.Column(db.String(36), db.ForeignKey('users.id'))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'))
+    branch_id = db.Column(CompactUUID, db.ForeignKey('branches.id'))  # home branch
     
     # Professional details
     specialization = db.Column(db.Text)  # JSON array
@@ -23,27 +28,36 @@ class Trainer(db.Model):
     available_days = db.Column(db.Text)  # JSON array
     available_hours = db.Column(db.Text)  # JSON object
     
-    # Rating
+    # Rating, maintained by create_trainer_review
     rating = db.Column(db.Float, default=5.0)
     total_reviews = db.Column(db.Integer, default=0)
+    rating_sum = db.Column(db.Float, default=0.0)
+    ranking_score = db.Column(db.Float, default=lambda: Trainer.smoothed_rating(0.0, 0))
     
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
     classes = db.relationship('Class', backref='trainer', lazy=True)
+    user = db.relationship('User', foreign_keys=[user_id])
+    
+    @staticmethod
+    def smoothed_rating(rating_sum, total_reviews):
+        """Bayesian average rating; takes numbers or column expressions"""
+        weight = app.config['TRAINER_RATING_PRIOR_WEIGHT']
+        return (weight * app.config['TRAINER_RATING_PRIOR_MEAN'] + rating_sum) / (weight + total_reviews)
     
     def to_dict(self):
         import json
-        from .user import User
         
-        user = User.query.get(self.user_id)
+        user = self.user
         return {
             'id': self.id,
             'user_id': self.user_id,
             'name': user.get_full_name() if user else None,
             'email': user.email if user else None,
-            'profile_image': user.profile_image if user else None,
+            'profile_image': image_store.url(user.profile_image) if user else None,
+            'profile_images': image_store.urls(user.profile_image) if user else None,
             'specialization': json.loads(self.specialization) if self.specialization else [],
             'experience_years': self.experience_years,
             'certifications': json.loads(self.certifications) if self.certifications else [],
@@ -51,5 +65,37 @@ class Trainer(db.Model):
             'available_days': json.loads(self.available_days) if self.available_days else [],
             'rating': self.rating,
             'total_reviews': self.total_reviews,
+            'ranking_score': round(self.ranking_score, 3) if self.ranking_score is not None else None,
+            'branch_id': self.branch_id,
             'is_active': self.is_active
         }
+
+
+class TrainerReview(db.Model):
+    """Review of a trainer by a member who attended one of their classes"""
+    __tablename__ = 'trainer_reviews'
+    __table_args__ = (
+        db.UniqueConstraint('trainer_id', 'user_id', name='uq_trainer_reviews_trainer_user'),
+        db.Index('ix_trainer_reviews_trainer_created', 'trainer_id', 'created_at'),
+    )
+    
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    trainer_id = db.Column(CompactUUID, db.ForeignKey('trainers.id'), nullable=False)
+    user_id = db.Column(CompactUUID, db.ForeignKey('users.id'), nullable=False)
+    rating = db.Column(db.Integer, nullable=False)  # 1-5
+    comment = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    user = db.relationship('User')
+    
+    def to_dict(self):
+        user = self.user
+        return {
+            'id': self.id,
+            'trainer_id': self.trainer_id,
+            'user_id': self.user_id,
+            'reviewer': f"{user.first_name} {user.last_name[:1]}." if user else None,
+            'rating': self.rating,
+            'comment': self.comment,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
@@ -4,16 +4,16 @@ User model for The Fitness Revolution
 
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-import uuid
+from keys import CompactUUID, new_id
 
 # Note: db will be imported from app
-from app import db
+from app import db, image_store
 
 class User(db.Model):
     """User model for members, trainers, and admins"""
     __tablename__ = 'users'
     
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
     first_name = db.Column(db.String(50), nullable=False)
@@ -31,9 +31,10 @@ class User(db.Model):
     activity_level = db.Column(db.String(20))  # sedentary, light, moderate, active
     
     # Membership
-    membership_id = db.Column(db.String(36), db.ForeignKey('memberships.id'))
+    membership_id = db.Column(CompactUUID, db.ForeignKey('memberships.id'))
     membership_start = db.Column(db.Date)
-    membership_end = db.Column(db.Date)
+    membership_end = db.Column(db.Date, index=True)
+    membership_billing = db.Column(db.String(10))  # monthly, yearly
     
     # Status
     is_active = db.Column(db.Boolean, default=True)
@@ -56,7 +57,11 @@ class User(db.Model):
             'last_name': self.last_name,
             'phone': self.phone,
             'role': self.role,
+            'profile_image': image_store.url(self.profile_image),
+            'profile_images': image_store.urls(self.profile_image),
             'membership_id': self.membership_id,
+            'membership_billing': self.membership_billing,
+            'membership_end': self.membership_end.isoformat() if self.membership_end else None,
             'is_active': self.is_active,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+The Fitness Revolution - personalized meal plans
+
+Computes each member's daily calorie and macro targets from their profile
+(Mifflin-St Jeor BMR x activity factor, adjusted for the fitness goal) and
+assembles daily plans from the meal library: every meal of every active
+MealPlan, grouped into breakfast, lunch, snack and dinner slots. Each plan is
+one meal per slot, scaled by a common serving factor; the combinations whose
+calories and macros come closest to the member's targets are picked with
+NumPy for a whole chunk of members at once.
+
+Plans are stored per member in personal_meal_plans. update_user regenerates
+a member's plan when a profile field it depends on changes; GET
+/api/meal-plans/personal serves the stored plan and, without writing,
+computes a missing or stale one on demand.
+
+Usage:
+    python nutrition.py                    # plan every member once
+    python nutrition.py --watch            # nightly
+    python nutrition.py --days 3 --dry-run
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import time
+from datetime import date, datetime
+
+import numpy as np
+
+from app import app, db, User, MealPlan, PersonalMealPlan
+
+logger = logging.getLogger('nutrition')
+
+ACTIVITY_FACTORS = {'sedentary': 1.2, 'light': 1.375, 'moderate': 1.55, 'active': 1.725}
+DEFAULT_ACTIVITY_FACTOR = 1.375
+# Mifflin-St Jeor constant; unspecified gender uses the midpoint
+GENDER_OFFSETS = {'male': 5.0, 'female': -161.0}
+DEFAULT_GENDER_OFFSET = -78.0
+# kcal per day added to maintenance calories
+GOAL_ADJUSTMENTS = {'weight_loss': -500.0, 'muscle_gain': 300.0, 'maintenance': 0.0}
+# Protein g per kg of body weight
+PROTEIN_PER_KG = {'weight_loss': 2.0, 'muscle_gain': 2.0, 'maintenance': 1.6}
+DEFAULT_PROTEIN_PER_KG = 1.6
+FAT_SHARE = 0.25
+MIN_CALORIES = 1200.0
+
+KCAL_PER_GRAM = np.array([4.0, 4.0, 9.0], dtype=np.float32)  # protein, carbs, fat
+
+# Meal names in the library -> slot; every plan has one meal per slot
+SLOTS = ('breakfast', 'lunch', 'snack', 'dinner')
+SLOT_ALIASES = {'mid-morning': 'snack', 'evening snack': 'snack', 'pre-workout': 'snack', 'supper': 'dinner'}
+SLOT_TIMES = {'breakfast': '8:00 AM', 'lunch': '1:00 PM', 'snack': '4:00 PM', 'dinner': '8:00 PM'}
+# Share of a day's calories each slot should carry
+SLOT_SHARES = {'breakfast': 0.25, 'lunch': 0.35, 'snack': 0.1, 'dinner': 0.3}
+# Meals per slot that are combined (12 per slot: 20,736 combinations)
+MEALS_PER_SLOT = 12
+
+MIN_SERVINGS, MAX_SERVINGS = 0.5, 2.0
+# Squared relative error weights for calories, protein, carbs, fat
+ERROR_WEIGHTS = np.array([2.0, 1.0, 0.5, 0.5], dtype=np.float32)
+# Cap on members x combinations x nutrients floats per scoring chunk
+CHUNK_CELLS = 4_000_000
+
+# Process-wide counters for the last refresh
+metrics = {'last_run_at': None, 'last_duration_ms': None, 'members': 0, 'planned': 0, 'incomplete': 0}
+
+
+# ============================================
+# TARGETS
+# ============================================
+
+def missing_profile_fields(user):
+    """Profile fields needed for targets that `user` has not filled in"""
+    return [field for field in ('height', 'weight', 'date_of_birth') if not getattr(user, field)]
+
+
+def profile_hash(user):
+    """Fingerprint of the profile fields a plan is based on"""
+    values = [str(getattr(user, field)) for field in PersonalMealPlan.PROFILE_FIELDS]
+    return hashlib.sha1('|'.join(values).encode('utf-8')).hexdigest()
+
+
+def age_on(date_of_birth, today):
+    return today.year - date_of_birth.year - ((today.month, today.day) < (date_of_birth.month, date_of_birth.day))
+
+
+def daily_targets(weight, height, age, gender, activity_level, fitness_goal):
+    """Targets for N members from equal-length sequences
+
+    Returns an N x 4 float32 array of kcal, protein g, carbs g and fat g.
+    """
+    weight = np.asarray(weight, dtype=np.float32)
+    height = np.asarray(height, dtype=np.float32)
+    age = np.asarray(age, dtype=np.float32)
+    offset = np.array([GENDER_OFFSETS.get((g or '').lower(), DEFAULT_GENDER_OFFSET) for g in gender],
+                      dtype=np.float32)
+    factor = np.array([ACTIVITY_FACTORS.get(a, DEFAULT_ACTIVITY_FACTOR) for a in activity_level],
+                      dtype=np.float32)
+    adjustment = np.array([GOAL_ADJUSTMENTS.get(g, 0.0) for g in fitness_goal], dtype=np.float32)
+    protein_per_kg = np.array([PROTEIN_PER_KG.get(g, DEFAULT_PROTEIN_PER_KG) for g in fitness_goal],
+                              dtype=np.float32)
+
+    bmr = 10.0 * weight + 6.25 * height - 5.0 * age + offset
+    calories = np.maximum(bmr * factor + adjustment, MIN_CALORIES)
+    protein = protein_per_kg * weight
+    fat = calories * FAT_SHARE / KCAL_PER_GRAM[2]
+    carbs = np.maximum(calories - protein * KCAL_PER_GRAM[0] - fat * KCAL_PER_GRAM[2], 0.0) / KCAL_PER_GRAM[1]
+    return np.stack([calories, protein, carbs, fat], axis=1)
+
+
+# ============================================
+# MEAL LIBRARY
+# ============================================
+
+def slot_for(meal_name):
+    name = (meal_name or '').strip().lower()
+    name = SLOT_ALIASES.get(name, name)
+    return name if name in SLOTS else None
+
+
+def meal_library(meal_plans):
+    """{slot: [meal, ...]} with per-serving kcal and macro grams
+
+    Meals without their own protein/carbs/fat grams take their plan's macro
+    percentages.
+    """
+    library = {slot: [] for slot in SLOTS}
+    for plan in meal_plans:
+        for meal in json.loads(plan.meals) if plan.meals else []:
+            slot = slot_for(meal.get('name'))
+            calories = meal.get('calories')
+            if slot is None or not calories:
+                continue
+            shares = [plan.protein_percent or 0, plan.carbs_percent or 0, plan.fat_percent or 0]
+            grams = [
+                meal[key] if meal.get(key) is not None else calories * share / 100 / per_gram
+                for key, share, per_gram in zip(('protein', 'carbs', 'fat'), shares, KCAL_PER_GRAM.tolist())
+            ]
+            library[slot].append({
+                'description': meal.get('description'),
+                'meal_plan_id': plan.id,
+                'nutrients': [float(calories)] + [float(g) for g in grams]
+            })
+    return library
+
+
+def slot_candidates(library, limit=MEALS_PER_SLOT):
+    """{slot: [meal index, ...]} of at most `limit` meals per slot
+
+    Servings are scaled per member, so what makes a meal fit is its share of
+    the day: the meals kept are those closest to their slot's SLOT_SHARES of
+    a typical library day (the sum of each slot's median calories).
+    """
+    calories = {slot: np.array([meal['nutrients'][0] for meal in library[slot]], dtype=np.float32)
+                for slot in SLOTS}
+    day = sum(float(np.median(values)) for values in calories.values())
+    candidates = {}
+    for slot, values in calories.items():
+        distance = np.abs(values - SLOT_SHARES[slot] * day)
+        candidates[slot] = np.sort(np.argsort(distance, kind='stable')[:limit]).tolist()
+    return candidates
+
+
+def combinations(library):
+    """Every one-meal-per-slot combination of the slots' candidate meals
+
+    Returns (C x len(SLOTS) meal indexes, C x 4 nutrients per serving).
+    """
+    if any(not library[slot] for slot in SLOTS):
+        return np.zeros((0, len(SLOTS)), dtype=np.intp), np.zeros((0, 4), dtype=np.float32)
+    candidates = slot_candidates(library)
+    picks = np.array(list(itertools.product(*(candidates[slot] for slot in SLOTS))), dtype=np.intp)
+    nutrients = np.zeros((len(picks), 4), dtype=np.float32)
+    for column, slot in enumerate(SLOTS):
+        slot_nutrients = np.array([meal['nutrients'] for meal in library[slot]], dtype=np.float32)
+        nutrients += slot_nutrients[picks[:, column]]
+    return picks, nutrients
+
+
+# ============================================
+# PLANNING
+# ============================================
+
+def choose_combinations(targets, nutrients, days):
+    """Best `days` distinct combinations and their servings for each member
+
+    Each combination is scaled to the member's calorie target (within
+    MIN_SERVINGS..MAX_SERVINGS), then scored by weighted squared relative
+    error against all four targets.
+    """
+    members, count = len(targets), len(nutrients)
+    days = min(days, count)
+    best = np.zeros((members, days), dtype=np.intp)
+    servings = np.zeros((members, days), dtype=np.float32)
+    rows = max(1, CHUNK_CELLS // (count * 4))
+    for start in range(0, members, rows):
+        chunk = targets[start:start + rows]
+        scale = np.clip(chunk[:, :1] / nutrients[None, :, 0], MIN_SERVINGS, MAX_SERVINGS)
+        # Round to quarter servings so plans are practical to follow
+        scale = np.round(scale * 4) / 4
+        scaled = scale[:, :, None] * nutrients[None, :, :]
+        error = (((scaled - chunk[:, None, :]) / chunk[:, None, :]) ** 2 * ERROR_WEIGHTS).sum(axis=2)
+        if days < count:
+            candidates = np.argpartition(error, days - 1, axis=1)[:, :days]
+        else:
+            candidates = np.broadcast_to(np.arange(count), error.shape)
+        order = np.argsort(np.take_along_axis(error, candidates, axis=1), axis=1)
+        chosen = np.take_along_axis(candidates, order, axis=1)
+        best[start:start + len(chunk)] = chosen
+        servings[start:start + len(chunk)] = np.take_along_axis(scale, chosen, axis=1)
+    return best, servings
+
+
+def _rounded(nutrients):
+    calories, protein, carbs, fat = (float(v) for v in nutrients)
+    return {'calories': round(calories), 'protein': round(protein, 1), 'carbs': round(carbs, 1), 'fat': round(fat, 1)}
+
+
+def plan_day(library, picks, nutrients, day, combination, serving):
+    """One daily plan as a dict"""
+    meals = []
+    for column, slot in enumerate(SLOTS):
+        meal = library[slot][picks[combination, column]]
+        meals.append({
+            'name': slot.capitalize(),
+            'time': SLOT_TIMES[slot],
+            'description': meal['description'],
+            'meal_plan_id': meal['meal_plan_id'],
+            'servings': serving,
+            **_rounded(np.array(meal['nutrients']) * serving)
+        })
+    return {'day': day, 'meals': meals, 'totals': _rounded(nutrients[combination] * serving)}
+
+
+def plan_days_json(library, picks, nutrients, chosen, servings, cache):
+    """JSON array of one member's daily plans
+
+    Members share most (day, combination, servings) triples, so each is
+    serialized once per refresh and kept in `cache`.
+    """
+    parts = []
+    for day, (combination, serving) in enumerate(zip(chosen.tolist(), servings.tolist()), start=1):
+        key = (day, combination, serving)
+        if key not in cache:
+            cache[key] = json.dumps(plan_day(library, picks, nutrients, day, combination, serving))
+        parts.append(cache[key])
+    return '[' + ','.join(parts) + ']'
+
+
+def load_library():
+    library = meal_library(MealPlan.query.filter_by(is_active=True).all())
+    picks, nutrients = combinations(library)
+    return library, picks, nutrients
+
+
+def generate_plans(users, days, library=None, cache=None):
+    """{user_id: PersonalMealPlan column values} for users with complete profiles"""
+    if library is None:
+        library = load_library()
+    if cache is None:
+        cache = {}
+    library, picks, nutrients = library
+    users = [u for u in users if not missing_profile_fields(u)]
+    if not users or not len(picks):
+        return {}
+
+    today = date.today()
+    targets = daily_targets(
+        [u.weight for u in users], [u.height for u in users],
+        [age_on(u.date_of_birth, today) for u in users],
+        [u.gender for u in users], [u.activity_level for u in users], [u.fitness_goal for u in users]
+    )
+    chosen, servings = choose_combinations(targets, nutrients, days)
+
+    generated_at = datetime.utcnow()
+    return {
+        user.id: {
+            'user_id': user.id,
+            'profile_hash': profile_hash(user),
+            'targets': json.dumps(_rounded(targets[row])),
+            'days': plan_days_json(library, picks, nutrients, chosen[row], servings[row], cache),
+            'generated_at': generated_at
+        }
+        for row, user in enumerate(users)
+    }
+
+
+def plan_for(user, days):
+    """Stored plan for `user`, or one computed now (not stored) if it is
+    missing or stale; None if the profile is incomplete or the library is empty
+
+    Read-only, so GET requests can be served by a replica.
+    """
+    plan = PersonalMealPlan.query.get(user.id)
+    if plan and plan.profile_hash == profile_hash(user):
+        return plan
+    values = generate_plans([user], days).get(user.id)
+    return PersonalMealPlan(**values) if values else None
+
+
+def store_plan(user, days):
+    """Recompute and store `user`'s plan (the write path: profile updates);
+    drops the stored plan if none can be built"""
+    values = generate_plans([user], days).get(user.id)
+    plan = PersonalMealPlan.query.get(user.id)
+    if values is None:
+        if plan:
+            db.session.delete(plan)
+    elif plan:
+        for key, value in values.items():
+            setattr(plan, key, value)
+    else:
+        plan = PersonalMealPlan(**values)
+        db.session.add(plan)
+    db.session.commit()
+    return plan if values else None
+
+
+def refresh_meal_plans(days=7, chunk_size=2000, dry_run=False):
+    """Recompute and store plans for every active member, a chunk at a time"""
+    started = time.perf_counter()
+    run_started_at = datetime.utcnow()
+    library = load_library()
+    table = PersonalMealPlan.__table__
+    columns = [getattr(User, field) for field in ('id',) + PersonalMealPlan.PROFILE_FIELDS]
+
+    report = {'members': 0, 'planned': 0, 'incomplete': 0, 'combinations': len(library[1]), 'dry_run': dry_run}
+    members = db.session.query(*columns).filter(User.is_active.is_(True), User.role == 'member') \
+        .order_by(User.id)
+    cache = {}
+    chunk = []
+    for row in members.yield_per(chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            _store_chunk(chunk, days, library, cache, table, report, dry_run)
+            chunk = []
+    if chunk:
+        _store_chunk(chunk, days, library, cache, table, report, dry_run)
+
+    if not dry_run and report['planned']:
+        # Members who left, or whose profile is no longer complete
+        db.session.execute(table.delete().where(table.c.generated_at < run_started_at))
+        db.session.commit()
+
+    report['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    metrics.update(last_run_at=run_started_at.isoformat(), last_duration_ms=report['duration_ms'],
+                   members=report['members'], planned=report['planned'], incomplete=report['incomplete'])
+    logger.info('meal plans for %s of %s members in %sms', report['planned'], report['members'],
+                report['duration_ms'])
+    return report
+
+
+def _store_chunk(chunk, days, library, cache, table, report, dry_run):
+    plans = generate_plans(chunk, days, library, cache)
+    report['members'] += len(chunk)
+    report['planned'] += len(plans)
+    report['incomplete'] += len(chunk) - len(plans)
+    if dry_run or not plans:
+        return
+    db.session.execute(table.delete().where(table.c.user_id.in_(list(plans))))
+    db.session.execute(table.insert(), list(plans.values()))
+    db.session.commit()
+
+
+def run_continuously(interval=86400, days=7):
+    """Refresh every `interval` seconds (nightly by default)"""
+    while True:
+        try:
+            with app.app_context():
+                refresh_meal_plans(days)
+        except Exception:
+            logger.exception('meal plan refresh failed')
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute personalized meal plans')
+    parser.add_argument('--days', type=int, default=None, help='Daily plans per member')
+    parser.add_argument('--chunk-size', type=int, default=2000, help='Members scored per batch')
+    parser.add_argument('--watch', action='store_true', help='Keep refreshing')
+    parser.add_argument('--interval', type=int, default=86400, help='Seconds between refreshes with --watch')
+    parser.add_argument('--dry-run', action='store_true', help='Plan without storing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    days = args.days or app.config['MEAL_PLAN_DAYS']
+
+    if args.watch:
+        run_continuously(args.interval, days)
+        return
+
+    with app.app_context():
+        report = refresh_meal_plans(days, chunk_size=args.chunk_size, dry_run=args.dry_run)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
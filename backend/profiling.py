@@ -0,0 +1,231 @@
+"""
+On-demand request profiling for The Fitness Revolution API
+
+An admin adds a header to one request to have just that request profiled:
+
+    curl -H "Authorization: Bearer <admin token>" -H "X-Profile: cprofile" \\
+        http://localhost:5000/api/classes
+
+    cprofile   deterministic, every call (pstats file; snakeviz, pstats)
+    sample     the request's stack sampled every PROFILE_SAMPLE_INTERVAL_MS
+               (folded stacks: flamegraph.pl, speedscope, inferno)
+
+The response names the profile in X-Profile-Id. Profiles are written to
+PROFILE_DIR, which is capped at PROFILE_MAX_FILES files and PROFILE_MAX_BYTES
+(oldest removed first), and downloaded from GET /api/admin/profiles/<id>.
+
+The hook is WSGI middleware: a request without the header costs one dict
+lookup, and with PROFILING_ENABLED off nothing is installed at all. Only the
+request's own thread is profiled (not the media pool or flush threads), up
+to the return of the view; a streamed body is not.
+
+The app decides who may profile with one decorator:
+
+    @request_profiler.authorizer
+    def may_profile(): ...      # runs in the request's context -> bool
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import re
+import secrets
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+
+KINDS = {'cprofile': 'pstats', 'sample': 'folded'}
+
+FILENAME_PATTERN = re.compile(r'^(\d{8}T\d{12})-([\w.]+)-(cprofile|sample)-[0-9a-f]{6}\.(pstats|folded)$')
+
+
+def fold(frame):
+    """A stack as one flamegraph 'folded' line, outermost frame first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    """Samples one thread's stack from a background thread"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[fold(frame)] += 1
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class RequestProfiler:
+    """Profiles single requests that carry the profiling header"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.header = 'X-Profile'
+        self.directory = 'profiles'
+        self.max_files = 50
+        self.max_bytes = 200 * 1024 * 1024
+        self.sample_interval = 0.002
+        self._authorize = None
+        self._lock = threading.Lock()
+        self.metrics = {'profiled': 0, 'refused': 0, 'removed': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('PROFILING_ENABLED', True)
+        self.header = app.config.get('PROFILE_HEADER', 'X-Profile')
+        self.directory = app.config.get('PROFILE_DIR', 'profiles')
+        self.max_files = app.config.get('PROFILE_MAX_FILES', 50)
+        self.max_bytes = app.config.get('PROFILE_MAX_BYTES', 200 * 1024 * 1024)
+        self.sample_interval = app.config.get('PROFILE_SAMPLE_INTERVAL_MS', 2) / 1000
+        app.extensions['request_profiler'] = self
+        if self.enabled:
+            app.wsgi_app = self._middleware(app.wsgi_app)
+
+    def authorizer(self, func):
+        """Register `func()` deciding, in the request's context, whether it may be profiled"""
+        self._authorize = func
+        return func
+
+    # ----- profiling -----
+
+    def _middleware(self, wsgi_app):
+        key = 'HTTP_' + self.header.upper().replace('-', '_')
+
+        def middleware(environ, start_response):
+            if key not in environ:
+                return wsgi_app(environ, start_response)
+            return self._profiled(wsgi_app, environ, start_response, environ[key].strip().lower())
+        return middleware
+
+    def _allowed(self, environ):
+        if self._authorize is None:
+            return False
+        with self.app.request_context(environ):
+            return bool(self._authorize())
+
+    def _endpoint(self, environ):
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match(method=environ.get('REQUEST_METHOD'))
+        except Exception:
+            endpoint = 'unrouted'
+        return re.sub(r'[^\w.]', '_', endpoint)
+
+    def _profiled(self, wsgi_app, environ, start_response, kind):
+        kind = kind if kind in KINDS else 'cprofile' if kind in ('', '1', 'true') else None
+        if kind is None or not self._allowed(environ):
+            self.metrics['refused'] += 1
+            return wsgi_app(environ, start_response)
+
+        name = (f'{datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")}-{self._endpoint(environ)}-{kind}-'
+                f'{secrets.token_hex(3)}.{KINDS[kind]}')
+
+        def start_profiled_response(status, headers, exc_info=None):
+            return start_response(status, headers + [('X-Profile-Id', name)], exc_info)
+
+        if kind == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(wsgi_app, environ, start_profiled_response)
+            finally:
+                self._save(name, lambda path: profile.dump_stats(path))
+
+        sampler = Sampler(threading.get_ident(), self.sample_interval)
+        sampler.start()
+        try:
+            return wsgi_app(environ, start_profiled_response)
+        finally:
+            sampler.stop()
+            self._save(name, lambda path: _write_text(path, sampler.folded()))
+
+    def _save(self, name, write):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        temporary = path + '.tmp'
+        write(temporary)
+        os.replace(temporary, path)
+        self.metrics['profiled'] += 1
+        self._enforce_cap()
+
+    def _enforce_cap(self):
+        with self._lock:
+            profiles = sorted(self.profiles(), key=lambda profile: profile['id'])
+            total = sum(profile['bytes'] for profile in profiles)
+            while profiles and (len(profiles) > self.max_files or total > self.max_bytes):
+                oldest = profiles.pop(0)
+                try:
+                    os.remove(os.path.join(self.directory, oldest['id']))
+                except FileNotFoundError:
+                    pass    # another worker removed it
+                total -= oldest['bytes']
+                self.metrics['removed'] += 1
+
+    # ----- stored profiles -----
+
+    def profiles(self):
+        """Stored profiles, newest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for filename in os.listdir(self.directory):
+            match = FILENAME_PATTERN.match(filename)
+            if not match:
+                continue
+            try:
+                size = os.path.getsize(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                continue
+            found.append({'id': filename, 'created_at': datetime.strptime(match.group(1), '%Y%m%dT%H%M%S%f').isoformat(),
+                          'endpoint': match.group(2), 'kind': match.group(3), 'bytes': size})
+        return sorted(found, key=lambda profile: profile['id'], reverse=True)
+
+    def locate(self, profile_id):
+        """(path, mimetype) of a stored profile, or None"""
+        match = FILENAME_PATTERN.match(profile_id)
+        path = os.path.join(self.directory, profile_id)
+        if not match or not os.path.exists(path):
+            return None
+        return path, 'application/octet-stream' if match.group(4) == 'pstats' else 'text/plain'
+
+    def report(self, profile_id, sort='cumulative', limit=50):
+        """A pstats profile as the text table pstats prints"""
+        stream = io.StringIO()
+        stats = pstats.Stats(self.locate(profile_id)[0], stream=stream)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def status(self):
+        profiles = self.profiles()
+        return {**self.metrics, 'enabled': self.enabled, 'header': self.header, 'stored': len(profiles),
+                'bytes': sum(profile['bytes'] for profile in profiles), 'max_files': self.max_files,
+                'max_bytes': self.max_bytes, 'profiles': profiles}
+
+
+def _write_text(path, text):
+    with open(path, 'w', encoding='utf-8') as out:
+        out.write(text)
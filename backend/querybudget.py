@@ -0,0 +1,275 @@
+"""
+SQL statement budgets for The Fitness Revolution API
+
+Every route declares how many SQL statements one request may run against a
+database. An N+1 regression (a relationship lazy-loaded per row inside a
+to_dict(), say) keeps the code working while the statement count grows with
+the number of rows returned. The budget catches that in tests even on the
+small seeded data set: besides the total, no single statement fingerprint
+may run more than `max_repeats` times on one database within a transaction
+(a commit expires the session, so reloading rows after it is not a repeat).
+
+Budgets live in config, keyed by view name like RATELIMIT_POLICIES (read
+when checked, so the table can follow the routes), or on the view itself
+with the decorator:
+
+    app.config['QUERY_BUDGETS'] = {'get_classes': 3, 'run_archive': None}
+    # None = unbounded (batch jobs run from admin routes)
+
+    @query_budget.budget(3)
+    def view(): ...
+
+QUERY_BUDGET_MODE:
+
+    off      nothing is hooked
+    auto     (unset) log while the app runs in debug mode, else nothing
+    log      over-budget requests log a warning, others log any statement
+             fingerprint they repeated; responses carry X-Query-Count
+    enforce  tests: over-budget requests, and requests to routes with no
+             declared budget, fail with a 500 describing the violation
+
+Code outside requests (scripts, tests) can use the context managers:
+
+    with query_budget.expect(4):
+        ...                             # raises QueryBudgetExceeded
+
+    with count_queries() as tally:
+        ...
+    tally.total, tally.repeated()
+"""
+
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+MODES = ('off', 'auto', 'log', 'enforce')
+
+# Innermost active tally in this context (requests nest in /api/batch)
+_current = ContextVar('query_tally', default=None)
+
+_PLACEHOLDERS = re.compile(r'%\(\w+\)s|%s|\$\d+|(?<![:\w]):\w+')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    """Statement text with parameters, literals and IN-list lengths erased"""
+    statement = _PLACEHOLDERS.sub('?', statement)
+    statement = _LITERALS.sub('?', statement)
+    statement = _IN_LISTS.sub('(?...)', statement)
+    return _SPACES.sub(' ', statement).strip()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised by expect() when the block ran more statements than allowed"""
+
+
+class Tally:
+    """Statements run per database, by fingerprint"""
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.by_engine = {}     # engine -> Counter(fingerprint -> count)
+        self.since_commit = {}  # engine -> Counter(fingerprint -> count) in this transaction
+        self.peaks = Counter()  # fingerprint -> most runs in one transaction on one database
+
+    def record(self, engine, statement):
+        statement = fingerprint(statement)
+        for counts in (self.by_engine, self.since_commit):
+            if engine not in counts:
+                counts[engine] = Counter()
+            counts[engine][statement] += 1
+        self.peaks[statement] = max(self.peaks[statement], self.since_commit[engine][statement])
+
+    def committed(self, engine):
+        self.since_commit.pop(engine, None)
+
+    @property
+    def total(self):
+        return sum(sum(counts.values()) for counts in self.by_engine.values())
+
+    @property
+    def per_database(self):
+        """Statements on the busiest database"""
+        return max((sum(counts.values()) for counts in self.by_engine.values()), default=0)
+
+    def repeated(self, more_than=1):
+        """[(fingerprint, count)] run more than `more_than` times in one transaction"""
+        return [(statement, count) for statement, count in self.peaks.most_common() if count > more_than]
+
+    def violations(self, statements, max_repeats):
+        """Descriptions of how this tally breaks a budget ([] if it doesn't)"""
+        problems = []
+        if statements is not None and self.per_database > statements:
+            problems.append(f'{self.per_database} statements on one database, budget {statements}')
+        if statements is not None:
+            for statement, count in self.repeated(max_repeats):
+                problems.append(f'{count}x {statement[:200]}')
+        return problems
+
+
+def _on_execute(conn, cursor, statement, parameters, context, executemany):
+    tally = _current.get()
+    if tally is not None:
+        tally.record(conn.engine, statement)
+
+
+def _on_commit(conn):
+    tally = _current.get()
+    if tally is not None:
+        tally.committed(conn.engine)
+
+
+_listening = threading.Lock()
+
+
+def listen():
+    """Count statements on every engine (idempotent)"""
+    with _listening:
+        if not event.contains(Engine, 'before_cursor_execute', _on_execute):
+            event.listen(Engine, 'before_cursor_execute', _on_execute)
+            event.listen(Engine, 'commit', _on_commit)
+
+
+@contextmanager
+def count_queries():
+    """Tally the statements run inside the block"""
+    listen()
+    tally = Tally(_current.get())
+    _current.set(tally)
+    try:
+        yield tally
+    finally:
+        _current.set(tally.parent)
+
+
+class QueryBudget:
+    """Checks each request's SQL statements against its route's budget"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.mode = 'off'
+        self.max_repeats = 2
+        self.stats = {}         # endpoint -> {'requests', 'max_statements', 'violations'}
+        self.recent = []        # last violations, newest last
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.mode = app.config.get('QUERY_BUDGET_MODE') or 'auto'
+        if self.mode not in MODES:
+            raise ValueError(f'QUERY_BUDGET_MODE must be one of {", ".join(MODES)}')
+        self.max_repeats = app.config.get('QUERY_BUDGET_MAX_REPEATS', 2)
+        app.extensions['query_budget'] = self
+        if self.mode == 'off':
+            return
+        if self.mode != 'auto':
+            listen()
+        app.before_request(self._start)
+        app.after_request(self._check)
+        app.teardown_request(self._finish)
+
+    def budget(self, statements):
+        """Decorator declaring a view's statement budget (None = unbounded)"""
+        def decorator(view):
+            view.query_budget = statements
+            return view
+        return decorator
+
+    @contextmanager
+    def expect(self, statements, max_repeats=None):
+        """Raise QueryBudgetExceeded if the block breaks the budget"""
+        with count_queries() as tally:
+            yield tally
+        problems = tally.violations(statements, self.max_repeats if max_repeats is None else max_repeats)
+        if problems:
+            raise QueryBudgetExceeded('; '.join(problems))
+
+    def budget_for(self, endpoint):
+        """(declared, statements) for an endpoint"""
+        view = self.app.view_functions.get(endpoint)
+        if view is not None and hasattr(view, 'query_budget'):
+            return True, view.query_budget
+        budgets = self.app.config.get('QUERY_BUDGETS', {})
+        if endpoint in budgets:
+            return True, budgets[endpoint]
+        return False, None
+
+    def undeclared(self):
+        """Endpoints with no declared budget"""
+        return sorted(endpoint for endpoint in self.app.view_functions
+                      if endpoint != 'static' and not self.budget_for(endpoint)[0])
+
+    # ----- request hooks -----
+
+    @property
+    def active_mode(self):
+        if self.mode == 'auto':
+            # app.debug is only known once the server runs (run.py)
+            return 'log' if self.app.debug else 'off'
+        return self.mode
+
+    def _start(self):
+        if self.active_mode == 'off':
+            return
+        listen()
+        tally = Tally(_current.get())
+        _current.set(tally)
+        request.environ['querybudget.tally'] = tally
+
+    def _check(self, response):
+        tally = request.environ.get('querybudget.tally')
+        endpoint = request.endpoint
+        if tally is None or endpoint is None or endpoint == 'static':
+            return response
+        response.headers['X-Query-Count'] = str(tally.total)
+
+        declared, statements = self.budget_for(endpoint)
+        problems = tally.violations(statements, self.max_repeats) if declared else \
+            [f'no query budget declared for {endpoint}']
+        with self._lock:
+            stats = self.stats.setdefault(endpoint, {'requests': 0, 'max_statements': 0, 'violations': 0})
+            stats['requests'] += 1
+            stats['max_statements'] = max(stats['max_statements'], tally.per_database)
+            if problems:
+                stats['violations'] += 1
+                self.recent = (self.recent + [{'endpoint': endpoint, 'path': request.path,
+                                               'problems': problems}])[-50:]
+        if self.active_mode == 'log':
+            if problems:
+                self.app.logger.warning('query budget exceeded by %s %s: %s', request.method, request.path,
+                                        '; '.join(problems))
+            else:
+                # Within budget, but worth a look while developing
+                for statement, count in tally.repeated():
+                    self.app.logger.info('%s %s ran %dx: %s', request.method, request.path, count,
+                                         statement[:200])
+            return response
+        if not problems:
+            return response
+        failure = jsonify({'error': 'Query budget exceeded', 'endpoint': endpoint,
+                           'statements': tally.per_database, 'budget': statements, 'problems': problems})
+        failure.status_code = 500
+        failure.headers['X-Query-Count'] = str(tally.total)
+        return failure
+
+    def _finish(self, exc=None):
+        tally = request.environ.pop('querybudget.tally', None)
+        if tally is not None and _current.get() is tally:
+            _current.set(tally.parent)
+
+    def status(self):
+        with self._lock:
+            return {'mode': self.active_mode, 'max_repeats': self.max_repeats, 'undeclared': self.undeclared(),
+                    'endpoints': {endpoint: {**stats, 'budget': self.budget_for(endpoint)[1]}
+                                  for endpoint, stats in sorted(self.stats.items())},
+                    'recent_violations': list(self.recent)}
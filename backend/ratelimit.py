@@ -0,0 +1,221 @@
+"""
+Token-bucket rate limiting for The Fitness Revolution API
+
+Each route gets a named policy with optional per-IP and per-account limits,
+for example ``{'ip': '20/minute', 'account': '5/minute'}``. Buckets live in a
+pluggable store; the SQLite store is shared by all gunicorn workers on a host.
+Rejected requests get a 429 before the view runs, so no database or bcrypt
+work is done for them.
+"""
+
+import random
+import threading
+import time
+from functools import wraps
+
+from flask import request, jsonify
+
+from shared_store import SharedSQLite, sqlite_path_from_url
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400
+}
+
+
+def parse_limit(limit):
+    """Parse '5/minute' into (capacity, refill rate in tokens per second)"""
+    count, _, period = limit.partition('/')
+    period = period.strip().rstrip('s')
+    if period not in PERIODS:
+        raise ValueError(f'Unknown rate limit period in {limit!r}')
+    capacity = int(count)
+    return capacity, capacity / PERIODS[period]
+
+
+# ============================================
+# BUCKET STORES
+# ============================================
+
+class BucketStore:
+    """Interface for token bucket storage backends
+
+    Implementations must make ``consume`` atomic for a given key across every
+    process that shares the store.
+    """
+
+    def consume(self, key, capacity, rate, cost=1):
+        """Take `cost` tokens from bucket `key`
+
+        Returns (allowed, retry_after) where retry_after is the number of
+        seconds until enough tokens are available again.
+        """
+        raise NotImplementedError
+
+    def reset(self):
+        """Drop every bucket"""
+        raise NotImplementedError
+
+
+def _refill(tokens, updated_at, now, capacity, rate, cost):
+    tokens = min(capacity, tokens + (now - updated_at) * rate)
+    if tokens >= cost:
+        return True, tokens - cost, 0.0
+    return False, tokens, (cost - tokens) / rate
+
+
+class MemoryBucketStore(BucketStore):
+    """In-process buckets; only correct with a single worker process"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, rate, cost=1):
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            allowed, tokens, retry_after = _refill(tokens, updated_at, now, capacity, rate, cost)
+            self._buckets[key] = (tokens, now)
+        return allowed, retry_after
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBucketStore(BucketStore):
+    """Buckets in a SQLite file shared by all workers on the host"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    """
+
+    # Buckets idle for this long are full again and can be forgotten
+    PRUNE_AFTER_SECONDS = 86400
+
+    def __init__(self, path):
+        self.db = SharedSQLite(path, self.SCHEMA)
+
+    def consume(self, key, capacity, rate, cost=1):
+        now = time.time()
+        with self.db.transaction() as conn:
+            row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?',
+                               (key,)).fetchone()
+            tokens, updated_at = row if row else (capacity, now)
+            allowed, tokens, retry_after = _refill(tokens, updated_at, now, capacity, rate, cost)
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+            if random.random() < 0.001:
+                conn.execute('DELETE FROM buckets WHERE updated_at < ?',
+                             (now - self.PRUNE_AFTER_SECONDS,))
+        return allowed, retry_after
+
+    def reset(self):
+        self.db.execute('DELETE FROM buckets')
+
+
+# Storage URL scheme -> factory(url). Register more (e.g. redis) with
+# RateLimiter.register_store().
+STORE_FACTORIES = {
+    'memory': lambda url: MemoryBucketStore(),
+    'sqlite': lambda url: SQLiteBucketStore(sqlite_path_from_url(url))
+}
+
+
+# ============================================
+# LIMITER
+# ============================================
+
+class RateLimiter:
+    """Applies per-route token-bucket policies to Flask views"""
+
+    def __init__(self, app=None):
+        self.store = None
+        self.policies = {}
+        self.enabled = True
+        self.trust_proxy = False
+        if app is not None:
+            self.init_app(app)
+
+    @staticmethod
+    def register_store(scheme, factory):
+        """Make a storage backend available under `scheme://` URLs"""
+        STORE_FACTORIES[scheme] = factory
+
+    def init_app(self, app):
+        url = app.config.get('RATELIMIT_STORAGE_URL', 'memory://')
+        scheme = url.split(':', 1)[0]
+        if scheme not in STORE_FACTORIES:
+            raise ValueError(f'No rate limit store registered for {scheme!r}')
+        self.store = STORE_FACTORIES[scheme](url)
+        self.enabled = app.config.get('RATELIMIT_ENABLED', True)
+        self.trust_proxy = app.config.get('RATELIMIT_TRUST_PROXY', False)
+        self.policies = {
+            name: {scope: parse_limit(limit) for scope, limit in policy.items()}
+            for name, policy in app.config.get('RATELIMIT_POLICIES', {}).items()
+        }
+        app.extensions['ratelimit'] = self
+
+    def client_ip(self):
+        if self.trust_proxy and request.access_route:
+            return request.access_route[0]
+        return request.remote_addr or 'unknown'
+
+    def check(self, name, account=None):
+        """Consume a token from each bucket of policy `name`
+
+        Returns None when allowed, otherwise the seconds to wait.
+        """
+        policy = self.policies.get(name)
+        if not self.enabled or not policy:
+            return None
+
+        keys = []
+        if 'ip' in policy:
+            keys.append(('ip', f'{name}:ip:{self.client_ip()}'))
+        if 'account' in policy and account:
+            keys.append(('account', f'{name}:account:{account}'))
+
+        retry_after = 0.0
+        for scope, key in keys:
+            capacity, rate = policy[scope]
+            allowed, wait = self.store.consume(key, capacity, rate)
+            if not allowed:
+                retry_after = max(retry_after, wait)
+        return retry_after or None
+
+    def limit(self, name=None, account=None):
+        """Decorator applying policy `name` (default: the view name)
+
+        `account` is an optional callable returning the account key for the
+        request, e.g. the email being logged into.
+        """
+        def decorator(view):
+            policy_name = name or view.__name__
+
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                account_key = account() if account else None
+                retry_after = self.check(policy_name, account_key)
+                if retry_after is not None:
+                    seconds = max(1, int(retry_after + 0.999))
+                    response = jsonify({'error': 'Too many requests', 'retry_after': seconds})
+                    response.headers['Retry-After'] = str(seconds)
+                    return response, 429
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+def email_from_json():
+    """Account key for unauthenticated forms: the submitted email"""
+    data = request.get_json(silent=True) or {}
+    email = data.get('email')
+    return email.strip().lower() if isinstance(email, str) and email.strip() else None
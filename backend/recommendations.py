@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+The Fitness Revolution - program and class recommendations
+
+Builds a member x program affinity matrix with NumPy and stores each member's
+top programs, plus the next open class of each, in the recommendations table,
+so GET /api/recommendations is a primary key read.
+
+Scores blend four signals, each scaled to 0..1:
+    co-booking  programs booked by members with similar booking histories
+                (item-item cosine similarity over live and archived bookings)
+    goal        User.fitness_goal vs Program.category
+    level       User.activity_level vs Program.level
+    popularity  share of all bookings, so new members still get a ranking
+
+Bookings and classes are read from the default database and every branch
+database, so members of branch locations are scored and branch classes picked.
+
+Usage:
+    python recommendations.py                 # refresh every member once
+    python recommendations.py --watch --interval 3600
+    python recommendations.py --top-k 10 --dry-run
+"""
+
+import argparse
+import json
+import logging
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func
+
+from app import app, db, User, Program, Class, Booking, ArchivedClass, ArchivedBooking, Recommendation, \
+    each_database
+
+logger = logging.getLogger('recommendations')
+
+WEIGHTS = {'co_booking': 0.5, 'goal': 0.25, 'level': 0.15, 'popularity': 0.1}
+# Reported as the reason for a pick, by strongest signal (same order)
+REASONS = ('similar_members', 'goal', 'level', 'popular')
+
+# How well each program category serves a fitness goal
+GOAL_CATEGORY_AFFINITY = {
+    'weight_loss': {'HIIT': 1.0, 'Cardio': 1.0, 'Strength': 0.5, 'Yoga': 0.3},
+    'muscle_gain': {'Strength': 1.0, 'HIIT': 0.6, 'Cardio': 0.2, 'Yoga': 0.2},
+    'maintenance': {'Yoga': 0.8, 'Cardio': 0.7, 'Strength': 0.7, 'HIIT': 0.5}
+}
+DEFAULT_AFFINITY = 0.4
+
+ACTIVITY_RANK = {'sedentary': 0.0, 'light': 0.5, 'moderate': 1.0, 'active': 2.0}
+PROGRAM_LEVEL_RANK = {'beginner': 0.0, 'intermediate': 1.0, 'advanced': 2.0}
+
+UPCOMING_DAYS = 7
+CHUNK_SIZE = 5000
+
+# Process-wide counters for the last refresh
+metrics = {'last_run_at': None, 'last_duration_ms': None, 'members': 0, 'programs': 0}
+
+
+def goal_scores(categories, goals):
+    """len(goals) x len(categories) goal affinity matrix"""
+    return np.array([
+        [GOAL_CATEGORY_AFFINITY.get(goal, {}).get(category, DEFAULT_AFFINITY) for category in categories]
+        for goal in goals
+    ], dtype=np.float32)
+
+
+def level_scores(levels, activity_levels):
+    """len(activity_levels) x len(levels) level fit matrix"""
+    program_rank = np.array([PROGRAM_LEVEL_RANK.get(level, np.nan) for level in levels], dtype=np.float32)
+    member_rank = np.array([ACTIVITY_RANK.get(level, np.nan) for level in activity_levels], dtype=np.float32)
+    fit = 1.0 - np.abs(member_rank[:, None] - program_rank[None, :]) / 2.0
+    # all_levels programs suit everyone; unknown activity levels are neutral
+    fit[:, np.isnan(program_rank)] = 1.0
+    fit[np.isnan(member_rank), :] = np.where(np.isnan(program_rank), 1.0, 0.5)
+    return np.clip(fit, 0.0, 1.0)
+
+
+def co_booking_scores(counts):
+    """Members x programs scores from item-item cosine similarity"""
+    weighted = np.log1p(counts)
+    norms = np.linalg.norm(weighted, axis=0)
+    norms[norms == 0] = 1.0
+    similarity = (weighted.T @ weighted) / np.outer(norms, norms)
+    np.fill_diagonal(similarity, 0.0)
+    scores = weighted @ similarity
+    peak = scores.max(axis=1, keepdims=True)
+    peak[peak == 0] = 1.0
+    return scores / peak
+
+
+def booking_counts(user_index, program_index):
+    """Members x programs booking counts, live and archived, from every database"""
+    counts = np.zeros((len(user_index), len(program_index)), dtype=np.float32)
+    for _ in each_database():
+        sources = (
+            db.session.query(Booking.user_id, Class.program_id, func.count(Booking.id))
+            .join(Class, Booking.class_id == Class.id)
+            .group_by(Booking.user_id, Class.program_id),
+            db.session.query(ArchivedBooking.user_id, ArchivedClass.program_id, func.count(ArchivedBooking.id))
+            .join(ArchivedClass, ArchivedBooking.class_id == ArchivedClass.id)
+            .group_by(ArchivedBooking.user_id, ArchivedClass.program_id)
+        )
+        for query in sources:
+            for user_id, program_id, count in query.yield_per(CHUNK_SIZE):
+                row, column = user_index.get(user_id), program_index.get(program_id)
+                if row is not None and column is not None:
+                    counts[row, column] += count
+    return counts
+
+
+def score_members(programs, goals, activity_levels, counts):
+    """Blended members x programs scores and the index of the strongest signal"""
+    goal_vocab = sorted(set(goals), key=str)
+    activity_vocab = sorted(set(activity_levels), key=str)
+    goal_index = {goal: i for i, goal in enumerate(goal_vocab)}
+    activity_index = {level: i for i, level in enumerate(activity_vocab)}
+    goal_rows = np.array([goal_index[g] for g in goals], dtype=np.intp)
+    activity_rows = np.array([activity_index[a] for a in activity_levels], dtype=np.intp)
+
+    popularity = counts.sum(axis=0)
+    if popularity.max() > 0:
+        popularity = popularity / popularity.max()
+
+    components = (
+        lambda: WEIGHTS['co_booking'] * co_booking_scores(counts),
+        lambda: WEIGHTS['goal'] * goal_scores([p.category for p in programs], goal_vocab)[goal_rows],
+        lambda: WEIGHTS['level'] * level_scores([p.level for p in programs], activity_vocab)[activity_rows],
+        lambda: WEIGHTS['popularity'] * popularity[None, :]
+    )
+    # Running sum and argmax, so only a few members x programs arrays are alive
+    total = np.zeros(counts.shape, dtype=np.float32)
+    strongest_value = np.full(counts.shape, -1.0, dtype=np.float32)
+    strongest = np.zeros(counts.shape, dtype=np.int8)
+    for index, component in enumerate(components):
+        values = np.broadcast_to(component(), counts.shape)
+        total += values
+        stronger = values > strongest_value
+        strongest_value[stronger] = values[stronger]
+        strongest[stronger] = index
+    return total, strongest
+
+
+def top_k(scores, k):
+    """Column indices of each row's k highest scores, best first"""
+    k = min(k, scores.shape[1])
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def next_open_classes(program_ids):
+    """{program_id: [class_id, ...]} of upcoming classes with free spots in
+    every database, soonest first"""
+    today = date.today()
+    classes = []
+    for _ in each_database():
+        classes.extend(db.session.query(Class.date, Class.start_time, Class.id, Class.program_id).filter(
+            Class.program_id.in_(program_ids),
+            Class.is_active.is_(True),
+            Class.date >= today,
+            Class.date <= today + timedelta(days=UPCOMING_DAYS),
+            Class.enrolled_count < Class.max_participants
+        ).all())
+    upcoming = {}
+    for _, _, class_id, program_id in sorted(classes, key=lambda c: (c[0], c[1])):
+        upcoming.setdefault(program_id, []).append(class_id)
+    return upcoming
+
+
+def upcoming_bookings():
+    """{user_id: {class_id, ...}} of confirmed bookings for upcoming classes in
+    every database"""
+    booked = {}
+    for _ in each_database():
+        rows = db.session.query(Booking.user_id, Booking.class_id).join(Class, Booking.class_id == Class.id) \
+            .filter(Booking.status == 'confirmed', Class.date >= date.today()).all()
+        for user_id, class_id in rows:
+            booked.setdefault(user_id, set()).add(class_id)
+    return booked
+
+
+def refresh_recommendations(top_k_programs=5, dry_run=False):
+    """Recompute and store recommendations for every active member"""
+    started = time.perf_counter()
+    run_started_at = datetime.utcnow()
+
+    programs = Program.query.filter_by(is_active=True).order_by(Program.id).all()
+    members = db.session.query(User.id, User.fitness_goal, User.activity_level) \
+        .filter(User.is_active.is_(True), User.role == 'member').all()
+    report = {'members': len(members), 'programs': len(programs), 'dry_run': dry_run}
+    if not programs or not members:
+        report['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        return report
+
+    user_ids = [m[0] for m in members]
+    program_ids = [p.id for p in programs]
+    counts = booking_counts({u: i for i, u in enumerate(user_ids)},
+                            {p: i for i, p in enumerate(program_ids)})
+    scores, strongest = score_members(programs, [m[1] for m in members], [m[2] for m in members], counts)
+    best = top_k(scores, top_k_programs)
+    report['scored_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+    upcoming = next_open_classes(program_ids)
+    booked = upcoming_bookings()
+
+    table = Recommendation.__table__
+    rows = []
+    for row, user_id in enumerate(user_ids):
+        picks = best[row]
+        already = booked.get(user_id, ())
+        class_ids = []
+        for column in picks:
+            open_class = next((c for c in upcoming.get(program_ids[column], ()) if c not in already), None)
+            if open_class:
+                class_ids.append(open_class)
+        rows.append({
+            'user_id': user_id,
+            'programs': json.dumps([
+                {'program_id': program_ids[column],
+                 'score': round(float(scores[row, column]), 4),
+                 'reason': REASONS[strongest[row, column]]}
+                for column in picks
+            ]),
+            'class_ids': json.dumps(class_ids),
+            'generated_at': run_started_at
+        })
+        if len(rows) == CHUNK_SIZE or row == len(user_ids) - 1:
+            if not dry_run:
+                chunk_ids = [r['user_id'] for r in rows]
+                db.session.execute(table.delete().where(table.c.user_id.in_(chunk_ids)))
+                db.session.execute(table.insert(), rows)
+                db.session.commit()
+            rows = []
+
+    if not dry_run:
+        # Members who left or stopped being members since the last run
+        db.session.execute(table.delete().where(table.c.generated_at < run_started_at))
+        db.session.commit()
+
+    report['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    metrics.update(last_run_at=run_started_at.isoformat(), last_duration_ms=report['duration_ms'],
+                   members=len(members), programs=len(programs))
+    logger.info('recommendations for %s members over %s programs in %sms',
+                len(members), len(programs), report['duration_ms'])
+    return report
+
+
+def fallback_recommendations(user, programs, top_k_programs=5):
+    """Goal and level ranking for a member without stored recommendations
+
+    `programs` are Program.to_dict() dicts.
+    """
+    if not programs:
+        return []
+    goal = WEIGHTS['goal'] * goal_scores([p['category'] for p in programs], [user.fitness_goal])[0]
+    level = WEIGHTS['level'] * level_scores([p['level'] for p in programs], [user.activity_level])[0]
+    scores = goal + level
+    order = np.argsort(-scores, kind='stable')[:top_k_programs]
+    return [
+        {'program_id': programs[i]['id'], 'score': round(float(scores[i]), 4),
+         'reason': 'goal' if goal[i] >= level[i] else 'level'}
+        for i in order
+    ]
+
+
+def run_continuously(interval=3600, top_k_programs=5):
+    """Refresh every `interval` seconds"""
+    while True:
+        try:
+            with app.app_context():
+                refresh_recommendations(top_k_programs)
+        except Exception:
+            logger.exception('recommendation refresh failed')
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute program and class recommendations')
+    parser.add_argument('--top-k', type=int, default=None, help='Programs per member')
+    parser.add_argument('--watch', action='store_true', help='Keep refreshing')
+    parser.add_argument('--interval', type=int, default=3600, help='Seconds between refreshes with --watch')
+    parser.add_argument('--dry-run', action='store_true', help='Score without storing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    top_k_programs = args.top_k or app.config['RECOMMENDATIONS_TOP_K']
+
+    if args.watch:
+        run_continuously(args.interval, top_k_programs)
+        return
+
+    with app.app_context():
+        report = refresh_recommendations(top_k_programs, dry_run=args.dry_run)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+The Fitness Revolution - enrolled_count reconciliation
+
+Class.enrolled_count is a denormalized counter maintained by the booking
+routes. This job recounts seat-holding bookings per class with one grouped
+aggregate over a date range and repairs drifted counters with a bulk
+compare-and-set update, so bookings made while it runs are never overwritten.
+Seats freed by a repair go to the class waitlist, as a cancellation's would.
+The default database and every branch database are reconciled in turn.
+
+Usage:
+    python reconcile.py                                  # upcoming 14 days, once
+    python reconcile.py --start 2024-01-01 --end 2024-12-31
+    python reconcile.py --watch --window-days 14 --interval 300
+    python reconcile.py --dry-run
+"""
+
+import argparse
+import json
+import logging
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import and_, bindparam, func
+
+from app import app, db, Class, Booking, ReconcileRun, calendar_feeds, capacity_feed, each_database, \
+    promote_from_waitlist
+from calendar_feeds import feed_scope
+
+logger = logging.getLogger('reconcile')
+
+SUMMED = ('classes_checked', 'drifted_classes', 'repaired_classes', 'absolute_drift', 'promoted')
+
+
+def count_seats(start, end):
+    """(class_id, date, recorded, actual) for every class between start and end
+    in the session's database"""
+    return db.session.query(
+        Class.id,
+        Class.date,
+        Class.enrolled_count,
+        func.count(Booking.id)
+    ).outerjoin(
+        Booking,
+        and_(Booking.class_id == Class.id,
+             Booking.status.in_(Booking.SEAT_HOLDING_STATUSES))
+    ).filter(
+        Class.date >= start,
+        Class.date <= end
+    ).group_by(Class.id, Class.date, Class.enrolled_count).all()
+
+
+def reconcile_enrolled_counts(start, end, repair=True):
+    """Recount classes dated start..end and repair drifted counters
+
+    Returns a drift report dict.
+    """
+    started = time.perf_counter()
+
+    checked, drifted, repaired, promoted = 0, [], 0, 0
+    for code in each_database():
+        rows = count_seats(start, end)
+        checked += len(rows)
+        found = [
+            {
+                'class_id': class_id,
+                'database': code,
+                'date': class_date.isoformat(),
+                'recorded': recorded or 0,
+                'actual': actual,
+                'drift': (recorded or 0) - actual
+            }
+            for class_id, class_date, recorded, actual in rows
+            if (recorded or 0) != actual
+        ]
+        drifted.extend(found)
+        if repair and found:
+            repaired += repair_counts(found)
+            promoted += fill_freed_seats(found)
+
+    duration_ms = round((time.perf_counter() - started) * 1000, 2)
+    report = {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'classes_checked': checked,
+        'drifted_classes': len(drifted),
+        'repaired_classes': repaired,
+        'absolute_drift': sum(abs(d['drift']) for d in drifted),
+        'promoted': promoted,
+        'duration_ms': duration_ms,
+        'drift': drifted
+    }
+
+    # Stored, so GET /api/admin/reconcile sees runs of every process (--watch included)
+    db.session.add(ReconcileRun(start=start, end=end, dry_run=not repair, duration_ms=duration_ms,
+                                **{key: report[key] for key in SUMMED}))
+    db.session.commit()
+
+    for d in drifted:
+        logger.warning('class %s on %s (%s database): enrolled_count %s, actual %s',
+                       d['class_id'], d['date'], d['database'] or 'default', d['recorded'], d['actual'])
+    logger.info('checked %s classes in %sms, %s drifted, %s repaired',
+                report['classes_checked'], duration_ms, len(drifted), repaired)
+    return report
+
+
+def repair_counts(drifted):
+    """Set drifted counters to the actual count in the session's database;
+    returns how many were repaired"""
+    # Only overwrite counters that still hold the value we read
+    table = Class.__table__
+    statement = table.update().where(and_(
+        table.c.id == bindparam('b_id'),
+        table.c.enrolled_count == bindparam('b_recorded')
+    )).values(enrolled_count=bindparam('b_actual'))
+    result = db.session.execute(statement, [
+        {'b_id': d['class_id'], 'b_recorded': d['recorded'], 'b_actual': d['actual']}
+        for d in drifted
+    ])
+    db.session.commit()
+    return result.rowcount if result.rowcount >= 0 else len(drifted)
+
+
+def run_metrics():
+    """Totals over every stored run, and the last run's report"""
+    totals = db.session.query(
+        func.count(ReconcileRun.id), *[func.sum(getattr(ReconcileRun, key)) for key in SUMMED]
+    ).one()
+    last = ReconcileRun.query.order_by(ReconcileRun.id.desc()).first()
+    return {
+        'runs': totals[0],
+        **{key: value or 0 for key, value in zip(SUMMED, totals[1:])},
+        'last_run_at': last.run_at.isoformat() if last else None,
+        'last_duration_ms': last.duration_ms if last else None,
+        'last_report': last.to_dict() if last else None
+    }
+
+
+def fill_freed_seats(drifted):
+    """Promote waiting members into seats that repaired counters freed, in
+    classes from today on in the session's database; returns how many were
+    promoted"""
+    today = date.today()
+    class_ids = [d['class_id'] for d in drifted if d['drift'] > 0 and date.fromisoformat(d['date']) >= today]
+    if not class_ids:
+        return 0
+    classes = Class.query.filter(
+        Class.id.in_(class_ids),
+        Class.waitlist_count > 0,
+        Class.enrolled_count < Class.max_participants
+    ).all()
+
+    promoted = []
+    for class_ in classes:
+        for _ in range(class_.max_participants - class_.enrolled_count):
+            booking = promote_from_waitlist(class_)
+            if booking is None:
+                break
+            class_.enrolled_count = Class.enrolled_count + 1
+            promoted.append(booking)
+    if not promoted:
+        return 0
+    db.session.commit()
+
+    for class_ in classes:
+        capacity_feed.publish(class_)
+    calendar_feeds.bump(*(feed_scope('member', booking.user_id) for booking in promoted))
+    logger.info('promoted %s waiting members into freed seats', len(promoted))
+    return len(promoted)
+
+
+def upcoming_window(window_days, lookback_days=1):
+    """Sliding window of classes around today"""
+    today = date.today()
+    return today - timedelta(days=lookback_days), today + timedelta(days=window_days)
+
+
+def run_continuously(window_days=14, interval=300, repair=True):
+    """Reconcile the upcoming window every `interval` seconds"""
+    while True:
+        start, end = upcoming_window(window_days)
+        try:
+            with app.app_context():
+                reconcile_enrolled_counts(start, end, repair=repair)
+        except Exception:
+            logger.exception('reconciliation run failed')
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconcile Class.enrolled_count with bookings')
+    parser.add_argument('--start', type=date.fromisoformat, help='First class date (YYYY-MM-DD)')
+    parser.add_argument('--end', type=date.fromisoformat, help='Last class date (YYYY-MM-DD)')
+    parser.add_argument('--window-days', type=int, default=14, help='Upcoming days to check')
+    parser.add_argument('--watch', action='store_true', help='Keep running over a sliding window')
+    parser.add_argument('--interval', type=int, default=300, help='Seconds between runs with --watch')
+    parser.add_argument('--dry-run', action='store_true', help='Report drift without repairing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.watch:
+        run_continuously(args.window_days, args.interval, repair=not args.dry_run)
+        return
+
+    start, end = upcoming_window(args.window_days)
+    start = args.start or start
+    end = args.end or end
+    with app.app_context():
+        report = reconcile_enrolled_counts(start, end, repair=not args.dry_run)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
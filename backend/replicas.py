@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Read-replica and branch routing for The Fitness Revolution API
+
+Replica engines are ordinary Flask-SQLAlchemy binds named ``replica_<n>``
+(see DATABASE_REPLICA_URLS). ``RoutingSession`` sends reads made while handling
+GET/HEAD requests to one replica and everything else to the primary. Once a
+session writes, it sticks to the primary so the request reads its own writes.
+
+Branches may also get a database of their own (binds named ``branch_<code>``,
+see BRANCH_DATABASE_URLS). When a session is scoped to such a branch, the
+branch-partitioned tables are read from and written to the branch database.
+
+For local testing, this module also copies a primary SQLite file into replica
+files on an interval:
+
+    python replicas.py --primary fitness_revolution.db \\
+        --replica replica_1.db --replica replica_2.db --interval 5
+"""
+
+import argparse
+import random
+import sqlite3
+import time
+
+import sqlalchemy as sa
+from flask import has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+REPLICA_BIND_PREFIX = 'replica_'
+BRANCH_BIND_PREFIX = 'branch_'
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Tables stored in a branch's own database when it has one
+BRANCH_PARTITIONED_TABLES = ('classes', 'bookings', 'waitlist_entries',
+                             'archived_classes', 'archived_bookings')
+
+
+def replica_binds(urls):
+    """SQLALCHEMY_BINDS entries for a comma-separated list of replica URLs"""
+    urls = [url.strip() for url in (urls or '').split(',') if url.strip()]
+    return {f'{REPLICA_BIND_PREFIX}{i}': url for i, url in enumerate(urls)}
+
+
+def branch_binds(spec):
+    """SQLALCHEMY_BINDS entries for 'code=url,code=url' branch databases"""
+    binds = {}
+    for item in (spec or '').split(','):
+        code, _, url = item.partition('=')
+        if code.strip() and url.strip():
+            binds[f'{BRANCH_BIND_PREFIX}{code.strip()}'] = url.strip()
+    return binds
+
+
+def _statement_table(mapper, clause):
+    if mapper is not None:
+        return getattr(sa.inspect(mapper), 'local_table', None)
+    if isinstance(clause, sa.Table):
+        return clause
+    if isinstance(clause, sa.sql.dml.UpdateBase):
+        return clause.table
+    return None
+
+
+class RoutingSession(Session):
+    """Session that routes reads to replica binds and branch tables to branch binds"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('branch_bind'):
+            table = _statement_table(mapper, clause)
+            if table is not None and table.name in BRANCH_PARTITIONED_TABLES:
+                return self._db.engines[self.info['branch_bind']]
+        if bind is None and self._reads_from_replica(clause):
+            engine = self._replica_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _reads_from_replica(self, clause):
+        if self._flushing or self.info.get('sticky_primary'):
+            return False
+        if isinstance(clause, sa.sql.dml.UpdateBase):
+            return False
+        if getattr(clause, '_for_update_arg', None) is not None:
+            return False
+        # Only read-only requests; jobs and scripts always use the primary
+        return has_request_context() and request.method in READ_ONLY_METHODS
+
+    def _replica_engine(self):
+        if 'replica_key' not in self.info:
+            keys = [k for k in self._db.engines if k and k.startswith(REPLICA_BIND_PREFIX)]
+            # One replica per session so a request sees a single snapshot
+            self.info['replica_key'] = random.choice(keys) if keys else None
+        key = self.info['replica_key']
+        return self._db.engines[key] if key else None
+
+    def use_primary(self):
+        """Send the rest of this session's reads to the primary"""
+        self.info['sticky_primary'] = True
+
+    def use_branch(self, code):
+        """Keep partitioned tables in branch `code`'s database, if it has one"""
+        key = f'{BRANCH_BIND_PREFIX}{code}'
+        if key in self._db.engines:
+            self.info['branch_bind'] = key
+            return True
+        return False
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _stick_after_flush(session, flush_context):
+    session.info['sticky_primary'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _stick_after_bulk_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['sticky_primary'] = True
+
+
+# ============================================
+# LOCAL SQLITE REPLICAS
+# ============================================
+
+def sync_sqlite_replicas(primary_path, replica_paths):
+    """Copy a consistent snapshot of the primary into each replica file
+
+    Uses the SQLite online backup API, which writes into the replica under its
+    own locks, so connections already open on a replica see the new data.
+    """
+    source = sqlite3.connect(primary_path)
+    try:
+        for path in replica_paths:
+            target = sqlite3.connect(path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+    finally:
+        source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy a primary SQLite database into replica files')
+    parser.add_argument('--primary', required=True, help='Primary database file')
+    parser.add_argument('--replica', action='append', required=True, help='Replica file (repeatable)')
+    parser.add_argument('--interval', type=float, default=0, help='Seconds between copies (0 = once)')
+    args = parser.parse_args()
+
+    while True:
+        started = time.perf_counter()
+        sync_sqlite_replicas(args.primary, args.replica)
+        print(f'Synced {len(args.replica)} replica(s) in {(time.perf_counter() - started) * 1000:.1f}ms')
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+The Fitness Revolution - revenue and membership-mix snapshots
+
+Writes one revenue_snapshots row per membership plan per day, computed with
+grouped aggregates: active members and MRR per plan from users joined to
+memberships, and the day's new members, renewals, upgrades, downgrades and
+cancellations from the membership_changes log. Memberships that ran out the
+day before count as expirations. GET /api/admin/reports/revenue only reads
+snapshot rows, a few hundred for a year of daily snapshots, however many
+members there are.
+
+MRR counts yearly members at a twelfth of price_yearly. Snapshots taken on
+the day are exact; backfilled ones use the members' current plans.
+
+Usage:
+    python revenue.py                        # snapshot today
+    python revenue.py --backfill 90          # the last 90 days
+    python revenue.py --watch --interval 3600   # also closes yesterday after midnight
+"""
+
+import argparse
+import json
+import logging
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import and_, case, func, or_
+
+from app import app, db, User, Membership, MembershipChange, RevenueSnapshot
+
+logger = logging.getLogger('revenue')
+
+FLOW_COUNTS = {'new': 'new_members', 'renewal': 'renewals', 'upgrade': 'upgrades',
+               'downgrade': 'downgrades', 'cancel': 'cancellations'}
+
+# Process-wide counters for the last snapshot
+metrics = {'last_run_at': None, 'last_duration_ms': None, 'snapshots': 0, 'plans': 0}
+
+
+def member_mrr():
+    """Monthly revenue of one member row, as a SQL expression"""
+    return case((User.membership_billing == 'yearly', Membership.price_yearly / 12.0),
+                else_=Membership.price_monthly)
+
+
+def active_on(day):
+    """Members holding a membership on `day`"""
+    return and_(
+        User.role == 'member',
+        User.is_active == True,
+        User.membership_id.isnot(None),
+        or_(User.membership_start.is_(None), User.membership_start <= day),
+        or_(User.membership_end.is_(None), User.membership_end >= day)
+    )
+
+
+def plan_totals(day):
+    """{membership_id: (active, yearly, mrr)} on `day`"""
+    rows = db.session.query(
+        User.membership_id,
+        func.count(User.id),
+        func.sum(case((User.membership_billing == 'yearly', 1), else_=0)),
+        func.sum(member_mrr())
+    ).join(Membership, Membership.id == User.membership_id) \
+        .filter(active_on(day)).group_by(User.membership_id).all()
+    return {membership_id: (active, yearly or 0, mrr or 0.0) for membership_id, active, yearly, mrr in rows}
+
+
+def expirations(day):
+    """{membership_id: (count, mrr)} of memberships that ended the day before"""
+    rows = db.session.query(User.membership_id, func.count(User.id), func.sum(member_mrr())) \
+        .join(Membership, Membership.id == User.membership_id) \
+        .filter(User.role == 'member', User.is_active == True,
+                User.membership_end == day - timedelta(days=1)) \
+        .group_by(User.membership_id).all()
+    return {membership_id: (count, mrr or 0.0) for membership_id, count, mrr in rows}
+
+
+def flows(day):
+    """Per-plan counts and MRR movements from the day's membership changes"""
+    start = datetime.combine(day, datetime.min.time())
+    # Cancellations count against the plan left, everything else the plan joined
+    plan = case((MembershipChange.kind == 'cancel', MembershipChange.from_membership_id),
+                else_=MembershipChange.to_membership_id).label('plan')
+    rows = db.session.query(
+        MembershipChange.kind,
+        plan,
+        func.count(MembershipChange.id),
+        func.sum(MembershipChange.to_mrr - MembershipChange.from_mrr)
+    ).filter(
+        MembershipChange.changed_at >= start,
+        MembershipChange.changed_at < start + timedelta(days=1)
+    ).group_by(MembershipChange.kind, plan).all()
+
+    plans = {}
+    for kind, membership_id, count, delta in rows:
+        plan = plans.setdefault(membership_id, {})
+        if kind in FLOW_COUNTS:
+            plan[FLOW_COUNTS[kind]] = plan.get(FLOW_COUNTS[kind], 0) + count
+        delta = delta or 0.0
+        if kind == 'new':
+            plan['new_mrr'] = plan.get('new_mrr', 0.0) + delta
+        elif kind == 'cancel':
+            plan['churned_mrr'] = plan.get('churned_mrr', 0.0) - delta
+        elif delta > 0:
+            plan['expansion_mrr'] = plan.get('expansion_mrr', 0.0) + delta
+        elif delta < 0:
+            plan['contraction_mrr'] = plan.get('contraction_mrr', 0.0) - delta
+    return plans
+
+
+def take_snapshot(day, dry_run=False):
+    """Compute and store the revenue snapshot rows of `day`"""
+    started = time.perf_counter()
+    names = dict(db.session.query(Membership.id, Membership.name).all())
+    totals, expired, moved = plan_totals(day), expirations(day), flows(day)
+
+    rows = []
+    for membership_id in sorted((set(totals) | set(expired) | set(moved)) - {None}, key=str):
+        active, yearly, mrr = totals.get(membership_id, (0, 0, 0.0))
+        expired_count, expired_mrr = expired.get(membership_id, (0, 0.0))
+        plan = moved.get(membership_id, {})
+        rows.append({
+            'snapshot_date': day,
+            'membership_id': membership_id,
+            'plan_name': names.get(membership_id),
+            'active_members': active,
+            'yearly_members': yearly,
+            'mrr': round(mrr, 2),
+            'new_members': plan.get('new_members', 0),
+            'renewals': plan.get('renewals', 0),
+            'upgrades': plan.get('upgrades', 0),
+            'downgrades': plan.get('downgrades', 0),
+            'cancellations': plan.get('cancellations', 0),
+            'expirations': expired_count,
+            'new_mrr': round(plan.get('new_mrr', 0.0), 2),
+            'expansion_mrr': round(plan.get('expansion_mrr', 0.0), 2),
+            'contraction_mrr': round(plan.get('contraction_mrr', 0.0), 2),
+            'churned_mrr': round(plan.get('churned_mrr', 0.0) + expired_mrr, 2),
+            'generated_at': datetime.utcnow()
+        })
+
+    if not dry_run:
+        table = RevenueSnapshot.__table__
+        db.session.execute(table.delete().where(table.c.snapshot_date == day))
+        if rows:
+            db.session.execute(table.insert(), rows)
+        db.session.commit()
+
+    duration_ms = round((time.perf_counter() - started) * 1000, 2)
+    metrics.update(last_run_at=datetime.utcnow().isoformat(), last_duration_ms=duration_ms,
+                   snapshots=metrics['snapshots'] + 1, plans=len(rows))
+    logger.info('revenue snapshot for %s: %s plans, MRR %.2f in %sms', day.isoformat(), len(rows),
+                sum(row['mrr'] for row in rows), duration_ms)
+    return {'date': day.isoformat(), 'plans': len(rows), 'mrr': round(sum(row['mrr'] for row in rows), 2),
+            'active_members': sum(row['active_members'] for row in rows), 'dry_run': dry_run,
+            'duration_ms': duration_ms}
+
+
+def backfill(days, dry_run=False):
+    """Snapshot each of the last `days` days, up to today"""
+    today = date.today()
+    return [take_snapshot(today - timedelta(days=offset), dry_run) for offset in range(days - 1, -1, -1)]
+
+
+# ============================================
+# REPORT
+# ============================================
+
+def period_of(day, interval):
+    if interval == 'week':
+        return (day - timedelta(days=day.weekday())).isoformat()
+    if interval == 'month':
+        return day.strftime('%Y-%m')
+    return day.isoformat()
+
+
+def revenue_report(start, end, interval='day'):
+    """MRR, plan mix, churn and plan changes per day, week or month
+
+    Stock figures (members, MRR, mix) are those of the last snapshot in each
+    period; flows (new, upgrades, churn) are summed over the period.
+    """
+    snapshots = RevenueSnapshot.query.filter(
+        RevenueSnapshot.snapshot_date >= start,
+        RevenueSnapshot.snapshot_date <= end
+    ).order_by(RevenueSnapshot.snapshot_date).all()
+
+    periods = {}
+    for snapshot in snapshots:
+        key = period_of(snapshot.snapshot_date, interval)
+        period = periods.setdefault(key, {'closing_date': None, 'plans': {}, 'flows': {}})
+        if period['closing_date'] != snapshot.snapshot_date:
+            # A later day in the period: its stock figures replace the earlier ones
+            period['closing_date'] = snapshot.snapshot_date
+            period['plans'] = {}
+        period['plans'][snapshot.membership_id] = snapshot
+        flows_ = period['flows']
+        for field in ('new_members', 'renewals', 'upgrades', 'downgrades', 'cancellations', 'expirations',
+                      'new_mrr', 'expansion_mrr', 'contraction_mrr', 'churned_mrr'):
+            flows_[field] = flows_.get(field, 0) + getattr(snapshot, field)
+
+    report, previous_active = [], None
+    for key, period in periods.items():
+        plans = period['plans'].values()
+        active = sum(p.active_members for p in plans)
+        mrr = sum(p.mrr for p in plans)
+        flows_ = {field: round(value, 2) if isinstance(value, float) else value
+                  for field, value in period['flows'].items()}
+        churned = flows_['cancellations'] + flows_['expirations']
+        # Members at the start of the period: the previous close, or derived
+        opening = previous_active if previous_active is not None else \
+            active - flows_['new_members'] + churned
+        report.append({
+            'period': key,
+            'as_of': period['closing_date'].isoformat(),
+            'active_members': active,
+            'mrr': round(mrr, 2),
+            'arr': round(mrr * 12, 2),
+            **flows_,
+            'churned_members': churned,
+            'churn_rate': round(churned / opening, 4) if opening > 0 else None,
+            'net_new_mrr': round(flows_['new_mrr'] + flows_['expansion_mrr']
+                                 - flows_['contraction_mrr'] - flows_['churned_mrr'], 2),
+            'plans': [{
+                'membership_id': p.membership_id,
+                'name': p.plan_name,
+                'active_members': p.active_members,
+                'yearly_members': p.yearly_members,
+                'mrr': p.mrr,
+                'share': round(p.active_members / active, 4) if active else 0.0
+            } for p in sorted(plans, key=lambda p: -p.mrr)]
+        })
+        previous_active = active
+    return report
+
+
+def closed(day):
+    """True if `day` was snapshotted after it ended"""
+    last = db.session.query(func.max(RevenueSnapshot.generated_at)) \
+        .filter(RevenueSnapshot.snapshot_date == day).scalar()
+    return last is not None and last >= datetime.combine(day + timedelta(days=1), datetime.min.time())
+
+
+def run_continuously(interval=3600):
+    """Re-snapshot today every `interval` seconds, and yesterday once more
+    after midnight for the changes logged after its last snapshot"""
+    while True:
+        try:
+            with app.app_context():
+                today = date.today()
+                if not closed(today - timedelta(days=1)):
+                    take_snapshot(today - timedelta(days=1))
+                take_snapshot(today)
+        except Exception:
+            logger.exception('revenue snapshot failed')
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Take daily revenue and membership-mix snapshots')
+    parser.add_argument('--date', type=date.fromisoformat, default=None, help='Snapshot this day (YYYY-MM-DD)')
+    parser.add_argument('--backfill', type=int, default=None, help='Snapshot the last N days')
+    parser.add_argument('--watch', action='store_true', help='Keep re-snapshotting today')
+    parser.add_argument('--interval', type=int, default=3600, help='Seconds between snapshots with --watch')
+    parser.add_argument('--dry-run', action='store_true', help='Compute without storing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.watch:
+        run_continuously(args.interval)
+        return
+
+    with app.app_context():
+        if args.backfill:
+            report = backfill(args.backfill, dry_run=args.dry_run)
+        else:
+            report = take_snapshot(args.date or date.today(), dry_run=args.dry_run)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
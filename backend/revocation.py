@@ -0,0 +1,299 @@
+"""
+JWT revocation for The Fitness Revolution API
+
+Access tokens live for days, so logging out, changing a password or
+deactivating an account puts the affected token ids (JTIs) on a denylist.
+Every authenticated request checks its JTI against that list without a
+database query: each worker keeps the denylist in memory as a Bloom filter in
+front of an exact dict. Almost every token is not revoked and is answered by
+the filter alone; the few filter hits are confirmed in the dict, so false
+positives never reject a valid token.
+
+The denylist itself lives in a pluggable store. The SQLite store is shared by
+all gunicorn workers on a host: a sync thread per worker pulls new entries
+every REVOCATION_SYNC_INTERVAL seconds. Entries are dropped once the token
+they revoke has expired anyway.
+
+To revoke every token of a user, issued tokens are recorded per user when
+they are created (see ``track``).
+"""
+
+import hashlib
+import math
+import os
+import threading
+import time
+
+from shared_store import SharedSQLite, sqlite_path_from_url
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over string keys"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(1, capacity)
+        self.size = max(64, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+# ============================================
+# DENYLIST STORES
+# ============================================
+
+class DenylistStore:
+    """Interface for denylist storage backends"""
+
+    # True if other processes write to the store and it must be polled
+    shared = False
+
+    def revoke(self, entries):
+        """Add (jti, expires_at) pairs to the denylist"""
+        raise NotImplementedError
+
+    def changes(self, after):
+        """(cursor, [(jti, expires_at), ...]) for entries added after `after`"""
+        raise NotImplementedError
+
+    def track(self, jti, user_id, expires_at):
+        """Remember that token `jti` was issued to `user_id`"""
+        raise NotImplementedError
+
+    def user_tokens(self, user_id, now):
+        """(jti, expires_at) of `user_id`'s unexpired tokens"""
+        raise NotImplementedError
+
+    def prune(self, now):
+        """Forget entries for tokens that expired before `now`"""
+        raise NotImplementedError
+
+
+class MemoryDenylistStore(DenylistStore):
+    """In-process denylist; only correct with a single worker process"""
+
+    def __init__(self):
+        self._issued = {}
+        self._lock = threading.Lock()
+
+    def revoke(self, entries):
+        # Nothing to share: RevocationList already holds every entry
+        pass
+
+    def changes(self, after):
+        return after, []
+
+    def track(self, jti, user_id, expires_at):
+        with self._lock:
+            self._issued.setdefault(user_id, {})[jti] = expires_at
+
+    def user_tokens(self, user_id, now):
+        with self._lock:
+            tokens = self._issued.get(user_id, {})
+            return [(jti, exp) for jti, exp in tokens.items() if exp > now]
+
+    def prune(self, now):
+        with self._lock:
+            for tokens in self._issued.values():
+                for jti in [jti for jti, exp in tokens.items() if exp <= now]:
+                    del tokens[jti]
+
+
+class SQLiteDenylistStore(DenylistStore):
+    """Denylist in a SQLite file shared by all workers on the host"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            jti TEXT NOT NULL UNIQUE,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_revoked_tokens_expires_at ON revoked_tokens (expires_at);
+        CREATE TABLE IF NOT EXISTS issued_tokens (
+            jti TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_issued_tokens_user ON issued_tokens (user_id, expires_at);
+    """
+
+    shared = True
+
+    def __init__(self, path):
+        self.db = SharedSQLite(path, self.SCHEMA)
+
+    def revoke(self, entries):
+        with self.db.transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO revoked_tokens (jti, expires_at) VALUES (?, ?)',
+                             entries)
+
+    def changes(self, after):
+        rows = self.db.execute(
+            'SELECT seq, jti, expires_at FROM revoked_tokens WHERE seq > ? ORDER BY seq', (after,)
+        ).fetchall()
+        cursor = rows[-1][0] if rows else after
+        return cursor, [(jti, expires_at) for _, jti, expires_at in rows]
+
+    def track(self, jti, user_id, expires_at):
+        with self.db.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO issued_tokens (jti, user_id, expires_at) VALUES (?, ?, ?)',
+                         (jti, user_id, expires_at))
+
+    def user_tokens(self, user_id, now):
+        return self.db.execute(
+            'SELECT jti, expires_at FROM issued_tokens WHERE user_id = ? AND expires_at > ?',
+            (user_id, now)
+        ).fetchall()
+
+    def prune(self, now):
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM revoked_tokens WHERE expires_at <= ?', (now,))
+            conn.execute('DELETE FROM issued_tokens WHERE expires_at <= ?', (now,))
+
+
+# Storage URL scheme -> factory(url). Register more (e.g. redis) with
+# RevocationList.register_store().
+STORE_FACTORIES = {
+    'memory': lambda url: MemoryDenylistStore(),
+    'sqlite': lambda url: SQLiteDenylistStore(sqlite_path_from_url(url))
+}
+
+
+# ============================================
+# REVOCATION LIST
+# ============================================
+
+class RevocationList:
+    """In-memory view of the denylist used to check every request's JTI"""
+
+    MIN_CAPACITY = 1024
+    PRUNE_INTERVAL = 300
+
+    def __init__(self, app=None):
+        self.store = None
+        self.sync_interval = 1.0
+        self._revoked = {}
+        self._bloom = BloomFilter(self.MIN_CAPACITY)
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._sync_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    @staticmethod
+    def register_store(scheme, factory):
+        """Make a storage backend available under `scheme://` URLs"""
+        STORE_FACTORIES[scheme] = factory
+
+    def init_app(self, app):
+        url = app.config.get('REVOCATION_STORAGE_URL', 'memory://')
+        scheme = url.split(':', 1)[0]
+        if scheme not in STORE_FACTORIES:
+            raise ValueError(f'No revocation store registered for {scheme!r}')
+        self.store = STORE_FACTORIES[scheme](url)
+        self.sync_interval = app.config.get('REVOCATION_SYNC_INTERVAL', 1.0)
+        app.extensions['revocation'] = self
+
+    def is_revoked(self, jti):
+        """True if token `jti` was revoked (no I/O)"""
+        self._ensure_sync()
+        if jti not in self._bloom:
+            return False
+        return jti in self._revoked
+
+    def track(self, jti, user_id, expires_at):
+        """Record a newly issued token so revoke_user() can find it"""
+        self.store.track(jti, user_id, expires_at)
+
+    def revoke(self, jti, expires_at):
+        """Revoke one token (e.g. on logout)"""
+        self._revoke_all([(jti, expires_at)])
+
+    def revoke_user(self, user_id):
+        """Revoke every unexpired token issued to `user_id`; returns how many"""
+        tokens = self.store.user_tokens(user_id, time.time())
+        self._revoke_all(tokens)
+        return len(tokens)
+
+    def _revoke_all(self, entries):
+        entries = [(jti, float(expires_at)) for jti, expires_at in entries]
+        if not entries:
+            return
+        self.store.revoke(entries)
+        # Effective in this worker at once; other workers pick it up on sync
+        self._apply(entries)
+
+    def _apply(self, entries):
+        with self._lock:
+            for jti, expires_at in entries:
+                self._revoked[jti] = expires_at
+            if len(self._revoked) > self._bloom.capacity:
+                self._rebuild()
+            else:
+                for jti, _ in entries:
+                    self._bloom.add(jti)
+
+    def _rebuild(self):
+        # Called with the lock held; readers keep using the old filter until
+        # the new one is swapped in
+        bloom = BloomFilter(max(self.MIN_CAPACITY, 2 * len(self._revoked)))
+        for jti in self._revoked:
+            bloom.add(jti)
+        self._bloom = bloom
+
+    def _prune(self):
+        now = time.time()
+        with self._lock:
+            expired = [jti for jti, expires_at in self._revoked.items() if expires_at <= now]
+            for jti in expired:
+                del self._revoked[jti]
+            if expired:
+                self._rebuild()
+        self.store.prune(now)
+
+    def _sync(self):
+        cursor, entries = self.store.changes(self._cursor)
+        self._cursor = cursor
+        if entries:
+            self._apply(entries)
+
+    def _ensure_sync(self):
+        # One sync thread per worker process (re-created after fork)
+        if self._sync_pid == os.getpid():
+            return
+        with self._sync_lock:
+            if self._sync_pid == os.getpid():
+                return
+            # Load the current denylist before the first check is answered
+            self._sync()
+            thread = threading.Thread(target=self._sync_loop, name='revocation-sync', daemon=True)
+            thread.start()
+            self._sync_pid = os.getpid()
+
+    def _sync_loop(self):
+        last_prune = time.monotonic()
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                if self.store.shared:
+                    self._sync()
+                if time.monotonic() - last_prune > self.PRUNE_INTERVAL:
+                    last_prune = time.monotonic()
+                    self._prune()
+            except Exception:
+                continue
@@ -4,12 +4,13 @@ The Fitness Revolution - Flask Backend
 Run script for development server
 """
 
-from app import app, db
+from app import app, db, create_branch_tables
 
 if __name__ == '__main__':
     with app.app_context():
         # Create all database tables
         db.create_all()
+        create_branch_tables()
         print("✅ Database tables created")
     
     print("🚀 Starting Fitness Revolution API Server...")
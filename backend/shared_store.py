@@ -0,0 +1,68 @@
+"""
+Shared state store for The Fitness Revolution API
+
+Gunicorn runs several worker processes that do not share memory. Small pieces
+of cross-worker state (rate limit buckets and similar counters) live in a local
+SQLite file opened in WAL mode, which every worker on the host can read and
+write concurrently.
+"""
+
+import os
+import sqlite3
+import threading
+
+
+def sqlite_path_from_url(url):
+    """Return the file path of a sqlite:/// URL"""
+    if not url.startswith('sqlite:///'):
+        raise ValueError(f'Not a sqlite URL: {url}')
+    return url[len('sqlite:///'):]
+
+
+class SharedSQLite:
+    """Thread-local connections to a SQLite file shared between workers"""
+
+    def __init__(self, path, schema=''):
+        self.path = path
+        self.schema = schema
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def connection(self):
+        """Get (or open) this thread's connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            # isolation_level=None: transactions are managed explicitly
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if self.schema:
+                conn.executescript(self.schema)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    def transaction(self):
+        """Context manager for an immediate (write-locked) transaction"""
+        return _ImmediateTransaction(self.connection())
+
+
+class _ImmediateTransaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
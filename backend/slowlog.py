@@ -0,0 +1,339 @@
+"""
+Slow-query log for The Fitness Revolution API
+
+Every statement on every engine (primary, branches, replicas) is timed.
+Those taking longer than SLOW_QUERY_THRESHOLD_MS are queued with their
+parameters and the route that ran them, and a background thread per worker
+process adds the database's plan for the statement (EXPLAIN QUERY PLAN on
+SQLite, EXPLAIN elsewhere), writes one JSON line to a rotating log and adds
+it to this worker's per-fingerprint summary (GET /api/admin/slow-queries).
+Each worker writes (and rotates) a log of its own, SLOW_QUERY_LOG with the
+pid added (logs/slow-queries-<pid>.jsonl).
+
+The plan is asked for on a separate pooled connection, so a slow request
+waits for nothing but its own statement, and at most once per fingerprint
+every SLOW_QUERY_EXPLAIN_INTERVAL seconds. Only SELECT, UPDATE and DELETE
+statements are explained; plain EXPLAIN doesn't run them.
+
+Parameters whose name matches one of SLOW_QUERY_REDACT (email, password,
+first_name, ...) are logged as '[redacted]', as are values that look like an
+email address or phone number wherever they appear.
+
+The logs of all workers can be summarized the same way offline:
+
+    python slowlog.py logs/slow-queries-*.jsonl*
+"""
+
+import argparse
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from querybudget import fingerprint
+
+REDACTED = '[redacted]'
+
+EXPLAINABLE = re.compile(r'^\s*(SELECT|WITH|UPDATE|DELETE)\b', re.IGNORECASE)
+EMAIL = re.compile(r'[^@\s]+@[^@\s]+\.\w+')
+PHONE = re.compile(r'^\+?[\d\s().-]{7,}\d$')
+
+MAX_STATEMENT = 4000
+MAX_VALUE = 200
+
+
+def database_name(engine):
+    return engine.url.render_as_string(hide_password=True)
+
+
+def worker_log_path(path, pid):
+    """`path` with the worker's pid before the extension"""
+    root, extension = os.path.splitext(path)
+    return f'{root}-{pid}{extension}'
+
+
+def explain_prefix(dialect_name):
+    return 'EXPLAIN QUERY PLAN ' if dialect_name == 'sqlite' else 'EXPLAIN '
+
+
+def redact_value(value):
+    """A parameter value as logged: PII-looking strings redacted, long ones cut"""
+    if isinstance(value, (list, tuple)):
+        return [redact_value(item) for item in value[:20]]
+    if isinstance(value, bytes):
+        value = value.hex()
+    if isinstance(value, str):
+        if EMAIL.search(value) or PHONE.match(value):
+            return REDACTED
+        return value if len(value) <= MAX_VALUE else f'{value[:MAX_VALUE]}... ({len(value)} chars)'
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return str(value)
+
+
+def redact(parameters, sensitive):
+    """{name: value} with values of sensitive names (a compiled regex) redacted"""
+    return {name: REDACTED if value is not None and sensitive.search(name) else redact_value(value)
+            for name, value in parameters.items()}
+
+
+def summarize(entries, limit=20, sort='total_ms'):
+    """Slow statements grouped by fingerprint, biggest `sort` first"""
+    groups = {}
+    for entry in entries:
+        if entry['fingerprint'] not in groups:
+            groups[entry['fingerprint']] = _group(entry['fingerprint'])
+        _add(groups[entry['fingerprint']], entry)
+    return _ranked(groups.values(), limit, sort)
+
+
+def _group(key):
+    return {'fingerprint': key, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'routes': Counter(),
+            'databases': Counter(), 'plan': None, 'slowest': None, 'last_seen': None}
+
+
+def _add(group, entry):
+    group['count'] += 1
+    group['total_ms'] += entry['duration_ms']
+    group['routes'][entry.get('route') or entry.get('thread')] += 1
+    group['databases'][entry['database']] += 1
+    group['last_seen'] = entry['time']
+    if entry.get('plan') is not None:
+        group['plan'] = entry['plan']
+    if entry['duration_ms'] >= group['max_ms']:
+        group['max_ms'] = entry['duration_ms']
+        group['slowest'] = {key: entry.get(key) for key in ('time', 'statement', 'parameters', 'route', 'path')}
+
+
+def _ranked(groups, limit, sort):
+    ranked = sorted(groups, key=lambda group: group[sort], reverse=True)[:limit]
+    return [{**group, 'total_ms': round(group['total_ms'], 1), 'mean_ms': round(group['total_ms'] / group['count'], 1),
+             'max_ms': round(group['max_ms'], 1), 'routes': dict(group['routes'].most_common(10)),
+             'databases': dict(group['databases'])} for group in ranked]
+
+
+class SlowQueryLog:
+    """Logs and summarizes statements slower than a threshold, with their plans"""
+
+    SORTS = ('total_ms', 'max_ms', 'count')
+
+    def __init__(self, app=None):
+        self.app = None
+        self.threshold = 0.0
+        self.path = None
+        self.log_bytes = 10 * 1024 * 1024
+        self.log_backups = 5
+        self.explain_interval = 300
+        self.max_fingerprints = 500
+        self.sensitive = None
+        self.logger = None
+        self.groups = {}        # fingerprint -> summary, as summarize() builds them
+        self._plans = {}        # (database, fingerprint) -> (plan, monotonic time explained)
+        self._queue = queue.Queue(maxsize=1000)
+        self._lock = threading.Lock()
+        self._pid = None
+        self.metrics = {'captured': 0, 'logged': 0, 'explained': 0, 'explain_errors': 0, 'dropped': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.threshold = float(app.config.get('SLOW_QUERY_THRESHOLD_MS') or 0) / 1000
+        self.path = app.config.get('SLOW_QUERY_LOG', 'logs/slow-queries.jsonl')
+        self.log_bytes = app.config.get('SLOW_QUERY_LOG_BYTES', 10 * 1024 * 1024)
+        self.log_backups = app.config.get('SLOW_QUERY_LOG_BACKUPS', 5)
+        self.explain_interval = app.config.get('SLOW_QUERY_EXPLAIN_INTERVAL', 300)
+        self.max_fingerprints = app.config.get('SLOW_QUERY_MAX_FINGERPRINTS', 500)
+        fields = app.config.get('SLOW_QUERY_REDACT',
+                                'email,phone,password,name,birth,address,token,secret,message')
+        self.sensitive = re.compile('|'.join(re.escape(field.strip()) for field in fields.split(',') if field.strip())
+                                    or r'(?!)', re.IGNORECASE)
+        app.extensions['slow_query_log'] = self
+        if self.threshold <= 0:
+            return
+
+        self.logger = logging.getLogger('slowlog')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    # ----- timing (every statement) -----
+
+    # The start is kept on the statement's execution context, so a statement
+    # that raises (and never reaches after_cursor_execute) leaves nothing behind
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._slowlog_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_slowlog_started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        if elapsed >= self.threshold:
+            self._capture(conn.engine, statement, parameters, context, executemany, elapsed)
+
+    # ----- capturing (slow statements only) -----
+
+    def _capture(self, engine, statement, parameters, context, executemany, elapsed):
+        entry = {
+            'time': datetime.utcnow().isoformat(),
+            'duration_ms': round(elapsed * 1000, 2),
+            'database': database_name(engine),
+            'fingerprint': fingerprint(statement),
+            'statement': statement[:MAX_STATEMENT],
+            'parameters': self._parameters(parameters, context, executemany),
+            'route': None,
+            'thread': threading.current_thread().name,
+            'pid': os.getpid()
+        }
+        if has_request_context():
+            entry.update(route=request.endpoint, method=request.method,
+                         # The rule, not the path: paths can carry tokens and emails
+                         path=request.url_rule.rule if request.url_rule else None)
+        # The plan needs the values the statement ran with, unredacted
+        explain = None if executemany or not EXPLAINABLE.match(statement) else (statement, parameters)
+        self._ensure_writer()
+        self.metrics['captured'] += 1
+        try:
+            self._queue.put_nowait((engine, explain, entry))
+        except queue.Full:
+            self.metrics['dropped'] += 1
+
+    def _parameters(self, parameters, context, executemany):
+        if executemany:
+            return {'executemany': len(parameters)}
+        compiled = getattr(context, 'compiled', None)
+        if compiled is not None and context.compiled_parameters:
+            # Named, and before type processing (ids as strings, not bytes)
+            named = context.compiled_parameters[0]
+        elif isinstance(parameters, dict):
+            named = parameters
+        else:
+            named = {str(position): value for position, value in enumerate(parameters or (), 1)}
+        return redact(named, self.sensitive)
+
+    # ----- writing (background thread) -----
+
+    def _ensure_writer(self):
+        # One writer thread per worker process (re-created after fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=1000)
+            self._open_log()
+            thread = threading.Thread(target=self._write_loop, name='slowlog', daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def _open_log(self):
+        # Here rather than in init_app: with gunicorn --preload the app is
+        # created in the master, before the workers (and their pids) exist
+        if not self.path:
+            return
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            worker_log_path(self.path, os.getpid()), maxBytes=self.log_bytes,
+            backupCount=self.log_backups, delay=True)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(handler)
+
+    def _write_loop(self):
+        while True:
+            engine, explain, entry = self._queue.get()
+            try:
+                self.write(engine, explain, entry)
+            except Exception:
+                self.app.logger.exception('slow query log write failed')
+
+    def write(self, engine, explain, entry):
+        if explain is not None:
+            entry['plan'] = self.plan(engine, entry['fingerprint'], *explain)
+        if self.logger is not None:
+            self.logger.info(json.dumps(entry, default=str))
+        with self._lock:
+            if entry['fingerprint'] not in self.groups:
+                if len(self.groups) >= self.max_fingerprints:
+                    # Forget the statement that has cost least so far
+                    del self.groups[min(self.groups, key=lambda key: self.groups[key]['total_ms'])]
+                self.groups[entry['fingerprint']] = _group(entry['fingerprint'])
+            _add(self.groups[entry['fingerprint']], entry)
+            self.metrics['logged'] += 1
+
+    def plan(self, engine, key, statement, parameters):
+        """The engine's plan for a statement, explained at most once per interval"""
+        cache_key = (database_name(engine), key)
+        cached = self._plans.get(cache_key)
+        if cached and time.monotonic() - cached[1] < self.explain_interval:
+            return cached[0]
+        # A raw DBAPI cursor: no engine events, so this isn't timed or counted itself
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(explain_prefix(engine.dialect.name) + statement, parameters)
+            rows = cursor.fetchall()
+            cursor.close()
+            # SQLite: (id, parent, notused, detail); PostgreSQL and MySQL: one text column or a row of columns
+            plan = [str(row[-1]) if engine.dialect.name == 'sqlite' or len(row) == 1
+                    else ' | '.join(str(column) for column in row) for row in rows]
+            self.metrics['explained'] += 1
+        except Exception as e:
+            plan = [f'EXPLAIN failed: {e}']
+            self.metrics['explain_errors'] += 1
+        finally:
+            connection.rollback()
+            connection.close()
+        self._plans[cache_key] = (plan, time.monotonic())
+        return plan
+
+    def status(self, limit=20, sort='total_ms'):
+        with self._lock:
+            statements = _ranked(list(self.groups.values()), limit, sort)
+        log = worker_log_path(self.path, os.getpid()) if self.enabled and self.path else None
+        return {'threshold_ms': self.threshold * 1000, 'log': log,
+                **self.metrics, 'pending': self._queue.qsize(), 'statements': statements}
+
+
+def read_entries(paths):
+    for path in paths:
+        with open(path, encoding='utf-8') as log:
+            for line in log:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue    # a line cut short by a crash
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize slow-query logs by statement fingerprint')
+    parser.add_argument('paths', nargs='+', help='Slow-query log files (every worker, every rotation)')
+    parser.add_argument('--sort', choices=SlowQueryLog.SORTS, default='total_ms', help='Rank statements by')
+    parser.add_argument('--limit', type=int, default=20, help='Statements to show')
+    args = parser.parse_args()
+
+    print(json.dumps(summarize(read_entries(args.paths), args.limit, args.sort), indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,12 @@
 """
 Test script for The Fitness Revolution API
 Run this to verify all endpoints are working
+
+Start the server with QUERY_BUDGET_MODE=enforce (app.py reads its
+settings from the environment), so a route over its SQL statement budget
+fails the run:
+
+    QUERY_BUDGET_MODE=enforce python run.py
 """
 
 import requests
@@ -33,7 +39,7 @@ def test_endpoint(name, method, endpoint, data=None, headers=None):
             tests_failed += 1
             return None
         
-        if response.status_code in [200, 201]:
+        if response.status_code in [200, 201, 202]:
             print(f"✅ {name} ({response.status_code})")
             tests_passed += 1
             return response.json()
@@ -47,10 +53,143 @@ def test_endpoint(name, method, endpoint, data=None, headers=None):
         tests_failed += 1
         return None
 
-def run_tests():
-    """Run all API tests"""
+def test_rate_limit():
+    """Repeated failed logins for one account should be rejected with 429"""
+    global tests_passed, tests_failed
+    
+    login_data = {"email": "ratelimit@example.com", "password": "wrong-password"}
+    for attempt in range(20):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json=login_data, timeout=5)
+        if response.status_code == 429:
+            print(f"✅ Login Rate Limit (429 after {attempt} attempts, Retry-After {response.headers.get('Retry-After')})")
+            tests_passed += 1
+            return
+    
+    print("❌ Login Rate Limit: never rejected")
+    tests_failed += 1
+
+def test_logout():
+    """A token should be rejected after logging out with it"""
+    global tests_passed, tests_failed
+    
+    login_data = {"email": "admin@fitnessrevolution.in", "password": "admin123"}
+    token = requests.post(f"{BASE_URL}/api/auth/login", json=login_data, timeout=5).json().get('token')
+    headers = {'Authorization': f'Bearer {token}'}
+    requests.post(f"{BASE_URL}/api/auth/logout", headers=headers, timeout=5)
+    response = requests.get(f"{BASE_URL}/api/auth/me", headers=headers, timeout=5)
+    
+    if response.status_code == 401:
+        print(f"✅ Logout Revokes Token ({response.status_code})")
+        tests_passed += 1
+    else:
+        print(f"❌ Logout Revokes Token: got {response.status_code}")
+        tests_failed += 1
+
+def test_event_stream():
+    """The capacity stream should open as text/event-stream"""
+    global tests_passed, tests_failed
+    
+    try:
+        with requests.get(f"{BASE_URL}/api/classes/stream", stream=True, timeout=5) as response:
+            first_line = next(response.iter_lines())
+            if response.headers.get('Content-Type', '').startswith('text/event-stream') and first_line.startswith(b'retry:'):
+                print(f"✅ Class Availability Stream ({response.status_code})")
+                tests_passed += 1
+                return
+    except Exception as e:
+        print(f"❌ Class Availability Stream: {str(e)}")
+        tests_failed += 1
+        return
+    
+    print("❌ Class Availability Stream: not an event stream")
+    tests_failed += 1
+
+def test_calendar_feed(headers):
+    """A calendar feed should be iCalendar and answer 304 to its own ETag"""
     global tests_passed, tests_failed
     
+    feed = requests.post(f"{BASE_URL}/api/calendar/feeds", json={"kind": "member"}, headers=headers, timeout=5).json()
+    path = feed['feed']['url'].split('/api/', 1)[1]
+    response = requests.get(f"{BASE_URL}/api/{path}", timeout=5)
+    etag = response.headers.get('ETag')
+    revalidated = requests.get(f"{BASE_URL}/api/{path}", headers={'If-None-Match': etag}, timeout=5)
+    
+    if response.text.startswith('BEGIN:VCALENDAR') and revalidated.status_code == 304:
+        print(f"✅ Calendar Feed ({response.status_code}, then {revalidated.status_code})")
+        tests_passed += 1
+    else:
+        print(f"❌ Calendar Feed: got {response.status_code}, then {revalidated.status_code}")
+        tests_failed += 1
+
+def tiny_png(width=8, height=8):
+    """A solid orange PNG, built without an imaging library"""
+    import struct
+    import zlib
+    
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\x00' + b'\xf9\x73\x16' * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+def test_profile_image(headers, user_id):
+    """An uploaded image should be served as immutable resized variants"""
+    global tests_passed, tests_failed
+    
+    upload = requests.post(f"{BASE_URL}/api/users/{user_id}/profile-image", headers=headers,
+                           files={'image': ('me.png', tiny_png(), 'image/png')}, timeout=10)
+    if upload.status_code != 201:
+        print(f"❌ Profile Image ({upload.status_code}): {upload.text[:100]}")
+        tests_failed += 1
+        return
+    variant = requests.get(BASE_URL + upload.json()['image']['variants']['card']['webp'], timeout=5)
+    
+    if variant.status_code == 200 and 'immutable' in variant.headers.get('Cache-Control', ''):
+        print(f"✅ Profile Image ({upload.status_code}, then {variant.status_code} {variant.headers['Content-Type']})")
+        tests_passed += 1
+    else:
+        print(f"❌ Profile Image: variant returned {variant.status_code}")
+        tests_failed += 1
+
+def test_query_budget(headers):
+    """Every route should declare a SQL statement budget, and none was exceeded"""
+    global tests_passed, tests_failed
+    
+    status = requests.get(f"{BASE_URL}/api/admin/query-budget", headers=headers, timeout=5).json()['query_budget']
+    undeclared = status['undeclared']
+    violations = [v['endpoint'] for v in status['recent_violations']]
+    
+    if status['mode'] != 'enforce':
+        print(f"❌ Query Budgets: server runs in {status['mode']} mode; restart it with QUERY_BUDGET_MODE=enforce")
+        tests_failed += 1
+    elif not undeclared and not violations:
+        print(f"✅ Query Budgets ({status['mode']}, {len(status['endpoints'])} routes counted)")
+        tests_passed += 1
+    else:
+        print(f"❌ Query Budgets: undeclared {undeclared}, exceeded by {violations}")
+        tests_failed += 1
+
+def test_profiled_request(headers):
+    """An admin request with X-Profile should leave a downloadable profile"""
+    global tests_passed, tests_failed
+    
+    response = requests.get(f"{BASE_URL}/api/classes", headers={**headers, 'X-Profile': 'cprofile'}, timeout=10)
+    profile_id = response.headers.get('X-Profile-Id')
+    if not profile_id:
+        print(f"❌ Profiled Request ({response.status_code}): no X-Profile-Id")
+        tests_failed += 1
+        return
+    report = requests.get(f"{BASE_URL}/api/admin/profiles/{profile_id}?format=text", headers=headers, timeout=5)
+    
+    if report.status_code == 200 and 'get_classes' in report.text:
+        print(f"✅ Profiled Request ({response.status_code}, then {report.status_code} pstats report)")
+        tests_passed += 1
+    else:
+        print(f"❌ Profiled Request: report returned {report.status_code}")
+        tests_failed += 1
+
+def run_tests():
+    """Run all API tests"""
     print("=" * 60)
     print("🧪 The Fitness Revolution API Tests")
     print("=" * 60)
@@ -67,8 +206,21 @@ def run_tests():
     test_endpoint("Get Memberships", "GET", "/api/memberships")
     test_endpoint("Get Programs", "GET", "/api/programs")
     test_endpoint("Get Trainers", "GET", "/api/trainers")
+    test_endpoint("Get Ranked Trainers", "GET", "/api/trainers?sort=ranking&limit=3")
     test_endpoint("Get Meal Plans", "GET", "/api/meal-plans")
     test_endpoint("Get Classes", "GET", "/api/classes")
+    test_endpoint("Get Branches", "GET", "/api/branches")
+    test_endpoint("Get Branch Classes", "GET", "/api/classes?branch=main")
+    test_event_stream()
+    test_endpoint("Batch Public Endpoints", "POST", "/api/batch", {
+        "requests": [
+            {"id": "memberships", "path": "/api/memberships"},
+            {"id": "programs", "path": "/api/programs"},
+            {"id": "trainers", "path": "/api/trainers"},
+            {"id": "meal_plans", "path": "/api/meal-plans"},
+            {"id": "classes", "path": "/api/classes"}
+        ]
+    })
     
     # Contact form
     contact_data = {
@@ -111,7 +263,9 @@ def run_tests():
         print("-" * 40)
         
         # User endpoints
-        test_endpoint("Get Current User", "GET", "/api/auth/me", headers=headers)
+        me = test_endpoint("Get Current User", "GET", "/api/auth/me", headers=headers)
+        if me:
+            test_profile_image(headers, me['user']['id'])
         test_endpoint("Get All Users", "GET", "/api/users", headers=headers)
         
         # Contact messages (admin)
@@ -119,6 +273,26 @@ def run_tests():
         
         # Admin dashboard
         test_endpoint("Admin Dashboard", "GET", "/api/admin/dashboard", headers=headers)
+        test_endpoint("Reconcile Enrolled Counts", "POST", "/api/admin/reconcile", {"dry_run": True}, headers)
+        test_endpoint("Archive Dry Run", "POST", "/api/admin/archive", {"dry_run": True}, headers)
+        test_endpoint("Refresh Recommendations", "POST", "/api/admin/recommendations/refresh", {"dry_run": True}, headers)
+        test_endpoint("Get Recommendations", "GET", "/api/recommendations?include_classes=true", headers=headers)
+        test_endpoint("Refresh Forecasts", "POST", "/api/admin/forecasts/refresh", {"dry_run": True}, headers)
+        test_endpoint("Occupancy Forecasts", "GET", "/api/admin/forecasts/occupancy", headers=headers)
+        test_endpoint("Revenue Snapshot", "POST", "/api/admin/reports/revenue/snapshot", headers=headers)
+        test_endpoint("Revenue Report", "GET", "/api/admin/reports/revenue?interval=week", headers=headers)
+        test_endpoint("Check-in Status", "GET", "/api/admin/checkin", headers=headers)
+        test_endpoint("Contact Queue Status", "GET", "/api/admin/contact-queue", headers=headers)
+        test_endpoint("Slow Queries", "GET", "/api/admin/slow-queries?sort=max_ms", headers=headers)
+        test_profiled_request(headers)
+        test_endpoint("Request Profiles", "GET", "/api/admin/profiles", headers=headers)
+        test_calendar_feed(headers)
+        test_endpoint("Rebuild Leaderboards", "POST", "/api/admin/leaderboards/rebuild", headers=headers)
+        test_endpoint("Weekly Workout Leaderboard", "GET", "/api/leaderboards/workouts?period=week", headers=headers)
+        test_endpoint("My Calorie Rank", "GET", "/api/leaderboards/calories/me?period=all", headers=headers)
+        test_endpoint("Refresh Meal Plans", "POST", "/api/admin/meal-plans/refresh", {"dry_run": True}, headers)
+        test_endpoint("Booking History", "GET", "/api/admin/history/bookings", headers=headers)
+        test_endpoint("Class History", "GET", "/api/admin/history/classes?start=2024-01-01", headers=headers)
         
         # Create membership (admin)
         membership_data = {
@@ -141,10 +315,18 @@ def run_tests():
             "level": "beginner"
         }
         test_endpoint("Create Program", "POST", "/api/programs", program_data, headers)
+        test_query_budget(headers)
+        
+        test_logout()
         
     else:
         print("⚠️  Skipping protected endpoints (login failed)")
     
+    print()
+    print("🚦 Testing Rate Limiting...")
+    print("-" * 40)
+    test_rate_limit()
+    
     print()
     print("=" * 60)
     print(f"📊 Test Results: {tests_passed} passed, {tests_failed} failed")
@@ -155,7 +337,7 @@ def run_tests():
 if __name__ == '__main__':
     import sys
     
-    print("\n⚠️  Make sure the Flask server is running on http://localhost:5000\n")
+    print("\n⚠️  Make sure the Flask server is running on http://localhost:5000 with QUERY_BUDGET_MODE=enforce\n")
     
     try:
         success = run_tests()